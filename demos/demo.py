@@ -97,13 +97,11 @@ def slide_demo(screen):
     bodies = []
     joints = []
 
-    r = Rect([500, 300], [900, 10])
+    r = Rect([500, 300], [900, 10], static=True)
     r.v[0] = math.pi / 32
     r.move(1)
     r.v[0] = 0.
     bodies.append(r)
-    joints.append(Joint(r, None, [100, 260]))
-    joints.append(Joint(r, None, [850, 335]))
     # joints.append(Joint(r, None, [100, 340]))
     # joints.append(Joint(r, None, [850, 265]))
     # joints.append(Joint(r, None, [110, 200]))
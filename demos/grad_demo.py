@@ -151,10 +151,8 @@ def make_world(learned_force):
     bodies.append(target)
     target.add_no_collision(c)
 
-    r = Rect([500, 300], [1000, 20])
+    r = Rect([500, 300], [1000, 20], static=True)
     bodies.append(r)
-    joints.append(Joint(r, None, [50, 275]))
-    joints.append(Joint(r, None, [950, 325]))
     # r = Rect([300, 100], [25, 500], mass=10000)
     # bodies.append(r)
 
@@ -212,8 +212,8 @@ def positions_run_world(world, dt=Params.DEFAULT_DT, run_time=10,
 
                 # # XXX visualize collision points and normal for debug
                 # if world.collisions_debug:
-                #     for c in world.collisions_debug:
-                #         (normal, p1, p2, penetration), b1, b2 = c
+                #     c = world.collisions_debug
+                #     for normal, (p1, p2), (b1, b2) in zip(c.normals, c.arms, c.bodies):
                 #         b1_pos = world.bodies[b1].pos
                 #         b2_pos = world.bodies[b2].pos
                 #         p1 = p1 + b1_pos
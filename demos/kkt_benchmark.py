@@ -0,0 +1,97 @@
+import sys
+import time
+from functools import partial
+
+from lcp_physics.lcp.lcp import LCPFunction
+from lcp_physics.physics.bodies import Circle, Rect
+from lcp_physics.physics.constraints import Joint
+from lcp_physics.physics.engines import PdipmEngine
+from lcp_physics.physics.forces import ExternalForce, gravity
+from lcp_physics.physics.utils import Params
+from lcp_physics.physics.world import World
+
+
+STEPS = 100
+DT = Params.DEFAULT_DT
+
+
+def stack_scene(engine):
+    bodies = []
+    r = Rect([500, 500], [900, 10], static=True)
+    bodies.append(r)
+    for i in range(5):
+        for j in range(3):
+            r = Rect([300 + 150 * i, 470 - 61 * j], [60, 60])
+            r.add_force(ExternalForce(gravity, multiplier=100))
+            bodies.append(r)
+    return World(bodies, [], dt=DT, engine=engine)
+
+
+def chain_scene(engine):
+    bodies = []
+    joints = []
+    r = Rect([500, 500], [900, 10], static=True)
+    bodies.append(r)
+    c = Circle([300, 100], 20)
+    bodies.append(c)
+    joints.append(Joint(c, None, [300, 60]))
+    for i in range(1, 8):
+        c = Circle([300 + 40 * i, 100], 20)
+        c.add_force(ExternalForce(gravity, multiplier=100))
+        bodies.append(c)
+        joints.append(Joint(bodies[-1], bodies[-2], [280 + 40 * i, 100]))
+    for i in range(4):
+        c = Circle([200 + 60 * i, 470], 20)
+        c.add_force(ExternalForce(gravity, multiplier=100))
+        bodies.append(c)
+    return World(bodies, joints, dt=DT, engine=engine)
+
+
+# numbers of iterations, i.e. of KKT (PDIPM) or Jacobian (FB Newton)
+# factorizations, at which the solvers' accuracy is measured
+FACTORIZATIONS = [1, 2, 4, 8, 16]
+
+SOLVERS = [('PDIPM_BATCHED', 'LU_FULL'), ('PDIPM_BATCHED', 'LU_PARTIAL'),
+           ('PDIPM_BATCHED', 'SP_LU_BATCHED'), ('FB_NEWTON_BATCHED', 'LU_FULL')]
+
+
+def benchmark(scene, solver, kkt_solver, steps=STEPS):
+    """Returns the mean time per step and the final velocities."""
+    world = scene(PdipmEngine(solver=solver, kkt_solver=kkt_solver))
+    start = time.time()
+    for _ in range(steps):
+        world.step()
+    return (time.time() - start) / steps, world.v.data
+
+
+def accuracy(scene, solver, factorizations=FACTORIZATIONS):
+    """Returns the max velocity error of the scene's first solve, for each
+    number of factorizations, against a converged PDIPM solve."""
+    engine = PdipmEngine(warm_start=False)
+    engine.lcp_solver = partial(LCPFunction, maxIter=100)
+    reference = scene(engine).solve_dynamics(DT).data
+    errors = []
+    for max_iter in factorizations:
+        engine = PdipmEngine(warm_start=False, solver=solver)
+        engine.lcp_solver = partial(LCPFunction, maxIter=max_iter)
+        errors.append((scene(engine).solve_dynamics(DT).data - reference).abs().max())
+    return errors
+
+
+if __name__ == '__main__':
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else STEPS
+    for scene in [stack_scene, chain_scene]:
+        # timings relative to, and velocities compared with, the first solver
+        base_time, base_v = None, None
+        for solver, kkt_solver in SOLVERS:
+            step_time, v = benchmark(scene, solver, kkt_solver, steps)
+            if base_time is None:
+                base_time, base_v = step_time, v
+            print('{:12} {:18} {:14} {:8.2f} ms/step {:5.2f}x  max |dv| {:.2e}'.format(
+                scene.__name__, solver, kkt_solver, 1000 * step_time,
+                base_time / step_time, (v - base_v).abs().max()))
+        print('{:12} max |dv| after {} factorizations'.format(
+            scene.__name__, ', '.join(str(k) for k in FACTORIZATIONS)))
+        for solver in ['PDIPM_BATCHED', 'FB_NEWTON_BATCHED']:
+            print('{:12} {:18} {}'.format(scene.__name__, solver, ' '.join(
+                '{:.2e}'.format(e) for e in accuracy(scene, solver))))
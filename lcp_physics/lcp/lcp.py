@@ -4,23 +4,45 @@ import torch
 from torch.autograd import Function
 
 from .solvers import batch_pdipm as pdipm_b
-from .util import bger, expandParam, extract_nBatch
+from .solvers import batch_fb_newton as fbn_b
+from .util import bger, expandParam, extract_nBatch, ruiz_scaling, scale_lcp, \
+    scale_solution, unscale_solution
+
+
+# Regularization of Q when it is factored for backward
+BACKWARD_REG_EPS = 1e-7
+
+
+def is_symmetric(X):
+    """Whether each of the batched matrices X (or None) is symmetric."""
+    return X is None or (X - X.transpose(1, 2)).abs().max() == 0
 
 
 class LCPSolvers(Enum):
     PDIPM_BATCHED = 1
+    # Fischer-Burmeister semismooth Newton, see batch_fb_newton
+    FB_NEWTON_BATCHED = 2
 
 
 class LCPFunction(Function):
 
     def __init__(self, eps=1e-12, verbose=0, notImprovedLim=3,
-                 maxIter=20, solver=LCPSolvers.PDIPM_BATCHED):
+                 maxIter=20, solver=LCPSolvers.PDIPM_BATCHED, warm_start=None,
+                 kkt_solver=pdipm_b.KKTSolvers.LU_FULL, workspace=None,
+                 equilibrate=False):
         super().__init__()
         self.eps = eps
         self.verbose = verbose
         self.notImprovedLim = notImprovedLim
         self.maxIter = maxIter
         self.solver = solver
+        self.kkt_solver = kkt_solver
+        # Optional initial (x, s, z, y) guess for the solver
+        self.warm_start = warm_start
+        # Optional pdipm_b.KKTWorkspace, reusing buffers across solves
+        self.workspace = workspace
+        # Solve the problem after Ruiz equilibration
+        self.equilibrate = equilibrate
 
     def forward(self, Q_, p_, G_, h_, A_, b_, F_):
         # TODO Write detailed documentation.
@@ -41,16 +63,54 @@ class LCPFunction(Function):
         assert(neq > 0 or nineq > 0)
         self.neq, self.nineq, self.nz = neq, nineq, nz
 
+        warm_start = self.warm_start
+        self.scaling = None
+        if self.equilibrate:
+            self.scaling = ruiz_scaling(Q, G, A, F)
+            Q, p, G, h, A, b, F = scale_lcp(self.scaling, Q, p, G, h, A, b, F)
+            if warm_start is not None:
+                x, s, z, y = warm_start
+                x, y, z, s = scale_solution(self.scaling, x, y, z, s)
+                warm_start = x, s, z, y
+            # backward solves the scaled KKT system, as factored in forward
+            self.scaled_kkt = G, A
+
         if self.solver == LCPSolvers.PDIPM_BATCHED:
-            Q_LU = S_LU = R = None
-            # Q_LU, S_LU, R = pre_factor_kkt(Q, G, F, A)
+            if self.kkt_solver == pdipm_b.KKTSolvers.LU_PARTIAL:
+                # Factor Q once, only the D dependent block is refactored
+                # at each iteration
+                Q_LU, S_LU, R = pdipm_b.pre_factor_kkt(Q, G, F, A)
+            else:
+                Q_LU = S_LU = R = None
             zhats, self.nus, self.lams, self.slacks = pdipm_b.forward(
                 Q, p, G, h, A, b, F, Q_LU, S_LU, R,
                 self.eps, self.verbose, self.notImprovedLim,
-                self.maxIter, solver=pdipm_b.KKTSolvers.LU_FULL)
+                self.maxIter, solver=self.kkt_solver,
+                warm_start=warm_start, workspace=self.workspace)
+            self.kkt_factors = None
+            if any(self.needs_input_grad):
+                # backward solves the transposed KKT system, i.e. with Q^T and
+                # F^T (F's friction blocks are not symmetric). Its Q
+                # factorization and partial Schur complement only depend on
+                # the problem: LU_PARTIAL's are reused if the system is
+                # symmetric, else they are factored once here
+                if Q_LU is None or not (is_symmetric(Q) and is_symmetric(F)):
+                    Q_t = Q.transpose(1, 2) + BACKWARD_REG_EPS * \
+                        torch.eye(nz).type_as(Q).repeat(nBatch, 1, 1)
+                    F_t = F.transpose(1, 2) if F is not None else None
+                    Q_LU, S_LU, R = pdipm_b.pre_factor_kkt(Q_t, G, F_t, A)
+                self.kkt_factors = Q_LU, S_LU, R
+        elif self.solver == LCPSolvers.FB_NEWTON_BATCHED:
+            zhats, self.nus, self.lams, self.slacks = fbn_b.forward(
+                Q, p, G, h, A, b, F, self.eps, self.verbose, self.maxIter,
+                self.notImprovedLim, warm_start=warm_start)
         else:
             assert False
 
+        if self.scaling is not None:
+            zhats, self.nus, self.lams, self.slacks = unscale_solution(
+                self.scaling, zhats, self.nus, self.lams, self.slacks)
+
         self.save_for_backward(zhats, Q_, p_, G_, h_, A_, b_, F_)
         return zhats
 
@@ -68,22 +128,45 @@ class LCPFunction(Function):
         # neq, nineq, nz = self.neq, self.nineq, self.nz
         neq, nineq = self.neq, self.nineq
 
-        D = torch.diag((self.lams / self.slacks).squeeze(0)).unsqueeze(0)
-        # XXX
-        dx, _, dlam, dnu = pdipm_b.solve_kkt_ir_inverse(
-            Q, D, G, A, F,
-            dl_dzhat, torch.zeros(nBatch, nineq).type_as(G),
-            torch.zeros(nBatch, nineq).type_as(G),
-            torch.zeros(nBatch, neq).type_as(G))
+        if self.solver == LCPSolvers.FB_NEWTON_BATCHED:
+            # Implicit differentiation of the semismooth system at the solution
+            dx, dlam, dnu = fbn_b.adjoint(Q, G, A, F, self.lams, self.slacks,
+                                          dl_dzhat)
+        else:
+            G_k, A_k = G, A
+            lams, slacks, dl_dx = self.lams, self.slacks, dl_dzhat
+            if self.scaling is not None:
+                # Solve the scaled system, diag(S) K diag(S) with S the
+                # scaling of (x, s, z, y), and map its solution back
+                dx_s, dz_s, dy_s = self.scaling
+                G_k, A_k = self.scaled_kkt
+                lams, slacks, dl_dx = lams / dz_s, slacks * dz_s, dl_dx * dx_s
+            # Adjoint of the KKT system, K^T [dx; ds; dz; dy] = -[dl_dx; 0; 0; 0].
+            # Q^T and the partial Schur complement were factored in forward,
+            # only the D block is refactored at the solution, the solve is
+            # then a sequence of triangular solves
+            Q_LU, S_LU, R = self.kkt_factors
+            d = lams / slacks
+            pdipm_b.factor_kkt(S_LU, R, d, self.workspace)
+            dx, _, dlam, dnu = pdipm_b.solve_kkt(
+                Q_LU, d, G_k, A_k, S_LU,
+                dl_dx, torch.zeros(nBatch, nineq).type_as(G),
+                torch.zeros(nBatch, nineq).type_as(G),
+                torch.zeros(nBatch, neq).type_as(G) if neq > 0 else None)
+            if self.scaling is not None:
+                dx, dlam = dx * dx_s, dlam * dz_s
+                dnu = dnu * dy_s if neq > 0 else None
 
         dps = dx
+        if p_e:
+            dps = dps.mean(0).squeeze(0)
         dGs = (bger(dlam, zhats) + bger(self.lams, dx))
         if G_e:
             dGs = dGs.mean(0).squeeze(0)
-        dFs = (bger(dlam, self.lams) + bger(self.lams, dlam))
-        # dFs = torch.ones(dFs.size()).double()
+        # F z enters the inequalities as h does
+        dFs = -bger(dlam, self.lams)
         if F_e:
-            assert False  # TODO
+            dFs = dFs.mean(0).squeeze(0)
         dhs = -dlam
         if h_e:
             dhs = dhs.mean(0).squeeze(0)
@@ -96,7 +179,8 @@ class LCPFunction(Function):
                 dbs = dbs.mean(0).squeeze(0)
         else:
             dAs, dbs = None, None
-        dQs = 0.5 * (bger(dx, zhats) + bger(zhats, dx))
+        # Q need not be symmetric (e.g. DelassusEngine's N)
+        dQs = bger(dx, zhats)
         if Q_e:
             dQs = dQs.mean(0).squeeze(0)
 
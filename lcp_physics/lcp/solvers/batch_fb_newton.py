@@ -0,0 +1,203 @@
+"""Semismooth Newton solver for batches of mixed LCPs, using the
+Fischer-Burmeister reformulation of the complementarity conditions.
+
+Solves the same problems as batch_pdipm.forward,
+
+    Q x + p + G^T z + A^T y = 0
+    A x = b
+    0 <= z  _|_  s = h + F z - G x >= 0
+
+as the root of R(x, z, y) = [Q x + p + G^T z + A^T y; phi(s, z); A x - b],
+where phi(a, b) = a + b - sqrt(a^2 + b^2) is zero iff 0 <= a _|_ b >= 0.
+Each iteration factors an element of the generalized Jacobian of R once and
+takes the Newton step damped by an Armijo line search on ||R||^2 / 2.
+"""
+import math
+
+import torch
+
+from lcp_physics.lcp.util import get_sizes, bdiag
+from .batch_pdipm import btrifact_hack, select_batch, INACC_ERR
+
+
+# Armijo line search sufficient decrease factor, step reduction factor and
+# maximum number of reductions
+LS_SIGMA = 1e-4
+LS_BETA = 0.5
+LS_MAX_ITER = 20
+
+# Regularization of the equality block, for redundant equality constraints
+REG_EPS = 1e-7
+
+
+def forward(Q, p, G, h, A, b, F, eps=1e-12, verbose=0, maxIter=20,
+            notImprovedLim=3, warm_start=None):
+    """Returns the solutions (x, y, z, s), in batch_pdipm.forward's order.
+
+    As in batch_pdipm.forward, problems leave the batch once their residual
+    is below eps, or once their merit did not decrease for notImprovedLim
+    iterations (e.g. at the limit of the precision). Only the remaining ones
+    are factored.
+
+    warm_start is an optional initial guess (x, s, z, y), the slacks s are
+    not used as they follow from x and z.
+    """
+    nineq, nz, neq, nBatch = get_sizes(G, A)
+
+    if warm_start is None:
+        x = torch.zeros(nBatch, nz).type_as(Q)
+        z = torch.zeros(nBatch, nineq).type_as(Q)
+        y = torch.zeros(nBatch, neq).type_as(Q) if neq > 0 else None
+    else:
+        x, _, z, y = [v.clone() if v is not None else None for v in warm_start]
+        z.clamp_(min=0)
+
+    R, s = residual(Q, p, G, h, A, b, F, x, z, y)
+    merit = 0.5 * (R * R).sum(1)
+    # Iterates of the whole batch, the active problems' are copied in
+    best = {'x': x.clone(), 'z': z.clone(), 's': s.clone(),
+            'y': y.clone() if neq > 0 else None, 'merit': merit.clone()}
+    active = torch.arange(0, nBatch).long()
+    if Q.is_cuda:
+        active = active.cuda()
+    nNotImproved = torch.zeros(nBatch).type_as(Q)
+    for i in range(maxIter):
+        resids = merit.sqrt()
+        if verbose == 1:
+            print('iter: {}, resid: {:.5e}, active: {}'.format(
+                i, resids.mean(), active.size(0)))
+        # Drop the converged and stalled problems from the batch
+        done = ((resids < eps) + (nNotImproved >= notImprovedLim)) > 0
+        if done.sum() == nBatch:
+            break
+        if done.sum() > 0:
+            keep = (1 - done).nonzero().view(-1)
+            active = active.index_select(0, keep)
+            nBatch = active.size(0)
+            x, z, s, R, merit, nNotImproved, Q, p, G, h, F = select_batch(
+                keep, x, z, s, R, merit, nNotImproved, Q, p, G, h, F)
+            if neq > 0:
+                y, A, b = select_batch(keep, y, A, b)
+
+        J = jacobian(Q, G, A, F, s, z)
+        du = -R.btrisolve(*btrifact_hack(J))
+        dx, dz, dy = unpack(du, nz, nineq, neq)
+
+        # Backtrack each problem's step until its merit decreases enough
+        t = torch.ones(nBatch).type_as(Q)
+        for k in range(LS_MAX_ITER):
+            t_ = t.unsqueeze(1)
+            x_t = x + t_ * dx
+            z_t = z + t_ * dz
+            y_t = y + t_ * dy if neq > 0 else None
+            R_t, s_t = residual(Q, p, G, h, A, b, F, x_t, z_t, y_t)
+            merit_t = 0.5 * (R_t * R_t).sum(1)
+            rejected = merit_t > (1 - 2 * LS_SIGMA * t) * merit
+            if rejected.sum() == 0 or k == LS_MAX_ITER - 1:
+                break
+            t[rejected] *= LS_BETA
+
+        # Steps without sufficient decrease are not taken
+        improved = (1 - rejected).type_as(Q)
+        step = improved.unsqueeze(1)
+        x = x + step * (x_t - x)
+        z = z + step * (z_t - z)
+        y = y + step * (y_t - y) if neq > 0 else None
+        R = R + step * (R_t - R)
+        s = s + step * (s_t - s)
+        merit = merit + improved * (merit_t - merit)
+        nNotImproved = (nNotImproved + 1) * (1 - improved)
+        best['x'].index_copy_(0, active, x)
+        best['z'].index_copy_(0, active, z)
+        best['s'].index_copy_(0, active, s)
+        best['merit'].index_copy_(0, active, merit)
+        if neq > 0:
+            best['y'].index_copy_(0, active, y)
+
+    if best['merit'].sqrt().max() > 1. and verbose >= 0:
+        print(INACC_ERR)
+        print(best['merit'].sqrt().max())
+    return best['x'], best['y'], best['z'], best['s']
+
+
+def residual(Q, p, G, h, A, b, F, x, z, y):
+    """Returns R(x, z, y) and the slacks s."""
+    neq = A.size(1) if A.ndimension() > 0 else 0
+    s = h - bmv(G, x)
+    if F is not None:
+        s += bmv(F, z)
+    rx = bmv(Q, x) + p + bmv(G.transpose(1, 2), z)
+    rz = s + z - (s * s + z * z).sqrt()
+    if neq > 0:
+        rx += bmv(A.transpose(1, 2), y)
+        ry = bmv(A, x) - b
+        return torch.cat([rx, rz, ry], 1), s
+    return torch.cat([rx, rz], 1), s
+
+
+def jacobian(Q, G, A, F, s, z):
+    """Returns an element of the generalized Jacobian of R at (s, z),
+
+    [Q,      G^T,          A^T    ]
+    [-Da G,  Da F + Db,    0      ]
+    [A,      0,            -eps I ]
+
+    with Da, Db the derivatives of phi w.r.t. s and z.
+    """
+    nineq, nz, neq, nBatch = get_sizes(G, A)
+    da, db = fb_derivatives(s, z)
+    n = nz + nineq + neq
+    J = torch.zeros(nBatch, n, n).type_as(Q)
+    J[:, :nz, :nz] = Q
+    J[:, :nz, nz:nz + nineq] = G.transpose(1, 2)
+    J[:, nz:nz + nineq, :nz] = -da.unsqueeze(2) * G
+    J[:, nz:nz + nineq, nz:nz + nineq] = bdiag(db)
+    if F is not None:
+        J[:, nz:nz + nineq, nz:nz + nineq] += da.unsqueeze(2) * F
+    if neq > 0:
+        J[:, :nz, nz + nineq:] = A.transpose(1, 2)
+        J[:, nz + nineq:, :nz] = A
+        J[:, nz + nineq:, nz + nineq:] = \
+            -REG_EPS * torch.eye(neq).type_as(Q).repeat(nBatch, 1, 1)
+    return J
+
+
+def fb_derivatives(a, b):
+    """Derivatives of phi(a, b) = a + b - sqrt(a^2 + b^2). At the kink
+    a = b = 0 the generalized gradient's point (1 - 1/sqrt(2)) (1, 1) is
+    chosen."""
+    r = (a * a + b * b).sqrt()
+    kink = r == 0
+    r[kink] = 1
+    da = 1 - a / r
+    db = 1 - b / r
+    da[kink] = 1 - 1 / math.sqrt(2)
+    db[kink] = 1 - 1 / math.sqrt(2)
+    return da, db
+
+
+def adjoint(Q, G, A, F, z, s, dl_dx):
+    """Implicit differentiation at the solution: solves J^T u = -[dl_dx; 0; 0].
+
+    Returns (dx, dlam, dnu) scaled as the solution of batch_pdipm's KKT
+    system in backward, so the same parameter gradients apply.
+    """
+    nineq, nz, neq, nBatch = get_sizes(G, A)
+    J = jacobian(Q, G, A, F, s, z)
+    r = torch.cat([-dl_dx, torch.zeros(nBatch, nineq + neq).type_as(Q)], 1)
+    u = r.btrisolve(*btrifact_hack(J.transpose(1, 2).contiguous()))
+    dx, dz, dy = unpack(u, nz, nineq, neq)
+    # The multipliers' adjoint enters through s, i.e. scaled by Da
+    da, _ = fb_derivatives(s, z)
+    return dx, -da * dz, dy
+
+
+def unpack(v, nz, nineq, neq):
+    x = v[:, :nz]
+    z = v[:, nz:nz + nineq]
+    y = v[:, nz + nineq:] if neq > 0 else None
+    return x, z, y
+
+
+def bmv(X, v):
+    return torch.bmm(X, v.unsqueeze(2)).squeeze(2)
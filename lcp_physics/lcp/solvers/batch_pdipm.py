@@ -1,3 +1,5 @@
+import copy
+
 import torch
 from enum import Enum
 # from block import block
@@ -6,7 +8,7 @@ import numpy as np
 from scipy.linalg import lu_factor, lu_solve
 from scipy.sparse import csc_matrix, eye, hstack, vstack, diags, block_diag, bmat
 from scipy.sparse.linalg import splu, spsolve
-from lcp_physics.lcp.util import get_sizes, bdiag
+from lcp_physics.lcp.util import get_sizes
 
 
 shown_btrifact_warning = False
@@ -54,37 +56,122 @@ class KKTSolvers(Enum):
     SP_IR_UNOPT = 5
     IR_INVERSE = 6
     SP_IR_INVERSE = 7
+    SP_LU_BATCHED = 8
+
+
+# Warm started slacks and multipliers are moved at least this far from the
+# boundary, where the predictor-corrector steps would be blocked
+WARM_START_MIN = 1e-3
+
+# Maximum number of buffers kept by a KKTWorkspace
+KKT_WORKSPACE_SIZE = 64
+# Maximum number of sparse KKT orderings kept by a KKTWorkspace
+SPARSE_KKT_ORDERINGS_SIZE = 64
+
+
+class KKTWorkspace:
+    """Buffers for forward and the KKT solves, reused across calls.
+
+    Identities, zero residuals, diagonal masks and scratch matrices are
+    allocated on first use for a given size and tensor type, and reused by
+    later calls with the same sizes, e.g. the steps of a world whose contacts
+    persist. Identities and zeros are shared and must not be modified.
+    The fill reducing orderings of sparse KKT matrices are kept the same way,
+    by sparsity pattern.
+    """
+    def __init__(self, size=KKT_WORKSPACE_SIZE,
+                 orderings_size=SPARSE_KKT_ORDERINGS_SIZE):
+        self.size = size
+        self.buffers = {}
+        self.orderings_size = orderings_size
+        self.orderings = {}
+
+    def _get(self, name, like, size, alloc):
+        key = (name, like.type(), size)
+        buf = self.buffers.get(key)
+        if buf is None:
+            if len(self.buffers) >= self.size:
+                self.buffers.clear()
+            buf = alloc()
+            self.buffers[key] = buf
+        return buf
+
+    def eye(self, nBatch, n, like):
+        return self._get('eye', like, (nBatch, n),
+                         lambda: torch.eye(n).type_as(like).repeat(nBatch, 1, 1))
+
+    def zeros(self, like, *size):
+        return self._get('zeros', like, size, lambda: torch.zeros(*size).type_as(like))
+
+    def diag_mask(self, nBatch, n, like):
+        return self._get('diag_mask', like, (nBatch, n),
+                         lambda: self.eye(nBatch, n, like).byte())
+
+    def buffer(self, name, like, *size):
+        """Scratch buffer, zeroed when allocated and overwritten by the next
+        call with the same name and size."""
+        return self._get(name, like, size, lambda: torch.zeros(*size).type_as(like))
+
+    def diag(self, d, reg_eps=0):
+        """Batched diagonal matrix of d + reg_eps, in a scratch buffer."""
+        nBatch, n = d.size()
+        D = self.buffer('diag', d, nBatch, n, n)
+        D[self.diag_mask(nBatch, n, d)] = (d + reg_eps).view(-1)
+        return D
+
+    def sparse_kkt_ordering(self, K):
+        """Fill reducing column ordering of the CSC matrix K, reused while its
+        sparsity pattern (e.g. the contacts) persists."""
+        key = (K.shape, K.indptr.tobytes(), K.indices.tobytes())
+        perm = self.orderings.get(key)
+        if perm is None:
+            if len(self.orderings) >= self.orderings_size:
+                self.orderings.clear()
+            # XXX SuperLU does not expose its symbolic analysis, the ordering
+            # is taken from a full factorization
+            perm = splu(K, permc_spec='COLAMD').perm_c
+            self.orderings[key] = perm
+        return perm
 
 
 def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             eps=1e-12, verbose=0, notImprovedLim=3,
-            maxIter=20, solver=KKTSolvers.LU_PARTIAL):
+            maxIter=20, solver=KKTSolvers.LU_PARTIAL, warm_start=None,
+            workspace=None):
     """
     Q_LU, S_LU, R = pre_factor_kkt(Q, G, A)
+
+    warm_start is an optional initial guess (x, s, z, y), e.g. the solution
+    of a similar problem, replacing the initial KKT solve.
+
+    workspace is an optional KKTWorkspace whose buffers are reused across
+    calls.
     """
     nineq, nz, neq, nBatch = get_sizes(G, A)
+    cold = warm_start is None
+    ws = workspace if workspace is not None else KKTWorkspace()
 
     # Find initial values
     if solver == KKTSolvers.LU_FULL:
-        D = torch.eye(nineq).repeat(nBatch, 1, 1).type_as(Q)
         reg_eps = 1e-7
-        Q_tilde = Q + reg_eps * torch.eye(nz).type_as(Q).repeat(nBatch, 1, 1)
-        D_tilde = D + reg_eps * torch.eye(nineq).type_as(Q).repeat(nBatch, 1, 1)
+        Q_tilde = Q + reg_eps * ws.eye(nBatch, nz, Q)
+        D_tilde = (1 + reg_eps) * ws.eye(nBatch, nineq, Q)
 
         if neq > 0:
-            A_ = torch.cat([torch.cat([G, torch.eye(nineq).type_as(Q_tilde).repeat(nBatch, 1, 1)], 2),
-                            torch.cat([A, torch.zeros(nBatch, neq, nineq).type_as(Q_tilde)], 2)], 1)
+            A_ = torch.cat([torch.cat([G, ws.eye(nBatch, nineq, Q)], 2),
+                            torch.cat([A, ws.zeros(Q, nBatch, neq, nineq)], 2)], 1)
         else:
-            A_ = torch.cat([G, torch.eye(nineq).type_as(Q_tilde).unsqueeze(0)], 2)
+            A_ = torch.cat([G, ws.eye(nBatch, nineq, Q)], 2)
 
-        C_tilde = reg_eps * torch.eye(neq + nineq).type_as(Q_tilde).repeat(nBatch, 1, 1)
+        C_tilde = reg_eps * ws.eye(nBatch, neq + nineq, Q)
         if F is not None:
             C_tilde[:, :nineq, :nineq] += F
         ns = [nineq, nz, neq, nBatch]
-        x, s, z, y = factor_solve_kkt(
-            Q_tilde, D_tilde, A_, C_tilde, p,
-            torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if b is not None else None, ns)
+        if cold:
+            x, s, z, y = factor_solve_kkt(
+                Q_tilde, D_tilde, A_, C_tilde, p,
+                ws.zeros(Q, nBatch, nineq),
+                -h, -b if b is not None else None, ns, ws)
     elif solver == KKTSolvers.SP_LU_FULL:
         # TODO Have it work for batches
         D = eye(nineq, format='csc')
@@ -104,37 +191,42 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             C_tilde[:nineq, :nineq] += F.squeeze(0).numpy()
         C_tilde = csc_matrix(C_tilde)
         ns = [nineq, nz, neq, nBatch]
-        x, s, z, y = sparse_factor_solve_kkt(
-            Q_tilde, D_tilde, A_, C_tilde, p,
-            torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if b is not None else None, ns)
+        if cold:
+            x, s, z, y = sparse_factor_solve_kkt(
+                Q_tilde, D_tilde, A_, C_tilde, p,
+                torch.zeros(nBatch, nineq).type_as(Q),
+                -h, -b if b is not None else None, ns)
     elif solver == KKTSolvers.LU_PARTIAL:
         # XXX
         reg_eps = 1e-7
         d = torch.ones(nBatch, nineq).type_as(Q) # * (1 + reg_eps)
-        factor_kkt(S_LU, R, d)
-        x, s, z, y = solve_kkt(
-            Q_LU, d, G, A, S_LU,
-            p, torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if neq > 0 else None)
+        factor_kkt(S_LU, R, d, ws)
+        if cold:
+            x, s, z, y = solve_kkt(
+                Q_LU, d, G, A, S_LU,
+                p, ws.zeros(Q, nBatch, nineq),
+                -h, -b if neq > 0 else None)
     elif solver == KKTSolvers.IR_UNOPT:
         D = torch.eye(nineq).repeat(nBatch, 1, 1).type_as(Q)
-        x, s, z, y = solve_kkt_ir(
-            Q, D, G, A, F, p,
-            torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if b is not None else None)
+        if cold:
+            x, s, z, y = solve_kkt_ir(
+                Q, D, G, A, F, p,
+                torch.zeros(nBatch, nineq).type_as(Q),
+                -h, -b if b is not None else None)
     elif solver == KKTSolvers.SP_IR_UNOPT:
         D = torch.eye(nineq).repeat(nBatch, 1, 1).type_as(Q)
-        x, s, z, y = sparse_solve_kkt_ir(
-            Q, D, G, A, F, p,
-            torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if b is not None else None)
+        if cold:
+            x, s, z, y = sparse_solve_kkt_ir(
+                Q, D, G, A, F, p,
+                torch.zeros(nBatch, nineq).type_as(Q),
+                -h, -b if b is not None else None)
     elif solver == KKTSolvers.IR_INVERSE:
         D = torch.eye(nineq).repeat(nBatch, 1, 1).type_as(Q)
-        x, s, z, y = solve_kkt_ir_inverse(
-            Q, D, G, A, F, p,
-            torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if b is not None else None)
+        if cold:
+            x, s, z, y = solve_kkt_ir_inverse(
+                Q, D, G, A, F, p,
+                torch.zeros(nBatch, nineq).type_as(Q),
+                -h, -b if b is not None else None)
     elif solver == KKTSolvers.SP_IR_INVERSE:
         reg_eps = 1e-7
         D = eye(nineq)
@@ -157,13 +249,27 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
         F_tilde = C_tilde[:nineq, :nineq]
         # C_tilde = csc_matrix(C_tilde.squeeze(0).numpy())
 
-        x, s, z, y = sparse_solve_kkt_ir_inverse(H_, A_, C_tilde,
-            Q_tilde, D_tilde, G, A, F_tilde, p,
-            torch.zeros(nBatch, nineq).type_as(Q),
-            -h, -b if b is not None else None)
+        if cold:
+            x, s, z, y = sparse_solve_kkt_ir_inverse(H_, A_, C_tilde,
+                Q_tilde, D_tilde, G, A, F_tilde, p,
+                torch.zeros(nBatch, nineq).type_as(Q),
+                -h, -b if b is not None else None)
+    elif solver == KKTSolvers.SP_LU_BATCHED:
+        reg_eps = 1e-7
+        kkt = SparseKKT(Q, G, A, F, reg_eps, ws)
+        if cold:
+            kkt.factor(torch.ones(nBatch, nineq).type_as(Q))
+            x, s, z, y = kkt.solve(
+                p, ws.zeros(Q, nBatch, nineq),
+                -h, -b if neq > 0 else None)
     else:
         assert False
 
+    if not cold:
+        x, s, z, y = [v.clone() if v is not None else None for v in warm_start]
+        s.clamp_(min=WARM_START_MIN)
+        z.clamp_(min=WARM_START_MIN)
+
     M = torch.min(s, 1)[0].repeat(1, nineq)
     I = M <= 0
     s[I] -= M[I] - 1
@@ -173,7 +279,14 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
     z[I] -= M[I] - 1
 
     best = {'resids': None, 'x': None, 'z': None, 's': None, 'y': None}
-    nNotImproved = 0
+    # Batch indices of the problems still being solved, the others have
+    # converged, or stalled for notImprovedLim iterations (e.g. at the limit
+    # of the precision), and are frozen at their best iterate
+    active = torch.arange(0, nBatch).long()
+    if Q.is_cuda:
+        active = active.cuda()
+    # iterations since each active problem's best residual improved
+    nNotImproved = torch.zeros(nBatch).type_as(Q)
 
     for i in range(maxIter):
         # affine scaling direction
@@ -197,9 +310,12 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
         d = z / s
         if solver == KKTSolvers.LU_PARTIAL:
             try:
-                factor_kkt(S_LU, R, d)
+                factor_kkt(S_LU, R, d, ws)
             except:
                 return best['x'], best['y'], best['z'], best['s']
+        elif solver == KKTSolvers.SP_LU_BATCHED:
+            # Factored once per iteration, shared by both directions
+            kkt.factor(d)
 
         if verbose == 1:
             print('iter: {}, pri_resid: {:.5e}, dual_resid: {:.5e}, mu: {:.5e}'.format(
@@ -210,33 +326,51 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             best['z'] = z.clone()
             best['s'] = s.clone()
             best['y'] = y.clone() if y is not None else None
-            nNotImproved = 0
         else:
-            I = resids < best['resids']
+            I = resids < best['resids'].index_select(0, active)
+            nNotImproved = (nNotImproved + 1) * (1 - I.type_as(Q))
             if I.sum() > 0:
-                nNotImproved = 0
-            else:
-                nNotImproved += 1
-            I_nz = I.repeat(nz, 1).t()
-            I_nineq = I.repeat(nineq, 1).t()
-            best['resids'][I] = resids[I]
-            best['x'][I_nz] = x[I_nz]
-            best['z'][I_nineq] = z[I_nineq]
-            best['s'][I_nineq] = s[I_nineq]
-            if neq > 0:
-                I_neq = I.repeat(neq, 1).t()
-                best['y'][I_neq] = y[I_neq]
-        if nNotImproved == notImprovedLim or best['resids'].max() < eps or mu.min() > 1e100:
+                I = I.nonzero().view(-1)
+                improved = active.index_select(0, I)
+                best['resids'].index_copy_(0, improved, resids.index_select(0, I))
+                best['x'].index_copy_(0, improved, x.index_select(0, I))
+                best['z'].index_copy_(0, improved, z.index_select(0, I))
+                best['s'].index_copy_(0, improved, s.index_select(0, I))
+                if neq > 0:
+                    best['y'].index_copy_(0, improved, y.index_select(0, I))
+        done = ((best['resids'].index_select(0, active) < eps) +
+                (nNotImproved >= notImprovedLim)) > 0
+        if done.sum() == nBatch or mu.min() > 1e100:
             if best['resids'].max() > 1. and verbose >= 0:
                 print(INACC_ERR)
                 print(best['resids'].max())
             return best['x'], best['y'], best['z'], best['s']
 
+        # Drop the converged and stalled problems from the batch, only the
+        # others are factored and updated from now on
+        if done.sum() > 0:
+            keep = (1 - done).nonzero().view(-1)
+            active = active.index_select(0, keep)
+            nBatch = active.size(0)
+            x, s, z, d, mu, rx, rz, Q, p, G, h, F, nNotImproved = select_batch(
+                keep, x, s, z, d, mu, rx, rz, Q, p, G, h, F, nNotImproved)
+            rs = z
+            if neq > 0:
+                y, ry, A, b = select_batch(keep, y, ry, A, b)
+            if solver == KKTSolvers.LU_FULL:
+                Q_tilde, A_, C_tilde = select_batch(keep, Q_tilde, A_, C_tilde)
+                ns = [nineq, nz, neq, nBatch]
+            elif solver == KKTSolvers.LU_PARTIAL:
+                Q_LU = select_batch(keep, *Q_LU)
+                S_LU = select_batch(keep, *S_LU)
+                R = R.index_select(0, keep)
+            elif solver == KKTSolvers.SP_LU_BATCHED:
+                kkt = kkt.subset(keep)
+
         if solver == KKTSolvers.LU_FULL:
-            D = bdiag(d)
-            D_tilde = D + reg_eps * torch.eye(nineq).type_as(Q).repeat(nBatch, 1, 1)
+            D_tilde = ws.diag(d, reg_eps)
             dx_aff, ds_aff, dz_aff, dy_aff = factor_solve_kkt(
-                Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns)
+                Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns, ws)
         elif solver == KKTSolvers.SP_LU_FULL:
             D = diags(d.squeeze(0).numpy())
             D_tilde = D + reg_eps * eye(nineq, format='csc')
@@ -247,15 +381,15 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             dx_aff, ds_aff, dz_aff, dy_aff = solve_kkt(
                 Q_LU, d, G, A, S_LU, rx, rs, rz, ry)
         elif solver == KKTSolvers.IR_UNOPT:
-            D = bdiag(d)
+            D = ws.diag(d)
             dx_aff, ds_aff, dz_aff, dy_aff = solve_kkt_ir(
                 Q, D, G, A, F, rx, rs, rz, ry)
         elif solver == KKTSolvers.SP_IR_UNOPT:
-            D = bdiag(d)
+            D = ws.diag(d)
             dx_aff, ds_aff, dz_aff, dy_aff = sparse_solve_kkt_ir(
                 Q, D, G, A, F, rx, rs, rz, ry)
         elif solver == KKTSolvers.IR_INVERSE:
-            D = bdiag(d)
+            D = ws.diag(d)
             dx_aff, ds_aff, dz_aff, dy_aff = solve_kkt_ir_inverse(
                 Q, D, G, A, F, rx, rs, rz, ry)
         elif solver == KKTSolvers.SP_IR_INVERSE:
@@ -265,6 +399,8 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             H_ = block_diag([Q_tilde, D_tilde], format='csc')
             dx_aff, ds_aff, dz_aff, dy_aff = sparse_solve_kkt_ir_inverse(H_, A_, C_tilde,
                 Q_tilde, D_tilde, G, A, F_tilde, rx, rs, rz, ry)
+        elif solver == KKTSolvers.SP_LU_BATCHED:
+            dx_aff, ds_aff, dz_aff, dy_aff = kkt.solve(rx, rs, rz, ry)
         else:
             assert False
 
@@ -279,16 +415,15 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
         t4 = torch.sum(s * z, 1).squeeze()
         sig = (t3 / t4)**3
 
-        rx = torch.zeros(nBatch, nz).type_as(Q)
+        rx = ws.zeros(Q, nBatch, nz)
         rs = ((-mu * sig).repeat(nineq, 1).t() + ds_aff * dz_aff) / s
-        rz = torch.zeros(nBatch, nineq).type_as(Q)
-        ry = torch.zeros(nBatch, neq).type_as(Q)
+        rz = ws.zeros(Q, nBatch, nineq)
+        ry = ws.zeros(Q, nBatch, neq)
 
         if solver == KKTSolvers.LU_FULL:
-            D = bdiag(d)
-            D_tilde = D + reg_eps * torch.eye(nineq).type_as(Q).repeat(nBatch, 1, 1)
+            # D_tilde is the affine step's
             dx_cor, ds_cor, dz_cor, dy_cor = factor_solve_kkt(
-                Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns)
+                Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns, ws)
         elif solver == KKTSolvers.SP_LU_FULL:
             D = diags(d.squeeze(0).numpy())
             D_tilde = D + reg_eps * eye(nineq, format='csc')
@@ -299,15 +434,15 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             dx_cor, ds_cor, dz_cor, dy_cor = solve_kkt(
                 Q_LU, d, G, A, S_LU, rx, rs, rz, ry)
         elif solver == KKTSolvers.IR_UNOPT:
-            D = bdiag(d)
+            D = ws.diag(d)
             dx_cor, ds_cor, dz_cor, dy_cor = solve_kkt_ir(
                 Q, D, G, A, F, rx, rs, rz, ry)
         elif solver == KKTSolvers.SP_IR_UNOPT:
-            D = bdiag(d)
+            D = ws.diag(d)
             dx_cor, ds_cor, dz_cor, dy_cor = sparse_solve_kkt_ir(
                 Q, D, G, A, F, rx, rs, rz, ry)
         elif solver == KKTSolvers.IR_INVERSE:
-            D = bdiag(d)
+            D = ws.diag(d)
             dx_cor, ds_cor, dz_cor, dy_cor = solve_kkt_ir_inverse(
                 Q, D, G, A, F, rx, rs, rz, ry)
         elif solver == KKTSolvers.SP_IR_INVERSE:
@@ -317,6 +452,8 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
             H_ = block_diag([Q_tilde, D_tilde], format='csc')
             dx_cor, ds_cor, dz_cor, dy_cor = sparse_solve_kkt_ir_inverse(H_, A_, C_tilde,
                 Q_tilde, D_tilde, G, A, F_tilde, rx, rs, rz, ry)
+        elif solver == KKTSolvers.SP_LU_BATCHED:
+            dx_cor, ds_cor, dz_cor, dy_cor = kkt.solve(rx, rs, rz, ry)
         else:
             assert False
 
@@ -342,6 +479,11 @@ def forward(Q, p, G, h, A, b, F, Q_LU, S_LU, R,
     return best['x'], best['y'], best['z'], best['s']
 
 
+def select_batch(idxs, *tensors):
+    """Selects the batch elements at idxs of each (optional) tensor."""
+    return [t.index_select(0, idxs) if t is not None else None for t in tensors]
+
+
 def get_step(v, dv):
     a = -v / dv
     a[dv > 0] = max(1.0, a.max())
@@ -677,10 +819,14 @@ def sparse_solve_kkt_inverse(H_, A_, C_tilde, rx, rs, rz, ry, ns):
     return dx, ds, dz, dy
 
 
-def factor_solve_kkt(Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns):
+def factor_solve_kkt(Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns, workspace=None):
     nineq, nz, neq, nBatch = ns
 
-    H_ = torch.zeros(nBatch, nz + nineq, nz + nineq).type_as(Q_tilde)
+    if workspace is not None:
+        # Only the diagonal blocks are written, the others stay 0
+        H_ = workspace.buffer('H', Q_tilde, nBatch, nz + nineq, nz + nineq)
+    else:
+        H_ = torch.zeros(nBatch, nz + nineq, nz + nineq).type_as(Q_tilde)
     H_[:, :nz, :nz] = Q_tilde
     H_[:, -nineq:, -nineq:] = D_tilde
     if neq > 0:
@@ -751,6 +897,95 @@ def sparse_factor_solve_kkt(Q_tilde, D_tilde, A_, C_tilde, rx, rs, rz, ry, ns):
     return dx, ds, dz, dy
 
 
+class SparseKKT:
+    """Sparse LU solves of a batch of KKT systems
+
+    [Q_tilde,       0, G^T,            A^T     ] [dx]     [rx]
+    [0,             D, I,              0       ] [ds] = - [rs]
+    [G,             I, -(F + eps I),   0       ] [dz]     [rz]
+    [A,             0, 0,              -eps I  ] [dy]     [ry]
+
+    whose sparsity pattern is fixed during a solve, only D changes between
+    iterations. Each matrix is assembled once in CSC format with its columns
+    permuted by a fill reducing ordering cached in the workspace, so that
+    each iteration only writes D's entries before factoring.
+
+    XXX scipy's splu cannot reuse a symbolic factorization, so each
+    iteration still reruns SuperLU's analysis (elimination tree, supernodes)
+    along with the numeric factorization. Only the column ordering, the
+    costly part of the analysis, is saved by passing the permuted matrix
+    with permc_spec='NATURAL'.
+    """
+    def __init__(self, Q, G, A, F, reg_eps, workspace):
+        self.nineq, self.nz, self.neq, self.nBatch = get_sizes(G, A)
+        self.reg_eps = reg_eps
+        nineq, nz, neq = self.nineq, self.nz, self.neq
+        self.Ks, self.perms, self.d_idxs = [], [], []
+        self.LUs = [None] * self.nBatch
+        for i in range(self.nBatch):
+            F_i = F[i].cpu().numpy() if F is not None else np.zeros((nineq, nineq))
+            blocks = [[csc_matrix(Q[i].cpu().numpy()) + reg_eps * eye(nz), None,
+                       csc_matrix(G[i].cpu().numpy()).transpose()],
+                      # D is set by factor, eye only reserves its entries
+                      [None, eye(nineq), eye(nineq)],
+                      [csc_matrix(G[i].cpu().numpy()), eye(nineq),
+                       -csc_matrix(F_i) - reg_eps * eye(nineq)]]
+            if neq > 0:
+                A_i = csc_matrix(A[i].cpu().numpy())
+                blocks[0].append(A_i.transpose())
+                blocks[1].append(None)
+                blocks[2].append(None)
+                blocks.append([A_i, None, None, -reg_eps * eye(neq)])
+            K = bmat(blocks, format='csc')
+            K.sort_indices()
+            perm = workspace.sparse_kkt_ordering(K)
+            K = K[:, perm].tocsc()
+            K.sort_indices()
+            # positions of D's diagonal entries in K.data
+            cols = perm[np.repeat(np.arange(K.shape[1]), np.diff(K.indptr))]
+            rows = K.indices
+            d_idxs = np.nonzero((rows == cols) & (rows >= nz) & (rows < nz + nineq))[0]
+            self.Ks.append(K)
+            self.perms.append(perm)
+            self.d_idxs.append(d_idxs[np.argsort(rows[d_idxs])])
+
+    def subset(self, idxs):
+        """Returns the solver of the batch elements at idxs, sharing their
+        matrices and factorizations."""
+        idxs = idxs.tolist()
+        kkt = copy.copy(self)
+        kkt.nBatch = len(idxs)
+        kkt.Ks = [self.Ks[i] for i in idxs]
+        kkt.perms = [self.perms[i] for i in idxs]
+        kkt.d_idxs = [self.d_idxs[i] for i in idxs]
+        kkt.LUs = [self.LUs[i] for i in idxs]
+        return kkt
+
+    def factor(self, d):
+        d = d.cpu().numpy()
+        for i, K in enumerate(self.Ks):
+            K.data[self.d_idxs[i]] = d[i] + self.reg_eps
+            self.LUs[i] = splu(K, permc_spec='NATURAL')
+
+    def solve(self, rx, rs, rz, ry):
+        nineq, nz, neq = self.nineq, self.nz, self.neq
+        if neq > 0:
+            r = -torch.cat([rx, rs, rz, ry], 1)
+        else:
+            r = -torch.cat([rx, rs, rz], 1)
+        r = r.cpu().numpy()
+        sol = np.empty_like(r)
+        for i, LU in enumerate(self.LUs):
+            sol[i, self.perms[i]] = LU.solve(r[i])
+        sol = torch.from_numpy(sol).type_as(rx)
+
+        dx = sol[:, :nz]
+        ds = sol[:, nz:nz + nineq]
+        dz = sol[:, nz + nineq:nz + 2 * nineq]
+        dy = sol[:, nz + 2 * nineq:] if neq > 0 else None
+        return dx, ds, dz, dy
+
+
 def solve_kkt(Q_LU, d, G, A, S_LU, rx, rs, rz, ry):
     """ Solve KKT equations for the affine step"""
 
@@ -804,7 +1039,10 @@ a non-zero diagonal.
     # See the 'Block LU factorization' part of our website
     # for more details.
 
-    G_invQ_GT = torch.bmm(G, G.transpose(1, 2).btrisolve(*Q_LU)) + F
+    G_invQ_GT = torch.bmm(G, G.transpose(1, 2).btrisolve(*Q_LU))
+    if F is not None:
+        # The F block adds to the inequality rows' Schur complement
+        G_invQ_GT += F
     R = G_invQ_GT.clone()
     S_LU_pivots = torch.IntTensor(range(1, 1 + neq + nineq)).unsqueeze(0) \
         .repeat(nBatch, 1).type_as(Q).int()
@@ -837,21 +1075,15 @@ a non-zero diagonal.
     return Q_LU, S_LU, R
 
 
-factor_kkt_eye = None
-
-
-def factor_kkt(S_LU, R, d):
+def factor_kkt(S_LU, R, d, workspace=None):
     """ Factor the U22 block that we can only do after we know D. """
     nBatch, nineq = d.size()
     neq = S_LU[1].size(1) - nineq
-    # TODO There's probably a better way to add a batched diagonal.
-    global factor_kkt_eye
-    if factor_kkt_eye is None or factor_kkt_eye.size() != d.size():
-        # print('Updating batchedEye size.')
-        factor_kkt_eye = torch.eye(nineq).repeat(
-            nBatch, 1, 1).type_as(R).byte()
-    T = R.clone()
-    T[factor_kkt_eye] += (1. / d).squeeze()
+    if workspace is None:
+        workspace = KKTWorkspace()
+    T = workspace.buffer('T', R, nBatch, nineq, nineq)
+    T.copy_(R)
+    T[workspace.diag_mask(nBatch, nineq, R)] += (1. / d).view(-1)
 
     T_LU = btrifact_hack(T)
 
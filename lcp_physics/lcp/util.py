@@ -57,3 +57,73 @@ def extract_nBatch(Q, p, G, h, A, b):
         if param.ndimension() == dim:
             return param.size(0)
     return 1
+
+
+def ruiz_scaling(Q, G, A, F, iters=10):
+    """Ruiz equilibration of the batched KKT matrices
+
+    [Q, G^T, A^T]
+    [G, F,   0  ]
+    [A, 0,   0  ]
+
+    Returns the diagonal scalings (dx, dz, dy) of the variables, inequality
+    and equality rows, so that the rows of the scaled matrices have unit
+    infinity norm (approximately, after iters iterations). dy is None
+    without equality constraints.
+    """
+    nineq, nz, neq, nBatch = get_sizes(G, A)
+    dx = torch.ones(nBatch, nz).type_as(Q)
+    dz = torch.ones(nBatch, nineq).type_as(Q)
+    dy = torch.ones(nBatch, neq).type_as(Q) if neq > 0 else None
+    for _ in range(iters):
+        Qs, Gs, As, Fs = scale_matrices((dx, dz, dy), Q, G, A, F)
+        x_norm = torch.max(Qs.abs().max(2)[0], Gs.abs().max(1)[0])
+        z_norm = Gs.abs().max(2)[0]
+        if Fs is not None:
+            z_norm = torch.max(z_norm, Fs.abs().max(2)[0])
+        if neq > 0:
+            x_norm = torch.max(x_norm, As.abs().max(1)[0])
+            y_norm = As.abs().max(2)[0]
+        for d, norm in zip((dx, dz, dy), (x_norm, z_norm, y_norm if neq > 0 else None)):
+            if d is not None:
+                # empty rows are left as they are
+                norm[norm == 0] = 1
+                d /= norm.sqrt()
+    return dx, dz, dy
+
+
+def scale_matrices(scaling, Q, G, A, F):
+    """Returns the scaled Q, G, A and F, diag(d) X diag(d')."""
+    dx, dz, dy = scaling
+    Q = dx.unsqueeze(2) * Q * dx.unsqueeze(1)
+    G = dz.unsqueeze(2) * G * dx.unsqueeze(1)
+    if dy is not None:
+        A = dy.unsqueeze(2) * A * dx.unsqueeze(1)
+    if F is not None:
+        F = dz.unsqueeze(2) * F * dz.unsqueeze(1)
+    return Q, G, A, F
+
+
+def scale_lcp(scaling, Q, p, G, h, A, b, F):
+    """Scales a mixed LCP: its variables x by dx, its inequality rows by dz
+    and equality rows by dy. The slacks are scaled as the rows and the
+    multipliers inversely, so complementarity is preserved."""
+    dx, dz, dy = scaling
+    Q, G, A, F = scale_matrices(scaling, Q, G, A, F)
+    p = dx * p
+    h = dz * h
+    if dy is not None:
+        b = dy * b
+    return Q, p, G, h, A, b, F
+
+
+def scale_solution(scaling, x, y, z, s):
+    """Maps a solution of the original problem to the scaled problem's."""
+    dx, dz, dy = scaling
+    return x / dx, y / dy if y is not None else None, z / dz, s * dz
+
+
+def unscale_solution(scaling, x, y, z, s):
+    """Maps a solution of the scaled problem to the original problem's."""
+    dx, dz, dy = scaling
+    return x * dx, y * dy if y is not None else None, z * dz, s / dz
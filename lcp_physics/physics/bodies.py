@@ -7,7 +7,7 @@ import pygame
 import torch
 from torch.autograd import Variable
 
-from .utils import Indices, Params, polar_to_cart, cart_to_polar
+from .utils import Indices, Params, BodyTransforms, rotation_matrix
 
 X = Indices.X
 Y = Indices.Y
@@ -17,18 +17,29 @@ Tensor = Params.TENSOR_TYPE
 
 
 class Body(object):
+    # Whether the ODE geom's rotation follows the body's (circles' need not)
+    geom_rotates = True
+
     def __init__(self, pos, mass=Variable(Tensor([1])), restitution=Params.DEFAULT_RESTITUTION,
-                 fric_coeff=Params.DEFAULT_FRIC_COEFF, eps=Params.DEFAULT_EPSILON, col=(255, 0, 0), thickness=1):
+                 fric_coeff=Params.DEFAULT_FRIC_COEFF, eps=Params.DEFAULT_EPSILON, col=(255, 0, 0), thickness=1,
+                 static=False):
         self.eps = Variable(Tensor([eps]))
+        # Static bodies have infinite mass: they are not solved for and move
+        # only with their prescribed velocity v (zero unless set by the user)
+        self.static = static
+        # Once added to a World, p and v are views into the world's state
+        # vectors, refreshed lazily whenever the world replaces them
+        self.world = None
+        self.idx = None
+        self._p_src = self._v_src = None
+
         # rotation & position vector
-        self.p = torch.cat([Variable(Tensor(1).zero_()), Variable(Tensor(pos))])
-        self.rot = self.p[0:1]
-        self.pos = self.p[1:]
+        self._set_own_p(torch.cat([Variable(Tensor(1).zero_()), Variable(Tensor(pos))]))
 
         # linear and angular velocity vector
         lin_vel = Variable(Tensor([0, 0]))
         ang_vel = Variable(Tensor([0]))
-        self.v = torch.cat([ang_vel, lin_vel])
+        self._v = torch.cat([ang_vel, lin_vel])
 
         self.mass = mass
         self.ang_inertia = self._get_ang_inertia(self.mass)
@@ -46,6 +57,9 @@ class Body(object):
         self.thickness = thickness
 
         self._create_geom()
+        # Set when the geom of a body outside of a world lags behind p. Once
+        # attached, the world tracks its dirty geoms (see World.sync_geoms)
+        self.geom_dirty = False
 
     def _create_geom(self):
         raise NotImplementedError
@@ -53,25 +67,109 @@ class Body(object):
     def _get_ang_inertia(self, mass):
         raise NotImplementedError
 
-    def move(self, dt, update_geom_rotation=True):
-        new_p = self.p + self.v * dt
-        self.set_p(new_p, update_geom_rotation)
+    def attach(self, world, idx):
+        """Makes the body's state a view into the world's p and v vectors."""
+        self.world = world
+        self.idx = idx
+        self._p_src = self._v_src = None
+
+    @property
+    def p(self):
+        self._refresh_p()
+        return self._p
+
+    @property
+    def rot(self):
+        self._refresh_p()
+        return self._rot
+
+    @property
+    def pos(self):
+        self._refresh_p()
+        return self._pos
+
+    @property
+    def rotation(self):
+        """Rotation matrix, from the world's transforms once in a world."""
+        if self.world is not None:
+            return self.world.transforms.rotations[self.idx]
+        return rotation_matrix(self.rot)
+
+    @property
+    def corners(self):
+        """World space corners, from the world's transforms once in a world
+        (see BodyTransforms)."""
+        if self.world is not None:
+            return self.world.transforms.corners[self.idx]
+        return BodyTransforms(self.p.unsqueeze(0), self.half_dims.unsqueeze(0)).corners[0]
+
+    @property
+    def half_dims(self):
+        raise NotImplementedError
 
-    def set_p(self, new_p, update_geom_rotation=True):
-        self.p = new_p
+    @property
+    def v(self):
+        if self.world is not None and self._v_src is not self.world.v:
+            self._v_src = self.world.v
+            self._v = self.world.v[self._state_slice()]
+        return self._v
+
+    @v.setter
+    def v(self, new_v):
+        # Once in a world, each write copies the world's whole v (O(n)), so
+        # updating many bodies this way is O(n^2): build the new vector and
+        # use World.set_v instead
+        if self.world is None:
+            self._v = new_v
+        else:
+            v = self.world.v.clone()
+            v[self._state_slice()] = new_v
+            self.world.v = v
+
+    def _state_slice(self):
+        vec_len = self.world.vec_len
+        return slice(self.idx * vec_len, (self.idx + 1) * vec_len)
+
+    def _refresh_p(self):
+        if self.world is not None and self._p_src is not self.world.p:
+            self._p_src = self.world.p
+            self._set_own_p(self.world.p[self._state_slice()])
+
+    def _set_own_p(self, p):
+        self._p = p
         # Reset memory pointers
-        self.rot = self.p[0:1]
-        self.pos = self.p[1:]
+        self._rot = self._p[0:1]
+        self._pos = self._p[1:]
 
+    def move(self, dt):
+        new_p = self.p + self.v * dt
+        self.set_p(new_p)
+
+    def set_p(self, new_p):
+        """Sets the body's rot and pos. Once in a world this copies the world's
+        whole p, to update many bodies build the new vector and use
+        World.set_p instead."""
+        # the geom is only moved when needed, by the collision detection
+        if self.world is None:
+            self._set_own_p(new_p)
+            self.geom_dirty = True
+        else:
+            p = self.world.p.clone()
+            p[self._state_slice()] = new_p
+            self.world.p = p
+            self.world._dirty_geoms.add(self.idx)
+
+    def sync_geom(self):
         self.geom.setPosition(torch.cat([self.pos.data,
                                          Tensor(1).zero_()]))
 
-        if update_geom_rotation:
+        if self.geom_rotates:
             # XXX sign correction
             s = math.sin(-self.rot.data[0] / 2)
             c = math.cos(-self.rot.data[0] / 2)
             quat = [s, 0, 0, c]  # Eq 2.3
             self.geom.setQuaternion(quat)
+        self.geom_dirty = False
 
     def apply_forces(self, t):
         return reduce(sum, [f.force(t) for f in self.forces],
@@ -90,14 +188,19 @@ class Body(object):
 
 class Rect(Body):
     def __init__(self, pos, dims, mass=Variable(Tensor([1])), restitution=Params.DEFAULT_RESTITUTION,
-                 fric_coeff=Params.DEFAULT_FRIC_COEFF, eps=Params.DEFAULT_EPSILON, col=(255, 0, 0), thickness=1):
+                 fric_coeff=Params.DEFAULT_FRIC_COEFF, eps=Params.DEFAULT_EPSILON, col=(255, 0, 0), thickness=1,
+                 static=False):
         self.dims = Variable(Tensor(dims))
         super().__init__(pos, mass=mass, restitution=restitution, fric_coeff=fric_coeff,
-                         eps=eps, col=col, thickness=thickness)
+                         eps=eps, col=col, thickness=thickness, static=static)
 
     def _get_ang_inertia(self, mass):
         return mass * torch.sum(self.dims ** 2) / 12
 
+    @property
+    def half_dims(self):
+        return self.dims / 2
+
     def _create_geom(self):
         self.geom = ode.GeomBox(None, torch.cat([self.dims.data + 2 * self.eps.data[0],
                                                  torch.ones(1).type_as(self.M.data)]))
@@ -105,17 +208,8 @@ class Rect(Body):
         self.geom.no_collision = set()
 
     def draw(self, screen):
-        # counter clockwise vertices, p1 is top right, origin center of mass
-        half_dims = self.dims / 2
-        r, theta = cart_to_polar(half_dims)
-        p1 = polar_to_cart(r, self.rot.data[0] + theta[0])
-        p2 = polar_to_cart(r, self.rot.data[0] + math.pi - theta[0])
-        p3 = polar_to_cart(r, self.rot.data[0] + math.pi + theta[0])
-        p4 = polar_to_cart(r, self.rot.data[0] + 2 * math.pi - theta[0])
-
-        # points in global frame
-        pts = [(p1 + self.pos).data.numpy(), (p2 + self.pos).data.numpy(),
-               (p3 + self.pos).data.numpy(), (p4 + self.pos).data.numpy()]
+        # counter clockwise vertices in global frame, pts[0] is top right
+        pts = list(self.corners.data.numpy())
 
         r = pygame.draw.polygon(screen, self.col, pts, 1)
         # draw diagonals
@@ -128,15 +222,22 @@ class Rect(Body):
 
 
 class Circle(Body):
+    geom_rotates = False
+
     def __init__(self, pos, rad, mass=Variable(Tensor([1])), restitution=Params.DEFAULT_RESTITUTION,
-                 fric_coeff=Params.DEFAULT_FRIC_COEFF, eps=Params.DEFAULT_EPSILON, col=(255, 0, 0), thickness=1):
+                 fric_coeff=Params.DEFAULT_FRIC_COEFF, eps=Params.DEFAULT_EPSILON, col=(255, 0, 0), thickness=1,
+                 static=False):
         self.rad = Variable(Tensor([rad]))
         super().__init__(pos, mass=mass, restitution=restitution, fric_coeff=fric_coeff,
-                                     eps=eps, col=col, thickness=thickness)
+                                     eps=eps, col=col, thickness=thickness, static=static)
 
     def _get_ang_inertia(self, mass):
         return mass * self.rad * self.rad / 2
 
+    @property
+    def half_dims(self):
+        return self.rad.repeat(DIM)
+
     def _create_geom(self):
         # XXX Change to cylinder?
         self.geom = ode.GeomSphere(None, self.rad.data[0] + self.eps.data[0])
@@ -144,12 +245,6 @@ class Circle(Body):
                                          Tensor(1).zero_()]))
         self.geom.no_collision = set()
 
-    def move(self, dt, update_geom_rotation=False):
-        super().move(dt, update_geom_rotation=update_geom_rotation)
-
-    def set_p(self, new_p, update_geom_rotation=False):
-        super().set_p(new_p, update_geom_rotation=update_geom_rotation)
-
     def draw(self, screen):
         center = self.pos.data.numpy().astype(int)
         rad = int(self.rad.data[0])
@@ -157,7 +252,6 @@ class Circle(Body):
                                rad, self.thickness)
         # draw radius to visualize orientation
         r = pygame.draw.line(screen, (0, 0, 255), center,
-                             center + [math.cos(self.rot.data[0]) * rad,
-                                       math.sin(self.rot.data[0]) * rad],
+                             center + self.rotation.data[:, X].numpy() * rad,
                              self.thickness)
         return [c, r]
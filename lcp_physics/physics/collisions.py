@@ -6,29 +6,143 @@ import torch
 from torch.autograd import Variable
 
 from .bodies import Circle
-from .utils import Indices, Params, cart_to_polar, polar_to_cart
+from .contacts import ContactCache
+from .utils import Indices, Params
 
 
 X = Indices.X
 Y = Indices.Y
 DIM = Params.DIM
 
+# Overlap margin by which rect_rect_contacts prefers an axis over an earlier
+# one (rectangle 1's before rectangle 2's, x before y)
+SAT_AXIS_TOL = 1e-6
+
 Tensor = Params.TENSOR_TYPE
 
 
+class BroadPhase:
+    # whether the ODE geoms must be synced with the bodies before each pass
+    uses_geoms = False
+
+    def __init__(self):
+        pass
+
+    def __call__(self, world):
+        raise NotImplementedError
+
+
+class OdeBroadPhase(BroadPhase):
+    """ODE's hash space, calling the collision handler back per candidate pair."""
+    uses_geoms = True
+
+    def __call__(self, world):
+        world.space.collide([world], world.collision_callback)
+
+
+class SweepAndPrune(BroadPhase):
+    """Sort based broad phase on the bodies' axis aligned bounding boxes.
+
+    The boxes of all bodies are computed at once from the world's positions
+    and rotations and sorted along x. The bodies whose x intervals overlap
+    each body's are found by a batched binary search in the sorted intervals,
+    the pairs whose y intervals do not overlap are then discarded. Candidate
+    pairs are handed to the collision handler as an index tensor.
+    """
+    def __call__(self, world):
+        world.collision_callback.collide_pairs(world, self.find_pairs(world))
+
+    def find_pairs(self, world):
+        """Returns the (i1, i2) rows, i1 < i2, of the bodies whose bounding
+        boxes overlap, as a LongTensor."""
+        lo, hi = self.bounding_boxes(world)
+        num_bodies = lo.size(0)
+        _, order = lo[:, X].sort()
+        lo, hi = lo.index_select(0, order), hi.index_select(0, order)
+
+        # ends[i] is one past the last sorted body starting before i ends
+        ends = upper_bound(lo[:, X].contiguous(), hi[:, X].contiguous())
+        counts = ends - torch.arange(0, num_bodies).long() - 1
+        num_pairs = counts.sum()
+        if num_pairs == 0:
+            return torch.LongTensor()
+        # the pairs of each (sorted) first body are consecutive, starting at
+        # starts[first], with second bodies first + 1, first + 2, ...
+        starts = torch.cumsum(counts, 0) - counts
+        nonempty = counts.nonzero().view(-1)
+        first = torch.LongTensor(num_pairs).zero_()
+        first.index_add_(0, starts.index_select(0, nonempty),
+                         torch.LongTensor(len(nonempty)).fill_(1))
+        first = nonempty.index_select(0, torch.cumsum(first, 0) - 1)
+        second = first + 1 + torch.arange(0, num_pairs).long() - starts.index_select(0, first)
+
+        overlap = (lo[:, Y].index_select(0, first) <= hi[:, Y].index_select(0, second)) * \
+            (lo[:, Y].index_select(0, second) <= hi[:, Y].index_select(0, first))
+        if overlap.sum() == 0:
+            return torch.LongTensor()
+        keep = overlap.nonzero().view(-1)
+        first = order.index_select(0, first.index_select(0, keep))
+        second = order.index_select(0, second.index_select(0, keep))
+        i1, i2 = torch.min(first, second), torch.max(first, second)
+        # deterministic order, independent of the sort
+        _, pair_order = (i1 * num_bodies + i2).sort()
+        return torch.stack([i1, i2], 1).index_select(0, pair_order)
+
+    def bounding_boxes(self, world):
+        """Returns the lower and upper corners of the bodies' bounding boxes,
+        grown by the world's eps, the separation within which the narrow
+        phase keeps contacts. A rectangle's box half size is the row-wise sum
+        of the absolute values of its half extents, a circle's its radius."""
+        pos = world.p.data.view(len(world.bodies), -1)[:, 1:]
+        half_dims = world._half_dims.data
+        rotated = world.transforms.half_extents.data.abs().sum(2)
+        round_ = world._is_circle.type_as(half_dims).unsqueeze(1)
+        half = round_ * half_dims + (1 - round_) * rotated + world.eps
+        return pos - half, pos + half
+
+
+def upper_bound(sorted_values, queries):
+    """Batched binary search, returns for each query the number of (sorted)
+    values smaller or equal to it."""
+    lo = torch.LongTensor(queries.size(0)).zero_()
+    hi = torch.LongTensor(queries.size(0)).fill_(sorted_values.size(0))
+    searching = lo < hi
+    while searching.sum() > 0:
+        mid = (lo + hi) / 2
+        mid_values = sorted_values.index_select(0, mid.clamp(max=sorted_values.size(0) - 1))
+        right = (mid_values <= queries) * searching
+        left = (1 - right) * searching
+        lo += right.long() * (mid + 1 - lo)
+        hi -= left.long() * (hi - mid)
+        searching = lo < hi
+    return lo
+
+
 class CollisionHandler:
+    uses_geoms = False
+
     def __init__(self):
         pass
 
     def __call__(self, *args, **kwargs):
         raise NotImplementedError
 
+    def collide_pairs(self, world, pairs):
+        """Narrow phase on the candidate body pairs, given as the (i1, i2) rows
+        of a LongTensor (see SweepAndPrune)."""
+        for i1, i2 in pairs.tolist():
+            self([world], world.bodies[i1].geom, world.bodies[i2].geom)
+
 
 class OdeCollisionHandler(CollisionHandler):
+    uses_geoms = True
+
     def __call__(self, args, geom1, geom2):
         if geom1 in geom2.no_collision:
             return
         world = args[0]
+        if world.skips_contact(geom1.body, geom2.body):
+            return
 
         contacts = ode.collide(geom1, geom2)
         for c in contacts:
@@ -44,14 +158,15 @@ class OdeCollisionHandler(CollisionHandler):
                 return
             p1 = point - Variable(Tensor(geom1.getPosition()))
             p2 = point - Variable(Tensor(geom2.getPosition()))
-            world.collisions.append(((normal, p1[:DIM], p2[:DIM], penetration),
-                                    geom1.body, geom2.body))
+            world.collisions.append(normal, p1[:DIM], p2[:DIM], penetration,
+                                    geom1.body, geom2.body)
             world.collisions_debug = world.collisions  # XXX
 
 
 class DiffCollisionHandler(CollisionHandler):
-    def __init__(self):
+    def __init__(self, cache=Params.CONTACT_CACHE):
         self.debug_callback = OdeCollisionHandler()
+        self.cache = ContactCache() if cache else None
 
     def __call__(self, args, geom1, geom2):
         # XXX
@@ -60,19 +175,171 @@ class DiffCollisionHandler(CollisionHandler):
         if geom1 in geom2.no_collision:
             return
         world = args[0]
+        if world.skips_contact(geom1.body, geom2.body):
+            return
+
+        i1, i2 = geom1.body, geom2.body
+        b1, b2 = world.bodies[i1], world.bodies[i2]
+        # Circle pairs are cheap enough to always recompute
+        cached = self.cache is not None and \
+            not (isinstance(b1, Circle) and isinstance(b2, Circle))
+        pts = self.cache.lookup(b1, b2, i1, i2, world.eps) if cached else None
+        if pts is None:
+            pts = self.contact_points(world, b1, b2)
+            if cached:
+                if pts:
+                    self.cache.store(b1, b2, i1, i2, pts)
+                else:
+                    self.cache.evict(i1, i2)
 
-        b1 = world.bodies[geom1.body]
-        b2 = world.bodies[geom2.body]
+        for feature, (normal, p1, p2, penetration) in enumerate(pts):
+            world.collisions.append(normal, p1, p2, penetration,
+                                    i1, i2, feature)
+        world.collisions_debug = world.collisions  # XXX
+
+    def collide_pairs(self, world, pairs):
+        """Runs the narrow phase of all pairs of each kind of shapes at once,
+        with the batched kernels."""
+        world.collisions_debug = world.collisions  # XXX
+        pairs = self.colliding_pairs(world, pairs)
+        if pairs is None:
+            return
+        i1, i2 = pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+        num_circles = world._is_circle.index_select(0, i1) + \
+            world._is_circle.index_select(0, i2)
+        for count, collide in [(2, self.collide_circles), (1, self.collide_circle_rects),
+                               (0, self.collide_rects)]:
+            kind_pairs = select_rows(pairs, num_circles == count)
+            if kind_pairs is not None:
+                collide(world, kind_pairs)
+
+    def colliding_pairs(self, world, pairs):
+        """Drops the pairs excluded with add_no_collision and those skipped
+        by world.skips_contact. Returns None if no pair is left."""
+        if pairs.dim() == 0 or pairs.size(0) == 0:
+            return None
+        n = len(world.bodies)
+        i1, i2 = pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+        static = torch.ByteTensor([int(s) for s in world.static])
+        inactive = torch.ByteTensor([int(a) for a in world._inactive])
+        skip = static.index_select(0, i1) * static.index_select(0, i2) + \
+            inactive.index_select(0, i1) * inactive.index_select(0, i2)
+        # excluded pairs, found by a binary search of the sorted pair keys
+        excluded = sorted({i * n + geom.body for i, b in enumerate(world.bodies)
+                           for geom in b.geom.no_collision})
+        if excluded:
+            excluded = torch.LongTensor(excluded)
+            keys = i1 * n + i2
+            ends = upper_bound(excluded, keys)
+            found = excluded.index_select(0, (ends - 1).clamp(min=0)) == keys
+            skip += found * (ends > 0)
+        return select_rows(pairs, skip == 0)
+
+    def collide_circles(self, world, pairs):
+        i1, i2 = pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+        var_i1, var_i2 = Variable(i1), Variable(i2)
+        pos, _ = body_poses(world)
+        # the half dims of circles are their radii
+        radii = world._half_dims[:, X]
+        normals, p1, p2, penetrations = circle_circle_contacts(
+            pos.index_select(0, var_i1), pos.index_select(0, var_i2),
+            radii.index_select(0, var_i1), radii.index_select(0, var_i2))
+        self._extend(world, penetrations.data >= -world.eps,
+                     normals, p1, p2, penetrations, i1, i2)
+
+    def collide_circle_rects(self, world, pairs):
+        # Not cached: the batched kernel costs less than per pair lookups,
+        # and the single contact of a pair always has feature 0
+        i1, i2 = pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+        # the kernel takes the circles first
+        flip = world._is_circle.index_select(0, i2)
+        circles = i1 * (1 - flip) + i2 * flip
+        rects = i1 + i2 - circles
+        var_circles, var_rects = Variable(circles), Variable(rects)
+        pos, rotations = body_poses(world)
+        normals, p_circle, p_rect, penetrations = circle_rect_contacts(
+            pos.index_select(0, var_circles),
+            world._half_dims[:, X].index_select(0, var_circles),
+            pos.index_select(0, var_rects), rotations.index_select(0, var_rects),
+            2 * world._half_dims.index_select(0, var_rects))
+        # back to the pairs' order, normals point from body 2 to body 1
+        flip = Variable(flip.type_as(pos.data).unsqueeze(1))
+        normals = normals * (1 - 2 * flip)
+        p1 = p_circle * (1 - flip) + p_rect * flip
+        p2 = p_rect * (1 - flip) + p_circle * flip
+        self._extend(world, penetrations.data > -world.eps,
+                     normals, p1, p2, penetrations, i1, i2)
+
+    def collide_rects(self, world, pairs):
+        if self.cache is not None:
+            # pairs with a valid cached manifold skip the narrow phase
+            misses = []
+            for i1, i2 in pairs.tolist():
+                b1, b2 = world.bodies[i1], world.bodies[i2]
+                pts = self.cache.lookup(b1, b2, i1, i2, world.eps)
+                if pts is None:
+                    misses.append((i1, i2))
+                    continue
+                for feature, (normal, p1, p2, penetration) in enumerate(pts):
+                    world.collisions.append(normal, p1, p2, penetration,
+                                            i1, i2, feature)
+            if not misses:
+                return
+            pairs = torch.LongTensor(misses)
+        i1, i2 = pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+        var_i1, var_i2 = Variable(i1), Variable(i2)
+        pos, rotations = body_poses(world)
+        dims = 2 * world._half_dims
+        normals, p1, p2, penetrations, valid = rect_rect_contacts(
+            pos.index_select(0, var_i1), rotations.index_select(0, var_i1),
+            dims.index_select(0, var_i1),
+            pos.index_select(0, var_i2), rotations.index_select(0, var_i2),
+            dims.index_select(0, var_i2))
+        keep = valid * (penetrations.data >= -world.eps)
+        n = len(pairs)
+        # features numbered among the kept contacts of each pair, as in
+        # contact_points
+        features = torch.cat([torch.LongTensor(n).zero_(), keep[:n].long()])
+        self._extend(world, keep, normals, p1, p2, penetrations,
+                     torch.cat([i1, i1]), torch.cat([i2, i2]), features)
+        if self.cache is not None:
+            for k, (j1, j2) in enumerate(pairs.tolist()):
+                pts = [(normals[r], p1[r], p2[r], penetrations[r:r + 1])
+                       for r in (k, n + k) if keep[r]]
+                if pts:
+                    self.cache.store(world.bodies[j1], world.bodies[j2], j1, j2, pts)
+                else:
+                    self.cache.evict(j1, j2)
+
+    def _extend(self, world, keep, normals, p1, p2, penetrations, i1, i2, features=None):
+        """Adds the contacts selected by the keep mask."""
+        if keep.sum() == 0:
+            return
+        keep = keep.nonzero().view(-1)
+        var_keep = Variable(keep)
+        world.collisions.extend(normals.index_select(0, var_keep),
+                                p1.index_select(0, var_keep),
+                                p2.index_select(0, var_keep),
+                                penetrations.index_select(0, var_keep),
+                                i1.index_select(0, keep), i2.index_select(0, keep),
+                                features.index_select(0, keep) if features is not None else None)
+
+    def contact_points(self, world, b1, b2):
+        """Narrow phase, returns the (normal, p1, p2, penetration) of each
+        contact between b1 and b2."""
         is_circle_g1 = isinstance(b1, Circle)
         is_circle_g2 = isinstance(b2, Circle)
         if is_circle_g1 and is_circle_g2:
             r = b1.rad + b2.rad
-            normal = b1.pos - b2.pos
-            dist = normal.norm()
+            d = b1.pos - b2.pos
+            # coincident centers are pushed apart along x
+            shift = 1. if d.data.abs().max() == 0 else 0.
+            axis = d + Variable(d.data.new([shift, 0]))
+            dist = axis.norm() - shift
             penetration = r - dist
             if penetration.data[0] < -world.eps:
-                return
-            normal = normal / dist
+                return []
+            normal = axis / (dist + shift)
             p1 = -normal * b1.rad
             p2 = normal * b2.rad
             pts = [(normal, p1, p2, penetration)]
@@ -88,10 +355,8 @@ class DiffCollisionHandler(CollisionHandler):
             c2 = torch.cat([c1[X], c3[Y]])
             c4 = torch.cat([c3[X], c1[Y]])
             # positions in rect frame
-            b1_pos = b1.pos - b2.pos
-            # TODO Optimize rotation
-            r, theta = cart_to_polar(b1_pos)
-            b1_pos = polar_to_cart(r, theta - b2.rot)
+            rotation = b2.rotation
+            b1_pos = torch.mv(rotation.t(), b1.pos - b2.pos)
             # TODO case where circle center is inside rect
             if c1.data[X] <= b1_pos.data[X] <= c3.data[X]:
                 # top or bottom face contact
@@ -143,12 +408,9 @@ class DiffCollisionHandler(CollisionHandler):
                     p2 = c4
                 penetration = b1.rad - (b1_pos - p2).norm()  # XXX
             if penetration.data[0] <= -world.eps:
-                return
-            # TODO Optimize rotations
-            r, theta = cart_to_polar(p2)
-            p2 = polar_to_cart(r, theta + b2.rot)
-            r, theta = cart_to_polar(normal)
-            normal = polar_to_cart(r, theta + b2.rot)
+                return []
+            p2 = torch.mv(rotation, p2)
+            normal = torch.mv(rotation, normal)
 
             p1 = -normal * b1.rad # TODO is this right?
             if is_circle_g2:
@@ -159,487 +421,184 @@ class DiffCollisionHandler(CollisionHandler):
             pts = [(normal, p1, p2, penetration)]
         else:
             # both are rectangles
-            if b1.rot.data[0] % (math.pi / 2) == 0 and \
-               b2.rot.data[0] % (math.pi / 2) == 0:
-                # both rectangles are axis aligned
-                b1_half_dims = b1.dims / 2
-                b2_half_dims = b2.dims / 2
-                b1_br = b1.pos + b1_half_dims
-                b1_tl = b1.pos - b1_half_dims
-                b2_br = b2.pos + b2_half_dims
-                b2_tl = b2.pos - b2_half_dims
-                delta_pos = b1.pos - b2.pos
-                overlap = b1_half_dims + b2_half_dims - torch.abs(delta_pos)
-                if overlap.data[X] > overlap.data[Y]:
-                    penetration = overlap[Y]
-                    if penetration.data[0] < -world.eps:
-                        return
-                    lx = torch.max(b1_tl[X], b2_tl[X])
-                    rx = torch.min(b1_br[X], b2_br[X])
-                    normal = b1_tl - torch.cat([b1_tl[X], b1_br[Y]])
-                    if delta_pos.data[Y] <= 0:
-                        # above
-                        pts_1 = [torch.cat([lx, b1_br[Y]]), torch.cat(([rx, b1_br[Y]]))]
-                        pts_2 = [torch.cat([lx, b2_tl[Y]]), torch.cat(([rx, b2_tl[Y]]))]
-                    else:
-                        # below
-                        pts_1 = [torch.cat([lx, b1_tl[Y]]), torch.cat(([rx, b1_tl[Y]]))]
-                        pts_2 = [torch.cat([lx, b2_br[Y]]), torch.cat(([rx, b2_br[Y]]))]
-                        normal *= -1
-                    normal = normal / normal.norm()
-                elif overlap.data[X] < overlap.data[Y]:
-                    penetration = overlap[X]
-                    if penetration.data[0] < -world.eps:
-                        return
-                    ty = torch.max(b1_tl[Y], b2_tl[Y])
-                    by = torch.min(b1_br[Y], b2_br[Y])
-                    normal = b1_tl - torch.cat([b1_br[X], b1_tl[Y]])
-                    if delta_pos.data[X] <= 0:
-                        # left
-                        pts_1 = [torch.cat([b1_tl[X]], ty), torch.cat(([b1_tl[X], by]))]
-                        pts_2 = [torch.cat([b2_br[X], ty]), torch.cat(([b2_br[X], by]))]
-                    else:
-                        # right
-                        pts_1 = [torch.cat([b1_br[X]], ty), torch.cat(([b1_br[X], by]))]
-                        pts_2 = [torch.cat([b2_tl[X], ty]), torch.cat(([b2_tl[X], by]))]
-                        normal *= -1
-                    normal = normal / normal.norm()
-                else:
-                    assert False  # TODO normal that points 45 degrees from corner
-                pts = [(normal, pt1 - b1.pos, pt2 - b1.pos, penetration)
-                       for pt1, pt2 in zip(pts_1, pts_2)]
-            else:
-                # rectangles not axis aligned
-                # TODO Simplify case where both are aligned with each other but not with world?
-                delta_pos = b1.pos - b2.pos
-                # Calculate separations for axis in b1's frame
-                c, s = torch.cos(-b1.rot), torch.sin(-b1.rot)
-                rot_mat_1 = torch.cat([torch.cat([c, -s]).unsqueeze(0),
-                                       torch.cat([s, c]).unsqueeze(0)], 0)
-                rot_delta_pos = torch.matmul(rot_mat_1, delta_pos)
-                rot_2 = b2.rot - b1.rot
-                c, s = torch.cos(rot_2), torch.sin(rot_2)
-                b2_rot_mat = torch.cat([torch.cat([c, -s]).unsqueeze(0),
-                                        torch.cat([s, c]).unsqueeze(0)], 0)
-                rot_half_x_2 = torch.matmul(b2_rot_mat, torch.cat([b2.dims[X] / 2, Variable(Tensor(1).zero_())]))
-                rot_half_y_2 = torch.matmul(b2_rot_mat, torch.cat([Variable(Tensor(1).zero_()), b2.dims[Y] / 2]))
-                b2_extent = torch.cat([torch.abs(rot_half_x_2[X]) + torch.abs(rot_half_y_2[X]),
-                                       torch.abs(rot_half_x_2[Y]) + torch.abs(rot_half_y_2[Y])])
-                b1_extent = b1.dims / 2
-                overlap_1 = b1_extent + b2_extent - torch.abs(rot_delta_pos)
-
-                # Calculate separations for axis in b2's frame
-                c, s = torch.cos(-b2.rot), torch.sin(-b2.rot)
-                rot_mat_2 = torch.cat([torch.cat([c, -s]).unsqueeze(0),
-                                       torch.cat([s, c]).unsqueeze(0)], 0)
-                rot_delta_pos = torch.matmul(rot_mat_2, delta_pos)
-                rot_1 = b1.rot - b2.rot
-                c, s = torch.cos(rot_1), torch.sin(rot_1)
-                b1_rot_mat = torch.cat([torch.cat([c, -s]).unsqueeze(0),
-                                        torch.cat([s, c]).unsqueeze(0)], 0)
-                rot_half_x_1 = torch.matmul(b1_rot_mat, torch.cat([b1.dims[X] / 2, Variable(Tensor(1).zero_())]))
-                rot_half_y_1 = torch.matmul(b1_rot_mat, torch.cat([Variable(Tensor(1).zero_()), b1.dims[Y] / 2]))
-                b1_extent = torch.cat([torch.abs(rot_half_x_1[X]) + torch.abs(rot_half_y_1[X]),
-                                       torch.abs(rot_half_x_1[Y]) + torch.abs(rot_half_y_1[Y])])
-                b2_extent = b2.dims / 2
-                overlap_2 = b1_extent + b2_extent - torch.abs(rot_delta_pos)
-
-                min_overlap_1 = torch.min(overlap_1)
-                min_overlap_2 = torch.min(overlap_2)
-                penetration = torch.min(min_overlap_1, min_overlap_2)
-                if penetration.data[0] < -world.eps:
-                    return
-                if min_overlap_1.data[0] <= min_overlap_2.data[0]:
-                    # Minimal penetration is in b1 frame
-                    rot_b1_pos = torch.matmul(rot_mat_1, b1.pos)
-                    rot_b2_pos = torch.matmul(rot_mat_1, b2.pos)
-                    b2_half_dims = b2.dims / 2
-                    c1 = -b2_half_dims
-                    c3 = b2_half_dims
-                    c2 = torch.cat([c1[X], c3[Y]])
-                    c4 = torch.cat([c3[X], c1[Y]])
-                    cs = [c1, c2, c3, c4]
-                    rot_cs = [rot_b2_pos + torch.matmul(b2_rot_mat, c) for c in cs]
-                    if overlap_1.data[X] < overlap_1.data[Y]:
-                        # Minimal penetration is in X axis
-                        normal = torch.cat([-b1.dims[X], b1.dims[Y]]) - b1.dims
-                        normal = torch.matmul(rot_mat_1.t(), normal)
-                        normal = normal / normal.norm()
-                        if rot_b2_pos.data[X] < rot_b1_pos.data[X]:
-                            # b2 is to the left of b1
-                            normal = -normal
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[X] > rot_cs[closest].data[X]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[X] > rot_cs[sec_closest].data[X]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[closest] - rot_cs[sec_closest]
-                            if pen_diff.data[X] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[Y] > rot_b1_pos.data[Y] + b1.dims.data[Y] / 2:
-                                pt1 = torch.cat([-b1.dims[X] / 2, b1.dims[Y] / 2])
-                                pt2 = torch.cat([rot_cs[closest][X], (rot_b1_pos + pt1)[Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            elif rot_cs[closest].data[Y] < rot_b1_pos.data[Y] - b1.dims.data[Y] / 2:
-                                pt1 = torch.cat([-b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                pt2 = torch.cat([rot_cs[closest][X], (rot_b1_pos + pt1)[Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            else:
-                                pt2 = torch.matmul(rot_mat_2.t(), cs[closest])
-                                pt1 = torch.cat([-b1.dims[X] / 2, rot_cs[closest][Y] - rot_b1_pos[Y]])
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[Y] > rot_b1_pos.data[Y] + b1.dims.data[Y] / 2:
-                                    pt1 = torch.cat([-b1.dims[X] / 2, b1.dims[Y] / 2])
-                                    pt2 = torch.cat([rot_cs[sec_closest][X], (rot_b1_pos + pt1)[Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                elif rot_cs[sec_closest].data[Y] < rot_b1_pos.data[Y] - b1.dims.data[Y] / 2:
-                                    pt1 = torch.cat([-b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                    pt2 = torch.cat([rot_cs[sec_closest][X], (rot_b1_pos + pt1)[Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                else:
-                                    pt2 = torch.matmul(rot_mat_2.t(), cs[sec_closest])
-                                    pt1 = torch.cat([-b1.dims[X] / 2, rot_cs[sec_closest][Y] - rot_b1_pos[Y]])
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[X]))
-                        else:
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[X] < rot_cs[closest].data[X]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[X] < rot_cs[sec_closest].data[X]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[sec_closest] - rot_cs[closest]
-                            if pen_diff.data[X] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[Y] > rot_b1_pos.data[Y] + b1.dims.data[Y] / 2:
-                                pt1 = torch.cat([b1.dims[X] / 2, b1.dims[Y] / 2])
-                                pt2 = torch.cat([rot_cs[closest][X], (rot_b1_pos + pt1)[Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            elif rot_cs[closest].data[Y] < rot_b1_pos.data[Y] - b1.dims.data[Y] / 2:
-                                pt1 = torch.cat([b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                pt2 = torch.cat([rot_cs[closest][X], (rot_b1_pos + pt1)[Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            else:
-                                pt2 = torch.matmul(rot_mat_2.t(), cs[closest])
-                                pt1 = torch.cat([b1.dims[X] / 2, rot_cs[closest][Y] - rot_b1_pos[Y]])
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[Y] > rot_b1_pos.data[Y] + b1.dims.data[Y] / 2:
-                                    pt1 = torch.cat([b1.dims[X] / 2, b1.dims[Y] / 2])
-                                    pt2 = torch.cat([rot_cs[sec_closest][X], (rot_b1_pos + pt1)[Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                elif rot_cs[sec_closest].data[Y] < rot_b1_pos.data[Y] - b1.dims.data[Y] / 2:
-                                    pt1 = torch.cat([b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                    pt2 = torch.cat([rot_cs[sec_closest][X], (rot_b1_pos + pt1)[Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                else:
-                                    pt2 = torch.matmul(rot_mat_2.t(), cs[sec_closest])
-                                    pt1 = torch.cat([b1.dims[X] / 2, rot_cs[sec_closest][Y] - rot_b1_pos[Y]])
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[X]))
-                    elif overlap_1.data[X] > overlap_1.data[Y]:
-                        # Minimal penetration is in Y axis
-                        normal = torch.cat([b1.dims[X], -b1.dims[Y]]) - b1.dims
-                        normal = torch.matmul(rot_mat_1.t(), normal)
-                        normal = normal / normal.norm()
-                        if rot_b2_pos.data[Y] < rot_b1_pos.data[Y]:
-                            # b2 is above b1
-                            normal = -normal
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[Y] > rot_cs[closest].data[Y]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[Y] > rot_cs[sec_closest].data[Y]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[closest] - rot_cs[sec_closest]
-                            if pen_diff.data[Y] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[X] > rot_b1_pos.data[X] + b1.dims.data[X] / 2:
-                                pt1 = torch.cat([b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[closest][Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            elif rot_cs[closest].data[X] < rot_b1_pos.data[X] - b1.dims.data[X] / 2:
-                                pt1 = torch.cat([-b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[closest][Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            else:
-                                pt2 = torch.matmul(rot_mat_2.t(), cs[closest])
-                                pt1 = torch.cat([rot_cs[closest][X] - rot_b1_pos[X], -b1.dims[Y] / 2])
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[X] > rot_b1_pos.data[X] + b1.dims.data[X] / 2:
-                                    pt1 = torch.cat([b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                    pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[sec_closest][Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                elif rot_cs[sec_closest].data[X] < rot_b1_pos.data[X] - b1.dims.data[X] / 2:
-                                    pt1 = torch.cat([-b1.dims[X] / 2, -b1.dims[Y] / 2])
-                                    pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[sec_closest][Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                else:
-                                    pt2 = torch.matmul(rot_mat_2.t(), cs[sec_closest])
-                                    pt1 = torch.cat([rot_cs[sec_closest][X] - rot_b1_pos[X], -b1.dims[Y] / 2])
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[Y]))
-                        else:
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[Y] < rot_cs[closest].data[Y]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[Y] < rot_cs[sec_closest].data[Y]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[sec_closest] - rot_cs[closest]
-                            if pen_diff.data[Y] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[X] > rot_b1_pos.data[X] + b1.dims.data[X] / 2:
-                                pt1 = torch.cat([b1.dims[X] / 2, b1.dims[Y] / 2])
-                                pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[closest][Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            elif rot_cs[closest].data[X] < rot_b1_pos.data[X] - b1.dims.data[X] / 2:
-                                pt1 = torch.cat([-b1.dims[X] / 2, b1.dims[Y] / 2])
-                                pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[closest][Y]])
-                                pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            else:
-                                pt2 = torch.matmul(rot_mat_2.t(), cs[closest])
-                                pt1 = torch.cat([rot_cs[closest][X] - rot_b1_pos[X], b1.dims[Y] / 2])
-                                pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[X] > rot_b1_pos.data[X] + b1.dims.data[X] / 2:
-                                    pt1 = torch.cat([b1.dims[X] / 2, b1.dims[Y] / 2])
-                                    pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[sec_closest][Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                elif rot_cs[sec_closest].data[X] < rot_b1_pos.data[X] - b1.dims.data[X] / 2:
-                                    pt1 = torch.cat([-b1.dims[X] / 2, b1.dims[Y] / 2])
-                                    pt2 = torch.cat([(rot_b1_pos + pt1)[X], rot_cs[sec_closest][Y]])
-                                    pt2 = torch.matmul(rot_mat_1.t(), pt2) - b2.pos
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                else:
-                                    pt2 = torch.matmul(rot_mat_2.t(), cs[sec_closest])
-                                    pt1 = torch.cat([rot_cs[sec_closest][X] - rot_b1_pos[X], b1.dims[Y] / 2])
-                                    pt1 = torch.matmul(rot_mat_1.t(), pt1)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[Y]))
-                    else:
-                        assert False    # TODO case where == ?
-                else:
-                    # Minimal penetration is in b2 frame
-                    rot_b1_pos = torch.matmul(rot_mat_2, b1.pos)
-                    rot_b2_pos = torch.matmul(rot_mat_2, b2.pos)
-                    b1_half_dims = b1.dims / 2
-                    c1 = -b1_half_dims
-                    c3 = b1_half_dims
-                    c2 = torch.cat([c1[X], c3[Y]])
-                    c4 = torch.cat([c3[X], c1[Y]])
-                    cs = [c1, c2, c3, c4]
-                    rot_cs = [rot_b1_pos + torch.matmul(b1_rot_mat, c) for c in cs]
-                    if overlap_2.data[X] < overlap_2.data[Y]:
-                        # Minimal penetration is in X axis
-                        normal = torch.cat([-b2.dims[X], b2.dims[Y]]) - b2.dims
-                        normal = torch.matmul(rot_mat_2.t(), normal)
-                        normal = normal / normal.norm()
-                        if rot_b1_pos.data[X] < rot_b2_pos.data[X]:
-                            # b1 is to the left of b2
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[X] > rot_cs[closest].data[X]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[X] > rot_cs[sec_closest].data[X]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[closest] - rot_cs[sec_closest]
-                            if pen_diff.data[X] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[Y] > rot_b2_pos.data[Y] + b2.dims.data[Y] / 2:
-                                pt2 = torch.cat([-b2.dims[X] / 2, b2.dims[Y] / 2])
-                                pt1 = torch.cat([rot_cs[closest][X], (rot_b2_pos + pt2)[Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            elif rot_cs[closest].data[Y] < rot_b2_pos.data[Y] - b2.dims.data[Y] / 2:
-                                pt2 = torch.cat([-b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                pt1 = torch.cat([rot_cs[closest][X], (rot_b2_pos + pt2)[Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            else:
-                                pt1 = torch.matmul(rot_mat_1.t(), cs[closest])
-                                pt2 = torch.cat([-b2.dims[X] / 2, rot_cs[closest][Y] - rot_b2_pos[Y]])
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[Y] > rot_b2_pos.data[Y] + b2.dims.data[Y] / 2:
-                                    pt2 = torch.cat([-b2.dims[X] / 2, b2.dims[Y] / 2])
-                                    pt1 = torch.cat([rot_cs[sec_closest][X], (rot_b2_pos + pt2)[Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                elif rot_cs[sec_closest].data[Y] < rot_b2_pos.data[Y] - b2.dims.data[Y] / 2:
-                                    pt2 = torch.cat([-b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                    pt1 = torch.cat([rot_cs[sec_closest][X], (rot_b2_pos + pt2)[Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                else:
-                                    pt1 = torch.matmul(rot_mat_1.t(), cs[sec_closest])
-                                    pt2 = torch.cat([-b2.dims[X] / 2, rot_cs[sec_closest][Y] - rot_b2_pos[Y]])
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[X]))
-                        else:
-                            normal = -normal
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[X] < rot_cs[closest].data[X]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[X] < rot_cs[sec_closest].data[X]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[sec_closest] - rot_cs[closest]
-                            if pen_diff.data[X] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[Y] > rot_b2_pos.data[Y] + b2.dims.data[Y] / 2:
-                                pt2 = torch.cat([b2.dims[X] / 2, b2.dims[Y] / 2])
-                                pt1 = torch.cat([rot_cs[closest][X], (rot_b2_pos + pt2)[Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            elif rot_cs[closest].data[Y] < rot_b2_pos.data[Y] - b2.dims.data[Y] / 2:
-                                pt2 = torch.cat([b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                pt1 = torch.cat([rot_cs[closest][X], (rot_b2_pos + pt2)[Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            else:
-                                pt1 = torch.matmul(rot_mat_1.t(), cs[closest])
-                                pt2 = torch.cat([b2.dims[X] / 2, rot_cs[closest][Y] - rot_b2_pos[Y]])
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[Y] > rot_b2_pos.data[Y] + b2.dims.data[Y] / 2:
-                                    pt2 = torch.cat([b2.dims[X] / 2, b2.dims[Y] / 2])
-                                    pt1 = torch.cat([rot_cs[sec_closest][X], (rot_b2_pos + pt2)[Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                elif rot_cs[sec_closest].data[Y] < rot_b2_pos.data[Y] - b2.dims.data[Y] / 2:
-                                    pt2 = torch.cat([b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                    pt1 = torch.cat([rot_cs[sec_closest][X], (rot_b2_pos + pt2)[Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                else:
-                                    pt1 = torch.matmul(rot_mat_1.t(), cs[sec_closest])
-                                    pt2 = torch.cat([b2.dims[X] / 2, rot_cs[sec_closest][Y] - rot_b2_pos[Y]])
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[X]))
-                    elif overlap_2.data[X] > overlap_2.data[Y]:
-                        # Minimal penetration is in Y axis
-                        normal = torch.cat([b2.dims[X], -b2.dims[Y]]) - b2.dims
-                        normal = torch.matmul(rot_mat_2.t(), normal)
-                        normal = normal / normal.norm()
-                        if rot_b1_pos.data[Y] < rot_b2_pos.data[Y]:
-                            # b1 is above b2
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[Y] > rot_cs[closest].data[Y]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[Y] > rot_cs[sec_closest].data[Y]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[closest] - rot_cs[sec_closest]
-                            if pen_diff.data[Y] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[X] > rot_b2_pos.data[X] + b2.dims.data[X] / 2:
-                                pt2 = torch.cat([b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[closest][Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            elif rot_cs[closest].data[X] < rot_b2_pos.data[X] - b2.dims.data[X] / 2:
-                                pt2 = torch.cat([-b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[closest][Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            else:
-                                pt1 = torch.matmul(rot_mat_1.t(), cs[closest])
-                                pt2 = torch.cat([rot_cs[closest][X] - rot_b2_pos[X], -b2.dims[Y] / 2])
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[X] > rot_b2_pos.data[X] + b2.dims.data[X] / 2:
-                                    pt2 = torch.cat([b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                    pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[sec_closest][Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                elif rot_cs[sec_closest].data[X] < rot_b2_pos.data[X] - b2.dims.data[X] / 2:
-                                    pt2 = torch.cat([-b2.dims[X] / 2, -b2.dims[Y] / 2])
-                                    pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[sec_closest][Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                else:
-                                    pt1 = torch.matmul(rot_mat_1.t(), cs[sec_closest])
-                                    pt2 = torch.cat([rot_cs[sec_closest][X] - rot_b2_pos[X], -b2.dims[Y] / 2])
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[Y]))
-                        else:
-                            normal = -normal
-                            closest = sec_closest = None
-                            for i in range(len(rot_cs)):
-                                if closest is None or rot_cs[i].data[Y] < rot_cs[closest].data[Y]:
-                                    sec_closest = closest
-                                    closest = i
-                                elif sec_closest is None or rot_cs[i].data[Y] < rot_cs[sec_closest].data[Y]:
-                                    sec_closest = i
-                            pen_diff = rot_cs[sec_closest] - rot_cs[closest]
-                            if pen_diff.data[Y] > world.par_eps + max(penetration.data[0], 0):
-                                sec_closest = None
-                            if rot_cs[closest].data[X] > rot_b2_pos.data[X] + b2.dims.data[X] / 2:
-                                pt2 = torch.cat([b2.dims[X] / 2, b2.dims[Y] / 2])
-                                pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[closest][Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            elif rot_cs[closest].data[X] < rot_b2_pos.data[X] - b2.dims.data[X] / 2:
-                                pt2 = torch.cat([-b2.dims[X] / 2, b2.dims[Y] / 2])
-                                pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[closest][Y]])
-                                pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            else:
-                                pt1 = torch.matmul(rot_mat_1.t(), cs[closest])
-                                pt2 = torch.cat([rot_cs[closest][X] - rot_b2_pos[X], b2.dims[Y] / 2])
-                                pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                            pts = [(normal, pt1, pt2, penetration)]
-                            if sec_closest is not None:
-                                if rot_cs[sec_closest].data[X] > rot_b2_pos.data[X] + b2.dims.data[X] / 2:
-                                    pt2 = torch.cat([b2.dims[X] / 2, b2.dims[Y] / 2])
-                                    pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[sec_closest][Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                elif rot_cs[sec_closest].data[X] < rot_b2_pos.data[X] - b2.dims.data[X] / 2:
-                                    pt2 = torch.cat([-b2.dims[X] / 2, b2.dims[Y] / 2])
-                                    pt1 = torch.cat([(rot_b2_pos + pt2)[X], rot_cs[sec_closest][Y]])
-                                    pt1 = torch.matmul(rot_mat_2.t(), pt1) - b1.pos
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                else:
-                                    pt1 = torch.matmul(rot_mat_1.t(), cs[sec_closest])
-                                    pt2 = torch.cat([rot_cs[sec_closest][X] - rot_b2_pos[X], b2.dims[Y] / 2])
-                                    pt2 = torch.matmul(rot_mat_2.t(), pt2)
-                                pts.append((normal, pt1, pt2, penetration - pen_diff[Y]))
-                    else:
-                        assert False  # TODO case where == ?
-
-        for p in pts:
-            world.collisions.append((p, geom1.body, geom2.body))
-        world.collisions_debug = world.collisions  # XXX
+            normals, p1, p2, penetrations, valid = rect_rect_contacts(
+                b1.pos.unsqueeze(0), b1.rotation.unsqueeze(0), b1.dims.unsqueeze(0),
+                b2.pos.unsqueeze(0), b2.rotation.unsqueeze(0), b2.dims.unsqueeze(0))
+            pts = [(normals[k], p1[k], p2[k], penetrations[k:k + 1]) for k in range(2)
+                   if valid[k] and penetrations.data[k] >= -world.eps]
+        return pts
+
+
+def select_rows(t, mask):
+    """Returns the rows of t where the ByteTensor mask is set, None if there
+    are none."""
+    idxs = mask.nonzero()
+    if idxs.dim() == 0 or idxs.size(0) == 0:
+        return None
+    return t.index_select(0, idxs.view(-1))
+
+
+def body_poses(world):
+    """Returns the (bodies, DIM) positions and (bodies, DIM, DIM) rotation
+    matrices of the world's bodies."""
+    p = world.p.view(len(world.bodies), world.vec_len)
+    return p[:, 1:], world.transforms.rotations
+
+
+def circle_circle_contacts(pos1, pos2, rad1, rad2):
+    """Batched circle-circle narrow phase, from (n, DIM) positions and (n)
+    radii. Returns the (normals, p1, p2, penetrations) of the n pairs."""
+    d = pos1 - pos2
+    # coincident centers are pushed apart along x
+    shift = Variable((d.data.abs().max(1)[0] == 0).type_as(d.data))
+    axis = d + torch.stack([shift, shift * 0], 1)
+    dist = (axis * axis).sum(1).sqrt() - shift
+    penetrations = rad1 + rad2 - dist
+    normals = axis / (dist + shift).unsqueeze(1)
+    p1 = -normals * rad1.unsqueeze(1)
+    p2 = normals * rad2.unsqueeze(1)
+    return normals, p1, p2, penetrations
+
+
+def circle_rect_contacts(circle_pos, rad, rect_pos, rect_rotations, dims):
+    """Batched circle-rectangle narrow phase, from (n, DIM) positions, (n)
+    radii, (n, DIM, DIM) rectangle rotation matrices and (n, DIM) rectangle
+    dims.
+
+    The circle's center is projected on the closest face, or corner when it
+    is outside of both faces' ranges. Returns the (normals, circle arms,
+    rectangle arms, penetrations) of the n pairs, normals pointing from the
+    rectangle to the circle.
+    """
+    c, s = rect_rotations[:, 0, 0], rect_rotations[:, 1, 0]
+    # circle center in the rectangle's frame
+    d = circle_pos - rect_pos
+    x = c * d[:, X] + s * d[:, Y]
+    y = -s * d[:, X] + c * d[:, Y]
+    hx, hy = dims[:, X] / 2, dims[:, Y] / 2
+
+    # regions, from data: facing the horizontal faces, the vertical faces,
+    # or a corner. Centers on an axis go to the positive side's face.
+    face_x = (x.data.abs() <= hx.data).type_as(x.data)
+    face_y = (1 - face_x) * (y.data.abs() <= hy.data).type_as(x.data)
+    corner = 1 - face_x - face_y
+    sx = Variable(2 * (x.data >= 0).type_as(x.data) - 1)
+    sy = Variable(2 * (y.data >= 0).type_as(x.data) - 1)
+    face_x, face_y, corner = Variable(face_x), Variable(face_y), Variable(corner)
+
+    # closest point on the boundary and normal, in the rectangle's frame
+    px = face_x * x + (face_y + corner) * sx * hx
+    py = face_y * y + (face_x + corner) * sy * hy
+    dx, dy = x - px, y - py
+    # (corner distances are never 0, the others are not used)
+    dist = (dx * dx + dy * dy).sqrt() + (1 - corner)
+    nx = face_y * sx + corner * dx / dist
+    ny = face_x * sy + corner * dy / dist
+    penetrations = rad - (dx * nx + dy * ny)
+
+    # back to the world frame
+    normals = torch.stack([c * nx - s * ny, s * nx + c * ny], 1)
+    p_rect = torch.stack([c * px - s * py, s * px + c * py], 1)
+    p_circle = -normals * rad.unsqueeze(1)
+    return normals, p_circle, p_rect, penetrations
+
+
+def rect_rect_contacts(pos1, rotations1, dims1, pos2, rotations2, dims2):
+    """Batched rectangle-rectangle narrow phase, from (n, DIM) positions and
+    dims and (n, DIM, DIM) rotation matrices.
+
+    The separating axis test picks, among both rectangles' axes, the one of
+    least overlap: in case of ties (within SAT_AXIS_TOL) rectangle 1's axes
+    are preferred over rectangle 2's, and x over y. The rectangle owning it
+    is the reference, the other one's face most opposed to the reference
+    face is clipped to the reference face's sides, giving up to two contacts
+    per pair. Returns the (normals, p1, p2, penetrations) of the contacts as
+    (2n) rows, first the first contact of each pair, then the second, with a
+    ByteTensor of the valid ones (clipping can leave a single point).
+    """
+    # the rectangles' frame axes are the rotations' columns
+    axes = [rotations1[:, :, X], rotations1[:, :, Y],
+            rotations2[:, :, X], rotations2[:, :, Y]]
+    half_dims = [dims1[:, X] / 2, dims1[:, Y] / 2, dims2[:, X] / 2, dims2[:, Y] / 2]
+    d = pos1 - pos2
+
+    # separating axis test, overlaps of the projections on each axis
+    overlaps = []
+    for u in axes:
+        projections = [h * _dot(u, a).abs() for h, a in zip(half_dims, axes)]
+        overlaps.append(sum(projections) - _dot(d, u).abs())
+    best = overlaps[0].data.clone()
+    best_axis = torch.LongTensor(best.size(0)).zero_()
+    for k in range(1, 4):
+        better = overlaps[k].data < best - SAT_AXIS_TOL
+        best[better] = overlaps[k].data[better]
+        best_axis[better] = k
+    m = [Variable((best_axis == k).type_as(best)) for k in range(4)]
+    ref_1 = (m[0] + m[1]).unsqueeze(1)
+    ref_2 = 1 - ref_1
+
+    # normal from rectangle 2 to 1, reference face normal pointing out of
+    # the reference rectangle, towards the incident one
+    u = sum(m_k.unsqueeze(1) * a for m_k, a in zip(m, axes))
+    normal = u * Variable(_sign(_dot(d, u).data).unsqueeze(1))
+    ref_normal = normal * (1 - 2 * ref_1)
+    ref_pos = ref_1 * pos1 + ref_2 * pos2
+    # the reference face's half extent along the normal, its tangent axis
+    # and half length
+    ref_hn = m[0] * half_dims[0] + m[1] * half_dims[1] + m[2] * half_dims[2] + m[3] * half_dims[3]
+    ref_t = m[0].unsqueeze(1) * axes[1] + m[1].unsqueeze(1) * axes[0] + \
+        m[2].unsqueeze(1) * axes[3] + m[3].unsqueeze(1) * axes[2]
+    ref_ht = m[0] * half_dims[1] + m[1] * half_dims[0] + m[2] * half_dims[3] + m[3] * half_dims[2]
+    ref_center = ref_pos + ref_hn.unsqueeze(1) * ref_normal
+
+    # incident face, the most opposed to the reference normal (x on ties)
+    inc_pos = ref_1 * pos2 + ref_2 * pos1
+    inc_x = ref_1 * axes[2] + ref_2 * axes[0]
+    inc_y = ref_1 * axes[3] + ref_2 * axes[1]
+    ref_1 = ref_1.squeeze(1)
+    inc_hx = ref_1 * half_dims[2] + (1 - ref_1) * half_dims[0]
+    inc_hy = ref_1 * half_dims[3] + (1 - ref_1) * half_dims[1]
+    dot_x, dot_y = _dot(ref_normal, inc_x), _dot(ref_normal, inc_y)
+    face_x = Variable((dot_x.data.abs() >= dot_y.data.abs()).type_as(best))
+    sign_x = Variable(_sign(dot_x.data)).unsqueeze(1)
+    sign_y = Variable(_sign(dot_y.data)).unsqueeze(1)
+    fx = face_x.unsqueeze(1)
+    inc_normal = -fx * sign_x * inc_x - (1 - fx) * sign_y * inc_y
+    inc_hn = face_x * inc_hx + (1 - face_x) * inc_hy
+    inc_t = fx * inc_y + (1 - fx) * inc_x
+    inc_ht = face_x * inc_hy + (1 - face_x) * inc_hx
+    inc_center = inc_pos + inc_hn.unsqueeze(1) * inc_normal
+    v1 = inc_center + inc_ht.unsqueeze(1) * inc_t
+    edge = -2 * inc_ht.unsqueeze(1) * inc_t
+
+    # clip the incident face v1 + l edge, 0 <= l <= 1, to the reference
+    # face's sides (the incident face is never orthogonal to them)
+    a0 = _dot(v1 - ref_center, ref_t)
+    da = _dot(edge, ref_t)
+    l1 = (-ref_ht - a0) / da
+    l2 = (ref_ht - a0) / da
+    lo = torch.clamp(torch.min(l1, l2), 0, 1)
+    hi = torch.clamp(torch.max(l1, l2), 0, 1)
+    points = torch.cat([v1 + lo.unsqueeze(1) * edge, v1 + hi.unsqueeze(1) * edge])
+    valid = torch.cat([torch.ones(lo.size(0)).type_as(best).byte(), (hi.data > lo.data)])
+
+    # points on the incident rectangle and their projections on the
+    # reference face
+    ref_normal, ref_center = torch.cat([ref_normal, ref_normal]), torch.cat([ref_center, ref_center])
+    separations = _dot(points - ref_center, ref_normal)
+    ref_points = points - separations.unsqueeze(1) * ref_normal
+    ref_1 = torch.cat([ref_1, ref_1]).unsqueeze(1)
+    pos1, pos2 = torch.cat([pos1, pos1]), torch.cat([pos2, pos2])
+    p1 = ref_1 * (ref_points - pos1) + (1 - ref_1) * (points - pos1)
+    p2 = ref_1 * (points - pos2) + (1 - ref_1) * (ref_points - pos2)
+    return torch.cat([normal, normal]), p1, p2, -separations, valid
+
+
+def _dot(u, v):
+    """Row wise dot products of (n, DIM) u and v."""
+    return (u * v).sum(1)
+
+
+def _sign(t):
+    """Sign of the tensor t, with sign(0) = 1."""
+    return 2 * (t >= 0).type_as(t) - 1
@@ -3,7 +3,7 @@ import pygame
 import torch
 from torch.autograd import Variable
 
-from .utils import Indices, Params, cart_to_polar, polar_to_cart
+from .utils import Indices, Params
 
 
 X = Indices.X
@@ -19,11 +19,10 @@ class Joint:
         self.body2 = body2
         self.pos = Variable(Tensor(pos))
         self.pos1 = self.pos - self.body1.pos
-        self.r1, self.rot1 = cart_to_polar(self.pos1)
-        self.rot2 = None
+        # position in body1's frame
+        self.local_pos1 = torch.mv(self.body1.rotation.t(), self.pos1)
         if body2 is not None:
             self.pos2 = self.pos - self.body2.pos
-            self.r2, self.rot2 = cart_to_polar(self.pos2)
 
     def J(self):
         J1 = torch.cat([torch.cat([-self.pos1[Y], self.pos1[X]]).unsqueeze(1),
@@ -36,13 +35,11 @@ class Joint:
         return J1, J2
 
     def move(self, dt):
-        self.rot1 = self.rot1 + self.body1.v[0] * dt
-        if self.body2 is not None:
-            self.rot2 = self.rot2 + self.body2.v[0] * dt
+        # the joint follows body1, already moved
         self.update_pos()
 
     def update_pos(self):
-        self.pos1 = polar_to_cart(self.r1, self.rot1)
+        self.pos1 = torch.mv(self.body1.rotation, self.local_pos1)
         self.pos = self.body1.pos + self.pos1
         if self.body2 is not None:
             # keep position on body1 as reference
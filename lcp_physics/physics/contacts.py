@@ -0,0 +1,219 @@
+import torch
+from torch.autograd import Variable
+
+from .utils import Params
+
+
+DIM = Params.DIM
+
+Tensor = Params.TENSOR_TYPE
+
+
+class ContactSet:
+    """Structure-of-arrays storage for the contacts found in a collision pass.
+
+    Each contact has a normal (pointing from body 2 to body 1), the contact
+    arms from each body's center to its contact point, a penetration depth,
+    the indices of both bodies and a feature id identifying the contact within
+    its body pair. Body indices and features are written into preallocated
+    LongTensors, which grow geometrically.
+
+    The differentiable terms are not preallocated: writing them into
+    preallocated Variables would add an in-place copy of the whole buffer to
+    the graph per contact, and break the graphs built from a reused set.
+    append only keeps the Variables it is given, extend keeps its batch as a
+    chunk, and all of them are stacked once, when the set is read.
+    """
+    def __init__(self, capacity=Params.DEFAULT_CONTACT_CAPACITY):
+        self.capacity = capacity
+        self._bodies = torch.LongTensor(capacity, 2)
+        self._features = torch.LongTensor(capacity)
+        self.clear()
+
+    def __len__(self):
+        return self.n
+
+    def clear(self):
+        self.n = 0
+        # (normals, arms, penetrations) chunks, and the rows appended since
+        # the last chunk, not yet concatenated. New Variables are built on
+        # read, so graphs built from previous contact sets remain valid for
+        # backprop
+        self._chunks = []
+        self._rows = []
+        self._stacked = None
+
+    def append(self, normal, p1, p2, penetration, i1, i2, feature=0):
+        if self.n == self.capacity:
+            self._grow(2 * self.capacity)
+        i = self.n
+        self._rows.append((normal, p1, p2, penetration))
+        self._stacked = None
+        self._bodies[i, 0] = i1
+        self._bodies[i, 1] = i2
+        self._features[i] = feature
+        self.n += 1
+
+    def extend(self, normals, p1, p2, penetrations, i1, i2, features=None):
+        """Appends n contacts at once, from (n, DIM) normals and arms, (n)
+        penetrations and body indices (LongTensors) and optional features."""
+        n = normals.size(0)
+        if self.n + n > self.capacity:
+            self._grow(max(2 * self.capacity, self.n + n))
+        rows = slice(self.n, self.n + n)
+        self._flush_rows()
+        self._chunks.append((normals, torch.stack([p1, p2], 1), penetrations))
+        self._stacked = None
+        self._bodies[rows, 0] = i1
+        self._bodies[rows, 1] = i2
+        if features is None:
+            self._features[rows] = 0
+        else:
+            self._features[rows] = features
+        self.n += n
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        self._bodies = torch.cat([self._bodies, torch.LongTensor(extra, 2)])
+        self._features = torch.cat([self._features, torch.LongTensor(extra)])
+        self.capacity = capacity
+
+    def _flush_rows(self):
+        """Stacks the appended rows into a chunk, keeping the rows' order."""
+        if self._rows:
+            normals, p1, p2, penetrations = zip(*self._rows)
+            self._chunks.append((torch.stack(normals),
+                                 torch.stack([torch.stack(p1), torch.stack(p2)], 1),
+                                 torch.cat(penetrations).view(-1)))
+            self._rows = []
+
+    def _stack(self):
+        """Concatenates the chunks and rows added since the last read."""
+        if self._stacked is None:
+            self._flush_rows()
+            if not self._chunks:
+                empty = Variable(Tensor())
+                return empty, empty, empty
+            if len(self._chunks) == 1:
+                self._stacked = self._chunks[0]
+            else:
+                self._stacked = tuple(torch.cat(terms) for terms in zip(*self._chunks))
+                self._chunks = [self._stacked]
+        return self._stacked
+
+    @property
+    def normals(self):
+        return self._stack()[0]
+
+    @property
+    def arms(self):
+        return self._stack()[1]
+
+    @property
+    def penetrations(self):
+        return self._stack()[2]
+
+    @property
+    def bodies(self):
+        return self._bodies[:self.n]
+
+    @property
+    def features(self):
+        return self._features[:self.n]
+
+    def subset(self, idxs, body_map=None):
+        """Returns a new ContactSet with the contacts at idxs. If body_map is
+        given, body indices are translated through it."""
+        contacts = ContactSet(max(len(idxs), 1))
+        contacts.n = len(idxs)
+        var_idxs = Variable(idxs)
+        contacts._chunks = [(self.normals.index_select(0, var_idxs),
+                             self.arms.index_select(0, var_idxs),
+                             self.penetrations.index_select(0, var_idxs))]
+        bodies = self.bodies.index_select(0, idxs)
+        if body_map is not None:
+            bodies = body_map.index_select(0, bodies.view(-1)).view(-1, 2)
+        contacts._bodies = bodies
+        contacts._features = self.features.index_select(0, idxs)
+        return contacts
+
+    def max_penetration(self):
+        if self.n == 0:
+            return -float('inf')
+        return self.penetrations.data.max()
+
+
+class ContactCache:
+    """Contact manifolds of body pairs from previous collision passes.
+
+    Contacts are stored by (body1, body2, feature) in the bodies' frames,
+    with the relative pose of the pair when they were computed. While the
+    pair's relative pose stays within the tolerances, its contacts are
+    refreshed from the current body poses instead of running the narrow
+    phase again, keeping their feature ids. A pair's entries are evicted when
+    the narrow phase finds no contacts for it, or when its refreshed contacts
+    are all separated.
+
+    Refreshed contacts are differentiable with respect to the bodies' poses
+    only, the stored arms are constants: gradients with respect to dims and
+    radii are lost on cache hits.
+    """
+    def __init__(self, lin_tol=Params.CONTACT_CACHE_LIN_TOL,
+                 ang_tol=Params.CONTACT_CACHE_ANG_TOL):
+        self.lin_tol = lin_tol
+        self.ang_tol = ang_tol
+        # (body1, body2) -> (relative position, relative rotation, num contacts)
+        self.poses = {}
+        # (body1, body2, feature) -> (normal in body1's frame, arm in body1's
+        # frame, arm in body2's frame, separation offset)
+        self.contacts = {}
+
+    def lookup(self, b1, b2, i1, i2, eps):
+        """Returns the refreshed (normal, p1, p2, penetration) contacts of the
+        pair, or None if there is no valid cached manifold."""
+        pose = self.poses.get((i1, i2))
+        if pose is None:
+            return None
+        rel_pos, rel_rot = self._relative_pose(b1, b2)
+        if (rel_pos - pose[0]).norm() > self.lin_tol or \
+                abs(rel_rot - pose[1]) > self.ang_tol:
+            return None
+        rotation1, rotation2 = b1.rotation, b2.rotation
+        pts = []
+        for feature in range(pose[2]):
+            normal, arm1, arm2, offset = self.contacts[(i1, i2, feature)]
+            normal = torch.mv(rotation1, Variable(normal))
+            p1 = torch.mv(rotation1, Variable(arm1))
+            p2 = torch.mv(rotation2, Variable(arm2))
+            separation = ((b1.pos + p1 - b2.pos - p2) * normal).sum()
+            pts.append((normal, p1, p2, Variable(offset) - separation))
+        if max(pt[3].data[0] for pt in pts) < -eps:
+            # the pair separated, its manifold is of no further use
+            self.evict(i1, i2)
+            return []
+        return pts
+
+    def store(self, b1, b2, i1, i2, pts):
+        """Caches the contacts found by the narrow phase for a pair."""
+        self.evict(i1, i2)
+        rel_pos, rel_rot = self._relative_pose(b1, b2)
+        self.poses[(i1, i2)] = (rel_pos, rel_rot, len(pts))
+        # inverse rotations, to the bodies' frames
+        inv_rotation1, inv_rotation2 = b1.rotation.data.t(), b2.rotation.data.t()
+        for feature, (normal, p1, p2, penetration) in enumerate(pts):
+            separation = ((b1.pos + p1 - b2.pos - p2) * normal).sum().data
+            self.contacts[(i1, i2, feature)] = (
+                torch.mv(inv_rotation1, normal.data), torch.mv(inv_rotation1, p1.data),
+                torch.mv(inv_rotation2, p2.data), penetration.data + separation)
+
+    def evict(self, i1, i2):
+        """Forgets the contacts of a pair, e.g. once it separated."""
+        pose = self.poses.pop((i1, i2), None)
+        if pose is not None:
+            for feature in range(pose[2]):
+                del self.contacts[(i1, i2, feature)]
+
+    def _relative_pose(self, b1, b2):
+        """Position and rotation of b2 in b1's frame."""
+        rel_pos = torch.mv(b1.rotation.data.t(), (b2.pos - b1.pos).data)
+        return rel_pos, b2.rot.data[0] - b1.rot.data[0]
@@ -11,8 +11,8 @@ from scipy.sparse.linalg.dsolve.linsolve import splu, spsolve
 import numpy as np
 
 from .utils import Params
-from lcp_physics.lcp.lcp import LCPFunction
-from lcp_physics.lcp.solvers.batch_pdipm import forward, KKTSolvers, pre_factor_kkt
+from lcp_physics.lcp.lcp import LCPFunction, LCPSolvers
+from lcp_physics.lcp.solvers.batch_pdipm import forward, KKTSolvers, KKTWorkspace, pre_factor_kkt
 
 
 Tensor = Params.TENSOR_TYPE
@@ -25,10 +25,60 @@ class Engine:
     def solve_dynamics(self, world, dt, stabilization=False):
         raise NotImplementedError
 
+    def batch_solve_dynamics(self, worlds, dt):
+        raise NotImplementedError
+
+    def reset(self):
+        """Clears any state kept across solves."""
+        pass
+
+    def contact_rhs(self, world, Jc):
+        """Returns the right side of the contact (restitution) and friction
+        constraints, including the fixed bodies' known velocities."""
+        hc = -torch.matmul(Jc, world.v * -world.restitutions)
+        return self.fixed_contact_rhs(world, hc)
+
+    def fixed_contact_rhs(self, world, hc):
+        """Adds the fixed bodies' terms to the right side hc of the contact
+        constraints, returns it with the friction constraints' right side."""
+        hf = Variable(Tensor(world.fric_dirs * hc.size(0)).zero_())
+        if world.fixed_v is not None:
+            # Fixed bodies' velocities are known, move their terms to the right side
+            fixed_v = world.fixed_v
+            hc = hc + world.Jc_fixed(fixed_v * world.fixed_restitutions) + \
+                world.Jc_fixed(fixed_v) / 2
+            hf = hf + world.Jf_fixed(fixed_v)
+        return hc, hf
+
+    def fixed_rhs(self, world, neq):
+        """Returns the fixed bodies' contribution to the joint velocities, the
+        equality constraints' right side in the LCP (which solves for -v)."""
+        if world.fixed_v is None:
+            return Variable(Tensor(neq).zero_())
+        return world.Je_fixed(world.fixed_v)
+
 
 class PdipmEngine(Engine):
-    def __init__(self):
+    def __init__(self, warm_start=Params.WARM_START, kkt_solver=Params.DEFAULT_KKT_SOLVER,
+                 solver=Params.DEFAULT_LCP_SOLVER, equilibrate=Params.EQUILIBRATE):
         self.lcp_solver = LCPFunction
+        self.equilibrate = equilibrate
+        if isinstance(solver, str):
+            solver = LCPSolvers[solver]
+        self.solver = solver
+        self.warm_start = warm_start
+        if isinstance(kkt_solver, str):
+            kkt_solver = KKTSolvers[kkt_solver]
+        self.kkt_solver = kkt_solver
+        self.reset()
+
+    def reset(self):
+        # Solver buffers, reused across this engine's (i.e. world's) solves
+        self.workspace = KKTWorkspace()
+        # Last solutions per contact / joint id, for the current and previous t
+        self._solution_t = None
+        self._solution = {}
+        self._prev_solution = {}
 
     def solve_dynamics(self, world, dt, stabilization=False):
         t = world.t
@@ -38,61 +88,35 @@ class PdipmEngine(Engine):
         neq = Je.size(0) if Je.ndimension() > 0 else 0
 
         f = world.apply_forces(t)
-        u = torch.matmul(world.M, world.v) + dt * f
-        if neq > 0:
-            u = torch.cat([u, Variable(Tensor(neq).zero_())])
+        u = world.M.mv(world.v) + dt * f
         if not world.collisions:
             # No contact constraints, no need to solve LCP
-            P = world.M
             if neq > 0:
-                P = torch.cat([torch.cat([P, -Je.t()], dim=1),
-                               torch.cat([Je, Variable(Tensor(neq, neq).zero_())],
-                                         dim=1)])
-            try:
-                x = torch.matmul(torch.inverse(P), u)  # Eq. 2.41
-            except RuntimeError:  # XXX
-                print('\nRegularizing singular matrix.\n')
-                x = torch.matmul(torch.inverse(P + Variable(torch.eye(P.size(0), P.size(1)).type_as(P.data) * 1e-10)), u)
+                new_v = self.solve_equality(world.M, u, Je, -self.fixed_rhs(world, neq))
+            else:
+                new_v = self.solve_equality(world.M, u)
         else:
             # Solve Mixed LCP (Kline 2.7.2)
-            # TODO Organize
             Jc = world.Jc()
-            v = -torch.matmul(Jc, world.v * -world.restitutions)
-            TM = world.M.unsqueeze(0)
+            M, G, h, F = self.lcp_terms(world, Jc)
             if neq > 0:
                 TJe = Je.unsqueeze(0)
-                b = Variable(Tensor(Je.size(0)).unsqueeze(0).zero_())
+                b = self.fixed_rhs(world, neq).unsqueeze(0)
             else:
                 TJe = Variable(Tensor())
                 b = Variable(None)
-            TJc = Jc.unsqueeze(0) / 2
-            Tu = u[:world.M.size(0)].unsqueeze(0)
-            Tv = v.unsqueeze(0)
-            Q_LU = S_LU = R = None
-            # Q_LU, S_LU, R = pre_factor_kkt(TM, TJc, TJe)
-            #######
-            E = world.E()
-            mu = world.mu()
-            Jf = world.Jf()
-            TJf = Jf.unsqueeze(0)
-            TE = E.unsqueeze(0)
-            Tmu = mu.unsqueeze(0)
-            G = torch.cat([TJc, TJf,
-                           Variable(Tensor(TJf.size(0), Tmu.size(1), TJf.size(2))
-                                    .zero_())], dim=1)
-            F = Variable(Tensor(G.size(1), G.size(1)).zero_().unsqueeze(0))
-            F[:, TJc.size(1):-TE.size(2), -TE.size(2):] = TE
-            F[:, -Tmu.size(1):, :Tmu.size(2)] = Tmu
-            F[:, -Tmu.size(1):, Tmu.size(2):Tmu.size(2) + TE.size(1)] = \
-                -TE.transpose(1, 2)
-            h = torch.cat([Tv,
-                           Variable(Tensor(Tv.size(0), TJf.size(1) + Tmu.size(1))
-                                    .zero_())], 1)
-            x = -self.lcp_solver()(TM, Tu, G, h, TJe, b, F)
-
-        new_v = x[:world.vec_len * len(world.bodies)].squeeze(0)
+            if self.warm_start:
+                solver = self.make_lcp_solver(warm_start=self.initial_guess(world, neq))
+            else:
+                solver = self.make_lcp_solver()
+            x = -solver(M.unsqueeze(0), u.unsqueeze(0), G.unsqueeze(0),
+                        h.unsqueeze(0), TJe, b, F.unsqueeze(0))
+            new_v = x[:world.vec_len * len(world.bodies)].squeeze(0)
+            if self.warm_start:
+                self.store_solution(world, solver, neq)
 
         # Post-stabilization
+        # XXX Static bodies' prescribed motion is not accounted for
         if stabilization:
             ge = torch.matmul(Je, new_v)
             if Jc is not None:
@@ -103,29 +127,414 @@ class PdipmEngine(Engine):
             new_v = (new_v - dp).squeeze(0)  # XXX Is sign correct?
         return new_v
 
+    def batch_solve_dynamics(self, worlds, dt):
+        """Solves the dynamics of worlds sharing the same bodies and joints
+        (but e.g. different masses, friction, forces or states) with a single
+        batched LCP. Contact constraints are padded to the largest contact
+        count in the batch with inactive rows.
+        """
+        nz = worlds[0].vec_len * len(worlds[0].bodies)
+        Je = [w.Je() for w in worlds]
+        neq = Je[0].size(0) if Je[0].ndimension() > 0 else 0
+        u = [w.M.mv(w.v) + dt * w.apply_forces(w.t) for w in worlds]
+        if not any(w.collisions for w in worlds):
+            # No contact constraints, no need to solve LCP
+            if neq == 0:
+                return [self.solve_equality(w.M, w_u) for w, w_u in zip(worlds, u)]
+            return [self.solve_equality(w.M, w_u, w_Je, -self.fixed_rhs(w, neq))
+                    for w, w_u, w_Je in zip(worlds, u, Je)]
+
+        terms = [self.lcp_terms(w, w.Jc()) if w.collisions else None
+                 for w in worlds]
+        nineq = max(t[1].size(0) for t in terms if t is not None)
+        Ms, Gs, hs, Fs = [], [], [], []
+        for w, t in zip(worlds, terms):
+            if t is None:
+                # Only inactive rows for worlds without contacts
+                M = w.M.dense()
+                G = Variable(Tensor(nineq, nz).zero_())
+                h = Variable(Tensor(nineq).fill_(1))
+                F = Variable(Tensor(nineq, nineq).zero_())
+            else:
+                M, G, h, F = t
+                G, h, F = self.pad_inequalities(G, h, F, nineq)
+            Ms.append(M)
+            Gs.append(G)
+            hs.append(h)
+            Fs.append(F)
+        if neq > 0:
+            TJe = torch.stack(Je)
+            b = torch.stack([self.fixed_rhs(w, neq) for w in worlds])
+        else:
+            TJe = Variable(Tensor())
+            b = Variable(None)
+        x = -self.make_lcp_solver()(
+            torch.stack(Ms), torch.stack(u), torch.stack(Gs),
+            torch.stack(hs), TJe, b, torch.stack(Fs))
+        return [x[i] for i in range(len(worlds))]
+
+    def make_lcp_solver(self, **kwargs):
+        return self.lcp_solver(solver=self.solver, kkt_solver=self.kkt_solver,
+                               workspace=self.workspace, equilibrate=self.equilibrate,
+                               **kwargs)
+
+    def initial_guess(self, world, neq):
+        """Builds the LCP's initial (x, s, z, y) from the solution of the
+        previous step, matching contacts and joints by their ids. Contacts new
+        in this step start at 1. Returns None (cold start) if no contact
+        persisted."""
+        self._roll_solutions(world.t)
+        prev = self._prev_solution
+        ids = world.contact_ids()
+        if not any(i in prev for i in ids):
+            return None
+        s = Tensor(len(ids), world.fric_dirs + 2).fill_(1)
+        z = Tensor(len(ids), world.fric_dirs + 2).fill_(1)
+        for k, i in enumerate(ids):
+            if i in prev:
+                s[k], z[k] = prev[i]
+        y = None
+        if neq > 0:
+            zeros = Tensor(Params.DIM).zero_()
+            y = torch.cat([prev.get(j[0], zeros) for j in world.joints]).unsqueeze(0)
+        # v of the previous step, the LCP solves for -v
+        x = -world.v.data.unsqueeze(0)
+        return x, self._contact_rows(s).unsqueeze(0), self._contact_rows(z).unsqueeze(0), y
+
+    def store_solution(self, world, solver, neq):
+        """Stores the slacks and multipliers of the last solve per contact and
+        joint id, for initial_guess in the next step."""
+        self._roll_solutions(world.t)
+        s = self._contact_columns(solver.slacks.squeeze(0), len(world.collisions), world.fric_dirs)
+        z = self._contact_columns(solver.lams.squeeze(0), len(world.collisions), world.fric_dirs)
+        for k, i in enumerate(world.contact_ids()):
+            self._solution[i] = (s[k], z[k])
+        if neq > 0:
+            y = solver.nus.squeeze(0)
+            for k, j in enumerate(world.joints):
+                self._solution[j[0]] = y[k * Params.DIM:(k + 1) * Params.DIM]
+
+    def _roll_solutions(self, t):
+        # Solutions stored at an earlier t become the previous step's; retries
+        # of a step (same t) keep matching against the same previous solution
+        if t != self._solution_t:
+            self._prev_solution, self._solution = self._solution, {}
+            self._solution_t = t
+
+    def _contact_rows(self, t):
+        """Lays out (contacts x (fric_dirs + 2)) values as inequality rows:
+        contact, friction and friction cone rows."""
+        return torch.cat([t[:, 0], t[:, 1:-1].contiguous().view(-1), t[:, -1]])
+
+    def _contact_columns(self, t, num_contacts, fric_dirs):
+        """Inverse of _contact_rows."""
+        num_fric = num_contacts * fric_dirs
+        return torch.cat([t[:num_contacts].unsqueeze(1),
+                          t[num_contacts:num_contacts + num_fric].contiguous().view(-1, fric_dirs),
+                          t[num_contacts + num_fric:].unsqueeze(1)], 1)
+
+    def solve_equality(self, M, u, Je=None, b=None):
+        """Solves [M, -Je^T; Je, 0] [v; l] = [u; b] (Eq. 2.41) for v, using the
+        closed form inverse of the block diagonal M. b defaults to 0."""
+        invM = M.inverse()
+        v = invM.mv(u)
+        if Je is not None:
+            invM_JeT, invS = self.joint_schur(invM, Je)
+            r = -torch.matmul(Je, v)
+            if b is not None:
+                r = r + b
+            v = v + torch.matmul(invM_JeT, torch.matmul(invS, r))
+        return v
+
+    def joint_schur(self, invM, Je):
+        """Eliminates v from the equality constraints, returns M^-1 Je^T and the
+        inverse of the (joints x joints) Schur complement Je M^-1 Je^T."""
+        invM_JeT = invM.mm(Je.t())
+        S = torch.matmul(Je, invM_JeT)
+        try:
+            invS = torch.inverse(S)
+        except RuntimeError:  # XXX
+            print('\nRegularizing singular matrix.\n')
+            invS = torch.inverse(S + Variable(torch.eye(S.size(0), S.size(1)).type_as(S.data) * 1e-10))
+        return invM_JeT, invS
+
+    def lcp_terms(self, world, Jc):
+        """Builds the (unbatched) mixed LCP terms for a world with contacts.
+
+        Returns (M, G, h, F), where the inequalities in G are stacked as
+        contact, friction and friction cone (mu) rows.
+        """
+        # TODO Organize
+        hc, hf = self.contact_rhs(world, Jc)
+        # XXX The LCP solver still takes M as a dense matrix
+        M = world.M.dense()
+        Jc = Jc / 2
+        E = world.E()
+        mu = world.mu()
+        Jf = world.Jf()
+        G = torch.cat([Jc, Jf,
+                       Variable(Tensor(mu.size(0), Jf.size(1)).zero_())])
+        F = Variable(Tensor(G.size(0), G.size(0)).zero_())
+        F[Jc.size(0):-E.size(1), -E.size(1):] = E
+        F[-mu.size(0):, :mu.size(1)] = mu
+        F[-mu.size(0):, mu.size(1):mu.size(1) + E.size(0)] = -E.t()
+        h = torch.cat([hc, hf, Variable(Tensor(mu.size(0)).zero_())])
+        return M, G, h, F
+
+    def pad_inequalities(self, G, h, F, nineq):
+        """Pads the inequality constraints with inactive rows (G = 0, F = 0,
+        h = 1), whose slacks stay at 1 and multipliers at 0."""
+        npad = nineq - G.size(0)
+        if npad == 0:
+            return G, h, F
+        G = torch.cat([G, Variable(Tensor(npad, G.size(1)).zero_())])
+        h = torch.cat([h, Variable(Tensor(npad).fill_(1))])
+        F_ = Variable(Tensor(nineq, nineq).zero_())
+        F_[:F.size(0), :F.size(1)] = F
+        return G, h, F_
+
     def post_stabilization(self, M, Je, Jc, ge, gc):
         u = torch.cat([Variable(Tensor(Je.size(1)).zero_()), ge])
         if Jc is None:
-            P = torch.cat([torch.cat([M, Je.t()], dim=1),
-                           torch.cat([Je, Variable(Tensor(Je.size(0), Je.size(0)).zero_())],
-                                     dim=1)])
-            try:
-                x = torch.matmul(torch.inverse(P), u)
-            except RuntimeError:  # XXX
-                print('\nRegularizing singular matrix in stabilization.\n')
-                x = torch.matmul(torch.inverse(P + Variable(torch.eye(P.size(0), P.size(1)).type_as(P.data) * 1e-10)), u)
+            # [M, Je^T; Je, 0] [dp; l] = [0; ge], with l negated
+            x = self.solve_equality(M, Variable(Tensor(Je.size(1)).zero_()), Je, ge)
         else:
             v = gc
-            TM = M.unsqueeze(0)
+            TM = M.dense().unsqueeze(0)
             TJe = Je.unsqueeze(0)
             TJc = Jc.unsqueeze(0)
             Th = u[:M.size(0)].unsqueeze(0)
             Tb = u[M.size(0):].unsqueeze(0)
             Tv = v.unsqueeze(0)
             F = Variable(Tensor(TJc.size(1), TJc.size(1)).zero_().unsqueeze(0))
-            Q_LU = S_LU = R = None
-            # Q_LU, S_LU, R = pre_factor_kkt(TM, TJc, TJe)
-            x = self.lcp_solver()(TM, Th, TJc, Tv, TJe, Tb, F)
+            x = self.make_lcp_solver()(TM, Th, TJc, Tv, TJe, Tb, F)
         # x = np.asarray(x).ravel()
         dp = x[:M.size(0)]
         return dp
+
+
+class PgsEngine(Engine):
+    """Projected Gauss-Seidel solver, for fast approximate stepping.
+
+    Sweeps over the joint, contact and friction constraints updating one
+    impulse at a time: joint impulses are free, contact impulses are kept
+    non negative and friction impulses inside the friction cone
+    |l_t| <= mu l_n. Each sweep is linear in the number of constraints, and
+    sweeps stop after iterations or once the largest impulse change is below
+    tol. Impulses are scaled as PdipmEngine's LCP multipliers, so both
+    engines solve the same problem. The result is not differentiable, and
+    post-stabilization is not supported.
+    """
+    def __init__(self, iterations=Params.PGS_ITERATIONS, tol=Params.PGS_TOL):
+        self.iterations = iterations
+        self.tol = tol
+
+    def solve_dynamics(self, world, dt, stabilization=False):
+        if stabilization:
+            raise NotImplementedError('PgsEngine does not support post-stabilization')
+        num_bodies = len(world.bodies)
+        vec_len = world.vec_len
+        u = (world.M.mv(world.v) + dt * world.apply_forces(world.t)).data
+        inv_mass = world.M.inverse().blocks.data
+        # unconstrained velocities, updated along with each impulse. The extra
+        # last body stands for fixed bodies (and joints' missing body), whose
+        # row blocks are 0
+        v = torch.bmm(inv_mass, u.view(num_bodies, vec_len, 1)).view(num_bodies, vec_len)
+        v = torch.cat([v, v.new(1, vec_len).zero_()])
+        inv_mass = torch.cat([inv_mass, inv_mass.new(1, vec_len, vec_len).zero_()])
+
+        # constraint rows: joints, then contacts, then one friction row per
+        # contact. Friction directions are (dir1, -dir1), solved as one signed
+        # impulse along dir1. Each row is kept as the blocks of its two bodies
+        blocks, bodies, rhs = [], [], []
+        Je = world.Je()
+        num_joint_rows = Je.size(0) if Je.ndimension() > 0 else 0
+        if num_joint_rows > 0:
+            joint_bodies = torch.LongTensor([[i1, i2 if i2 is not None else num_bodies]
+                                             for _, i1, i2 in world.joints
+                                             for _ in range(Params.DIM)]).clamp(max=num_bodies)
+            blocks.append(self._dense_blocks(Je.data, joint_bodies, num_bodies))
+            bodies.append(joint_bodies)
+            rhs.append(self.fixed_rhs(world, num_joint_rows).data)
+        num_contacts = len(world.collisions) if world.collisions else 0
+        mu = []
+        if num_contacts > 0:
+            # the contact rows are assembled from their bodies' blocks, fixed
+            # bodies' blocks are moved to the right side
+            contact_bodies = world.collisions.bodies
+            free = (contact_bodies < num_bodies).type_as(v).unsqueeze(2)
+            contact_bodies = contact_bodies.clamp(max=num_bodies)
+            Jc = world.Jc_blocks().data * free
+            restitution_v = (world.v * world.restitutions).data.view(num_bodies, vec_len)
+            restitution_v = torch.cat([restitution_v, v.new(1, vec_len).zero_()])
+            hc = (Jc * restitution_v.index_select(0, contact_bodies.view(-1))
+                  .view(num_contacts, 2, vec_len)).view(num_contacts, -1).sum(1)
+            hc, hf = self.fixed_contact_rhs(world, Variable(hc))
+            fric_rows = torch.arange(0, num_contacts).long() * world.fric_dirs
+            # contact rows are halved in the LCP, see lcp_terms
+            blocks += [Jc / 2, world.Jf_blocks().data.index_select(0, fric_rows) * free]
+            bodies += [contact_bodies, contact_bodies]
+            rhs += [hc.data, hf.data.index_select(0, fric_rows)]
+            mu = torch.diag(world.mu()).data.tolist()
+        if not blocks:
+            return Variable(v[:num_bodies].contiguous().view(-1))
+        blocks, bodies = torch.cat(blocks), torch.cat(bodies)
+        inv_mass_blocks, eff_mass = self._rows(blocks, bodies, inv_mass)
+        rhs = torch.cat(rhs).tolist()
+        eff_mass = eff_mass.tolist()
+
+        impulses = [0.] * len(rhs)
+        for _ in range(self.iterations):
+            max_delta = 0.
+            for r in range(num_joint_rows):
+                delta = -(self._residual(r, bodies, blocks, v) + rhs[r]) / eff_mass[r]
+                impulses[r] += delta
+                v.index_add_(0, bodies[r], inv_mass_blocks[r] * delta)
+                max_delta = max(max_delta, abs(delta))
+            for k in range(num_contacts):
+                r = num_joint_rows + k
+                impulse = max(impulses[r] - (self._residual(r, bodies, blocks, v) + rhs[r]) /
+                              eff_mass[r], 0.)
+                delta = impulse - impulses[r]
+                impulses[r] = impulse
+                v.index_add_(0, bodies[r], inv_mass_blocks[r] * delta)
+                max_delta = max(max_delta, abs(delta))
+
+                bound = mu[k] * impulse
+                f = r + num_contacts
+                impulse = impulses[f] - (self._residual(f, bodies, blocks, v) + rhs[f]) / eff_mass[f]
+                impulse = min(max(impulse, -bound), bound)
+                delta = impulse - impulses[f]
+                impulses[f] = impulse
+                v.index_add_(0, bodies[f], inv_mass_blocks[f] * delta)
+                max_delta = max(max_delta, abs(delta))
+            if max_delta < self.tol:
+                break
+        return Variable(v[:num_bodies].contiguous().view(-1))
+
+    def batch_solve_dynamics(self, worlds, dt):
+        return [self.solve_dynamics(w, dt) for w in worlds]
+
+    def _dense_blocks(self, J, bodies, num_bodies):
+        """Splits the rows of a dense Jacobian J into the (rows x 2 x vec_len)
+        blocks of their (rows x 2) bodies. Blocks of the extra last body
+        (index num_bodies) are 0."""
+        num_rows, vec_len = J.size(0), J.size(1) // num_bodies
+        J = torch.cat([J.view(num_rows, num_bodies, vec_len),
+                       J.new(num_rows, 1, vec_len).zero_()], 1)
+        return J.gather(1, bodies.unsqueeze(2).expand(num_rows, 2, vec_len).contiguous())
+
+    def _rows(self, blocks, bodies, inv_mass):
+        """Returns M^-1 times the (rows x 2 x vec_len) Jacobian blocks of the
+        rows' (rows x 2) bodies, and the rows' effective masses J M^-1 J^T."""
+        num_rows, vec_len = blocks.size(0), blocks.size(2)
+        inv_mass_blocks = torch.bmm(inv_mass.index_select(0, bodies.view(-1)),
+                                    blocks.view(-1, vec_len, 1)).view(num_rows, 2, vec_len)
+        eff_mass = (blocks * inv_mass_blocks).view(num_rows, -1).sum(1)
+        return inv_mass_blocks, eff_mass
+
+    def _residual(self, r, bodies, blocks, v):
+        """J v for row r."""
+        return (blocks[r] * v.index_select(0, bodies[r])).sum()
+
+
+class DelassusEngine(PdipmEngine):
+    """Solves the contact LCP over the contact impulses only.
+
+    Velocities are eliminated with the closed form inverse of the block
+    diagonal M, and joint impulses with the joints' Schur complement, leaving
+    the Delassus matrix N = G W G^T + F, where W is M^-1 projected onto the
+    joint constraints. The LCP's size then depends on the number of contacts
+    instead of the number of bodies. N is singular as soon as there are more
+    contact rows than degrees of freedom, it is regularized by reg_eps I
+    (i.e. a small constraint compliance) before being factored. Batched
+    solves pad each world's N with inactive rows, as PdipmEngine pads G.
+    N is not symmetric (F's friction blocks are not), it is passed as the
+    LCP's Q, whose backward solves the transposed system and does not
+    symmetrize dQ.
+    """
+    def __init__(self, warm_start=Params.WARM_START, kkt_solver=Params.DEFAULT_KKT_SOLVER,
+                 solver=Params.DEFAULT_LCP_SOLVER, equilibrate=Params.EQUILIBRATE,
+                 reg_eps=Params.DELASSUS_REG_EPS):
+        super().__init__(warm_start=warm_start, kkt_solver=kkt_solver, solver=solver,
+                         equilibrate=equilibrate)
+        self.reg_eps = reg_eps
+
+    def solve_dynamics(self, world, dt, stabilization=False):
+        Je = world.Je()
+        new_v, Jc, N, q, W_GT = self.delassus_terms(world, Je, dt)
+        if N is not None:
+            lam = self.solve_delassus(N.unsqueeze(0), q.unsqueeze(0))
+            new_v = new_v + torch.matmul(W_GT, lam.squeeze(0))
+
+        # Post-stabilization
+        if stabilization:
+            ge = torch.matmul(Je, new_v)
+            if Jc is not None:
+                gc = torch.matmul(Jc, new_v) + torch.matmul(Jc, new_v * -world.restitutions)
+            else:
+                gc = None
+            dp = self.post_stabilization(world.M, Je, Jc, ge, gc)
+            new_v = (new_v - dp).squeeze(0)  # XXX Is sign correct?
+        return new_v
+
+    def batch_solve_dynamics(self, worlds, dt):
+        """Solves the worlds' Delassus LCPs as a single batched LCP, padded to
+        the largest contact count with inactive rows (N = I, q = 1), whose
+        impulses stay at 0."""
+        terms = [self.delassus_terms(w, w.Je(), dt) for w in worlds]
+        new_vs = [t[0] for t in terms]
+        contact_terms = [(k, t) for k, t in enumerate(terms) if t[2] is not None]
+        if not contact_terms:
+            return new_vs
+        nineq = max(t[2].size(0) for _, t in contact_terms)
+        Ns, qs = [], []
+        for _, (_, _, N, q, _) in contact_terms:
+            npad = nineq - N.size(0)
+            if npad > 0:
+                N_ = Variable(torch.eye(nineq).type_as(N.data))
+                N_[:N.size(0), :N.size(1)] = N
+                N = N_
+                q = torch.cat([q, Variable(Tensor(npad).fill_(1))])
+            Ns.append(N)
+            qs.append(q)
+        lams = self.solve_delassus(torch.stack(Ns), torch.stack(qs))
+        for i, (k, (_, _, N, _, W_GT)) in enumerate(contact_terms):
+            new_vs[k] = new_vs[k] + torch.matmul(W_GT, lams[i, :N.size(0)])
+        return new_vs
+
+    def delassus_terms(self, world, Je, dt):
+        """Returns the velocities without contacts (joints only), and if the
+        world has contacts Jc, the Delassus LCP's N and q, and W G^T, mapping
+        contact impulses to velocity changes. The contact terms are None
+        otherwise."""
+        neq = Je.size(0) if Je.ndimension() > 0 else 0
+        b = -self.fixed_rhs(world, neq) if neq > 0 else None
+        u = world.M.mv(world.v) + dt * world.apply_forces(world.t)
+        new_v = self.solve_equality(world.M, u, Je if neq > 0 else None, b)
+        if not world.collisions:
+            return new_v, None, None, None, None
+        Jc = world.Jc()
+        _, G, h, F = self.lcp_terms(world, Jc)
+        invM = world.M.inverse()
+        invM_GT = invM.mm(G.t())
+        if neq > 0:
+            invM_JeT, invS = self.joint_schur(invM, Je)
+            W_GT = invM_GT - torch.matmul(invM_JeT, torch.matmul(invS, torch.matmul(Je, invM_GT)))
+        else:
+            W_GT = invM_GT
+        N = torch.matmul(G, W_GT) + F
+        q = h + torch.matmul(G, new_v)
+        return new_v, Jc, N, q, W_GT
+
+    def solve_delassus(self, N, q):
+        """Solves the batch of LCP(N, q) for the impulses l, as mixed LCPs
+        N_reg l + q - w = 0 with w the multipliers of the inequalities
+        -l + s = 0, s >= 0."""
+        nBatch, nineq = q.size()
+        I = Variable(torch.eye(nineq).type_as(N.data).repeat(nBatch, 1, 1))
+        N = N + self.reg_eps * I
+        return self.make_lcp_solver()(
+            N, q, -I, Variable(Tensor(nBatch, nineq).zero_()),
+            Variable(Tensor()), Variable(None),
+            Variable(Tensor(nBatch, nineq, nineq).zero_()))
@@ -26,7 +26,33 @@ class Params:
     DEFAULT_DT = 1.0 / DEFAULT_FPS
 
     DEFAULT_ENGINE = 'PdipmEngine'
+    # LCP solver (see LCPSolvers) and KKT system solver (see KKTSolvers, for
+    # the interior point solver) used by PdipmEngine. LU_PARTIAL factors Q
+    # once per solve and only the nineq x nineq D dependent block at each
+    # iteration, where LU_FULL refactors the whole KKT system.
+    # XXX Not yet timed against LU_FULL, run demos/kkt_benchmark.py
+    DEFAULT_LCP_SOLVER = 'PDIPM_BATCHED'
+    DEFAULT_KKT_SOLVER = 'LU_PARTIAL'
+    # Regularization of DelassusEngine's Delassus matrix
+    DELASSUS_REG_EPS = 1e-6
+    # PgsEngine's maximum number of sweeps and impulse change tolerance
+    PGS_ITERATIONS = 30
+    PGS_TOL = 1e-6
     DEFAULT_COLLISION = 'DiffCollisionHandler'
+    # Broad phase finding the candidate pairs for the collision handler,
+    # OdeBroadPhase (ODE's hash space) or SweepAndPrune
+    DEFAULT_BROAD_PHASE = 'OdeBroadPhase'
+
+    # Initial number of contacts preallocated per contact set
+    DEFAULT_CONTACT_CAPACITY = 32
+
+    # Contact manifold cache: a body pair's contacts are refreshed from the
+    # previous collision pass instead of recomputed while the pair's relative
+    # pose moved less than these tolerances. Cached contacts carry no gradients
+    # with respect to the bodies' dims and radii
+    CONTACT_CACHE = False
+    CONTACT_CACHE_LIN_TOL = 0.05
+    CONTACT_CACHE_ANG_TOL = 1e-3
 
     # Tensor type
     TENSOR_TYPE = torch.DoubleTensor
@@ -34,6 +60,25 @@ class Params:
     # Post stabilization flag
     POST_STABILIZATION = False
 
+    # Start the LCP solver from the previous step's solution, matched through
+    # persistent contact ids
+    WARM_START = False
+    # Equilibrate (Ruiz scaling) the LCPs before solving them, for pixel scale
+    # scenes whose KKT systems are badly scaled
+    EQUILIBRATE = False
+
+    # Solve each group of bodies connected by contacts or joints separately
+    CONTACT_ISLANDS = False
+
+    # Sleeping: islands whose bodies' velocities stay below the thresholds
+    # for SLEEP_TIME are frozen until touched by an awake body or pushed by
+    # a change in their applied forces. Off by default, since sleeping
+    # bodies do not propagate gradients.
+    SLEEP = False
+    SLEEP_LIN_VEL = 1.
+    SLEEP_ANG_VEL = 0.01
+    SLEEP_TIME = 0.5
+
     def __init__(self):
         pass
 
@@ -66,6 +111,84 @@ class Recorder:
             self.prev_t += self.dt
 
 
+class BlockDiag:
+    """Block diagonal matrix stored as the (n x k x k) tensor of its blocks.
+
+    Products and inverses are computed block by block, so their cost grows
+    linearly with the number of blocks instead of quadratically with the size
+    of the dense matrix.
+    """
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def size(self, dim=None):
+        n = self.blocks.size(0) * self.blocks.size(1)
+        return torch.Size([n, n]) if dim is None else n
+
+    def mv(self, v):
+        n, k, _ = self.blocks.size()
+        return torch.bmm(self.blocks, v.contiguous().view(n, k, 1)).view(-1)
+
+    def mm(self, mat):
+        n, k, _ = self.blocks.size()
+        cols = mat.size(1)
+        return torch.bmm(self.blocks, mat.contiguous().view(n, k, cols)).view(n * k, cols)
+
+    def inverse(self):
+        """Closed form inverse. Assumes diagonal blocks, as is the case for body
+        mass matrices."""
+        k = self.blocks.size(1)
+        eye = Variable(torch.eye(k).type_as(self.blocks.data)).unsqueeze(0)
+        diag = (self.blocks * eye).sum(2)
+        return BlockDiag(eye / diag.unsqueeze(2))
+
+    def dense(self):
+        n, k, _ = self.blocks.size()
+        size = n * k
+        block = torch.arange(0, n).long().view(n, 1, 1) * k
+        row = torch.arange(0, k).long().view(1, k, 1)
+        col = torch.arange(0, k).long().view(1, 1, k)
+        idxs = ((block + row) * size + block + col).view(-1)
+        dense = Variable(self.blocks.data.new(size * size).zero_())
+        dense = dense.index_add(0, Variable(idxs), self.blocks.contiguous().view(-1))
+        return dense.view(size, size)
+
+    def detach_(self):
+        self.blocks.detach_()
+
+
+class BodyTransforms:
+    """Transforms of all the bodies of a world at given positions, computed
+    at once from the (bodies x vec_len) positions p and (bodies x DIM) half
+    dims (a circle's are its radius).
+
+    rotations are the (bodies x DIM x DIM) rotation matrices, half_extents
+    the same matrices with each column (the bodies' frame axes) scaled by the
+    half dim along it, and corners the (bodies x 4 x DIM) world space corners,
+    counterclockwise from the top right one (for circles, of their bounding
+    square).
+    """
+    # corners' coordinates in units of half dims, in the bodies' frames
+    CORNERS = [[1, 1], [-1, 1], [-1, -1], [1, -1]]
+
+    def __init__(self, p, half_dims):
+        n = p.size(0)
+        rot, pos = p[:, 0], p[:, 1:]
+        c, s = torch.cos(rot), torch.sin(rot)
+        self.rotations = torch.stack([torch.stack([c, -s], 1),
+                                      torch.stack([s, c], 1)], 1)
+        self.half_extents = self.rotations * half_dims.unsqueeze(1)
+        corners = Variable(p.data.new(self.CORNERS)).unsqueeze(0).expand(n, 4, Params.DIM)
+        self.corners = pos.unsqueeze(1) + \
+            torch.bmm(corners, self.half_extents.transpose(1, 2))
+
+
+def rotation_matrix(rot):
+    """Rotation matrix of the angle rot, a 1 element Variable."""
+    c, s = torch.cos(rot), torch.sin(rot)
+    return torch.stack([torch.cat([c, -s]), torch.cat([s, c])])
+
+
 def cart_to_polar(cart_vec, positive=True):
     r = cart_vec.norm()
     theta = torch.cat([torch.atan2(cart_vec[Indices.Y], cart_vec[Indices.X])])
@@ -82,6 +205,11 @@ def cross_2d(v1, v2):
     return v1[0] * v2[1] - v1[1] * v2[0]
 
 
+def batch_cross_2d(v1, v2):
+    """Row-wise 2D cross product of two (N x 2) tensors."""
+    return v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]
+
+
 def plot(y_axis, x_axis=None):
     import matplotlib.pyplot as plt
     if x_axis is None:
@@ -95,10 +223,13 @@ def plot(y_axis, x_axis=None):
 
 def get_instance(mod, class_id):
     """Checks if class_id is a string and if so loads class from module;
-        else, just instantiates the class."""
+        else, just instantiates the class. Instances are returned as is,
+        e.g. to pass an engine created with options."""
     if isinstance(class_id, str):
         # Get by name if string
         return getattr(mod, class_id)()
-    else:
+    elif isinstance(class_id, type):
         # Else just instantiate
         return class_id()
+    else:
+        return class_id
@@ -1,5 +1,4 @@
 import time
-from functools import lru_cache
 
 import ode
 import pygame
@@ -8,7 +7,9 @@ from torch.autograd import Variable
 
 import lcp_physics.physics.engines as engines_module
 import lcp_physics.physics.collisions as collisions_module
-from .utils import Indices, Params, cross_2d, get_instance
+from .bodies import Circle
+from .contacts import ContactSet
+from .utils import Indices, Params, BlockDiag, BodyTransforms, batch_cross_2d, get_instance
 
 X, Y = Indices.X, Indices.Y
 DIM = Params.DIM
@@ -20,12 +21,14 @@ class World:
     def __init__(self, bodies, joints, dt=Params.DEFAULT_DT, engine=Params.DEFAULT_ENGINE,
                  collision_callback=Params.DEFAULT_COLLISION, eps=Params.DEFAULT_EPSILON,
                  par_eps=Params.DEFAULT_PAR_EPS, fric_dirs=Params.DEFAULT_FRIC_DIRS,
-                 post_stab=Params.POST_STABILIZATION):
+                 post_stab=Params.POST_STABILIZATION, islands=Params.CONTACT_ISLANDS,
+                 sleep=Params.SLEEP, broad_phase=Params.DEFAULT_BROAD_PHASE):
         self.collisions_debug = None  # XXX
 
         # Load classes from string name defined in utils
         self.engine = get_instance(engines_module, engine)
         self.collision_callback = get_instance(collisions_module, collision_callback)
+        self.broad_phase = get_instance(collisions_module, broad_phase)
 
         self.t = 0
         self.dt = dt
@@ -33,14 +36,23 @@ class World:
         self.par_eps = par_eps
         self.fric_dirs = fric_dirs
         self.post_stab = post_stab
+        self.islands = islands
+        self.sleep = sleep
+        self.sleep_lin_vel = Params.SLEEP_LIN_VEL
+        self.sleep_ang_vel = Params.SLEEP_ANG_VEL
+        self.sleep_time = Params.SLEEP_TIME
 
         self.bodies = bodies
         self.vec_len = len(self.bodies[0].v)
+        # world indices of the bodies (see Island)
+        self.body_ids = torch.arange(0, len(bodies)).long()
 
         self.space = ode.HashSpace()
         for i, b in enumerate(bodies):
             b.geom.body = i
             self.space.add(b.geom)
+        # indices of the bodies whose geoms lag behind p (see sync_geoms)
+        self._dirty_geoms = {i for i, b in enumerate(bodies) if b.geom_dirty}
 
         self.joints = []
         for j in joints:
@@ -51,152 +63,450 @@ class World:
                 i2 = bodies.index(b2)
             self.joints.append((j, i1, i2))
 
-        M_size = bodies[0].M.size(0)
-        self.M = Variable(Tensor(M_size * len(bodies), M_size * len(bodies)).zero_())
-        # TODO Better way for diagonal block matrix?
-        for i, b in enumerate(bodies):
-            self.M[i * M_size:(i+1) * M_size, i * M_size:(i+1) * M_size] = b.M
-        self.set_v(torch.cat([b.v for b in bodies]))
-
-        self.restitutions = Variable(Tensor(len(self.v)))
-        for i in range(len(bodies)):
-            self.restitutions[i * self.vec_len:(i + 1) * self.vec_len] = \
-                bodies[i].restitution.repeat(3)
+        self.M = BlockDiag(torch.stack([b.M for b in bodies]))
 
+        # The world owns the state vectors, bodies' p and v are views into them
+        self.p = torch.cat([b.p for b in bodies])
+        self.v = torch.cat([b.v for b in bodies])
+        for i, b in enumerate(bodies):
+            b.attach(self, i)
+
+        self.restitutions = torch.cat([b.restitution.repeat(self.vec_len)
+                                       for b in bodies])
+
+        # Body transforms, rebuilt lazily whenever p is replaced. Half dims
+        # also give the batched narrow phase the circles' radii and the
+        # rectangles' dims
+        self._half_dims = torch.stack([b.half_dims for b in bodies])
+        self._is_circle = torch.LongTensor([int(isinstance(b, Circle)) for b in bodies])
+        self._transforms = self._transforms_src = None
+
+        # Static bodies add no degrees of freedom to the solve, they keep their
+        # prescribed velocities, which are moved to the constraints' right side
+        self.static = [b.static for b in bodies]
+        self._static_mask = Variable(Tensor([float(s) for s in self.static])
+                                     .unsqueeze(1).repeat(1, self.vec_len).view(-1))
+        # Bodies outside of self.bodies appearing in the constraints, with
+        # their velocities (only used by islands)
+        self.fixed_bodies = []
+        self.fixed_v = None
+
+        # Per body sleeping state
+        self.asleep = [False] * len(bodies)
+        self.rest_time = Tensor(len(bodies)).zero_()
+        self._sleep_forces = [None] * len(bodies)
+
+        # Two contact sets are alternated between collision passes, so that the
+        # contacts at the start of a step are kept if the step is retried
+        self._contact_sets = (ContactSet(), ContactSet())
         self.collisions = None
+        # mu and E of the current contacts, per instance and cleared by each
+        # collision pass
+        self._lcp_cache = {}
         self.find_collisions()
 
     def step(self):
         dt = self.dt
-        start_p = torch.cat([b.p for b in self.bodies])
-        start_rot_joints = [(j[0].rot1, j[0].rot2) for j in self.joints]
-        start_collisions = self.collisions
-        assert all([c[0][3].data[0] <= 0 for c in self.collisions]), \
-            'Interpenetration at beginning of step'
+        start = self._step_start()
         while True:
-            new_v = self.engine.solve_dynamics(self, dt, self.post_stab).squeeze()
-            self.set_v(new_v)
+            new_v = self.solve_dynamics(dt)
             # try step with current dt
-            for body in self.bodies:
-                body.move(dt)
-            for joint in self.joints:
-                joint[0].move(dt)
-            self.find_collisions()
-            if all([c[0][3].data[0] <= 0 for c in self.collisions]):
+            self._advance(new_v, dt)
+            if self.collisions.max_penetration() <= 0:
                 break
             else:
                 dt /= 2
-                # reset positions to beginning of step
-                self.set_p(start_p.clone())  # XXX Avoid clone?
-                for j, c in zip(self.joints, start_rot_joints):
-                    # XXX Clone necessary?
-                    j[0].rot1 = c[0].clone()
-                    j[0].rot2 = c[1].clone() if j[0].rot2 is not None else None
-                    j[0].update_pos()
-                if dt > self.dt / 4:  # XXX
-                    self.collisions = start_collisions
-                # else:
-                #     print('\nSolving stuck collision.')
+                self._restore(start, dt)
+        if self.sleep:
+            self._update_rest_time(dt)
         self.t += dt
 
+    def solve_dynamics(self, dt):
+        if not self.islands and not self.sleep and not any(self.static):
+            return self.engine.solve_dynamics(self, dt, self.post_stab).squeeze()
+        if self.islands:
+            groups = self.island_groups()
+        else:
+            groups = [self.dynamic_group()]
+        if self.sleep:
+            groups = [g for g in groups if not self._island_sleeps(g[0])]
+        # Solve each island on its own and scatter the velocities back
+        islands = self.make_islands(groups)
+        new_vs = [self.engine.solve_dynamics(island, dt, self.post_stab).view(-1)
+                  for island in islands]
+        return self.gather_v(islands, new_vs)
+
+    def gather_v(self, islands, new_vs):
+        """Scatters the islands' new velocities into a world velocity vector.
+        Static bodies keep their velocities, sleeping bodies get zero."""
+        v = self.v * self._static_mask
+        if islands:
+            dofs = torch.cat([island.dofs for island in islands])
+            v = v.index_add(0, Variable(dofs), torch.cat(new_vs))
+        return v
+
+    def dynamic_group(self):
+        """Returns all the non static bodies, with all contacts and joints, as a
+        single group (see island_groups)."""
+        body_idxs = [i for i, s in enumerate(self.static) if not s]
+        joint_idxs = [k for k, j in enumerate(self.joints)
+                      if self._dynamic_body(j[1], j[2]) is not None]
+        return body_idxs, list(range(len(self.collisions))), joint_idxs
+
+    def dynamic_view(self):
+        """Returns the world itself, or if it has static bodies an Island with
+        all of its other bodies, for engines to solve."""
+        if not any(self.static):
+            return self
+        return Island(self, *self.dynamic_group())
+
+    def _dynamic_body(self, i1, i2):
+        """Returns the first non static body of a pair, if any."""
+        if not self.static[i1]:
+            return i1
+        if i2 is not None and not self.static[i2]:
+            return i2
+        return None
+
+    def find_islands(self):
+        """Splits the world into Islands, groups of bodies connected by contacts
+        or joints, whose dynamics can be solved independently."""
+        return self.make_islands(self.island_groups())
+
+    def island_groups(self):
+        """Returns the (body indices, contact indices, joint indices) of each
+        group of bodies connected by contacts or joints. Static bodies do not
+        connect groups and belong to none."""
+        parent = list(range(len(self.bodies)))
+        static = self.static
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        contact_pairs = self.collisions.bodies.tolist() if self.collisions else []
+        joint_pairs = [(j[1], j[2]) for j in self.joints if j[2] is not None]
+        for i1, i2 in contact_pairs + joint_pairs:
+            if static[i1] or static[i2]:
+                continue
+            r1, r2 = find(i1), find(i2)
+            if r1 != r2:
+                parent[r2] = r1
+
+        groups = {}
+        for i in range(len(self.bodies)):
+            if not static[i]:
+                groups.setdefault(find(i), ([], [], []))[0].append(i)
+        for k, (i1, i2) in enumerate(contact_pairs):
+            groups[find(self._dynamic_body(i1, i2))][1].append(k)
+        for k, j in enumerate(self.joints):
+            i = self._dynamic_body(j[1], j[2])
+            if i is not None:
+                groups[find(i)][2].append(k)
+        return list(groups.values())
+
+    def make_islands(self, groups):
+        """Builds an Island for each group. Bodies without any contacts or
+        joints are gathered in a single island."""
+        islands = []
+        free_bodies = []
+        for body_idxs, contact_idxs, joint_idxs in groups:
+            if not contact_idxs and not joint_idxs:
+                free_bodies.extend(body_idxs)
+            else:
+                islands.append(Island(self, body_idxs, contact_idxs, joint_idxs))
+        if free_bodies:
+            islands.append(Island(self, free_bodies, [], []))
+        return islands
+
+    def _island_sleeps(self, body_idxs):
+        """Checks whether a group of bodies is (or goes) to sleep. A group goes to
+        sleep once all of its bodies have been resting for sleep_time."""
+        if all(self.asleep[i] for i in body_idxs):
+            return True
+        if any(self.asleep[i] for i in body_idxs):
+            for i in body_idxs:
+                self.wake(i)
+            return False
+        if all(self.rest_time[i] >= self.sleep_time for i in body_idxs):
+            for i in body_idxs:
+                self.asleep[i] = True
+                self._sleep_forces[i] = self.bodies[i].apply_forces(self.t).data.clone()
+            return True
+        return False
+
+    def wake(self, i):
+        self.asleep[i] = False
+        self.rest_time[i] = 0
+
+    def _wake_touching(self):
+        """Wakes sleeping bodies touching or jointed to an awake (or moving
+        static) body, and those whose applied forces changed since they fell
+        asleep. Returns whether any body was woken."""
+        woken = False
+        pairs = self.collisions.bodies.tolist() if self.collisions else []
+        pairs += [(j[1], j[2]) for j in self.joints if j[2] is not None]
+        for i1, i2 in pairs:
+            for i, other in ((i1, i2), (i2, i1)):
+                if self.asleep[i] and not self._inactive[other]:
+                    self.wake(i)
+                    woken = True
+        for i, b in enumerate(self.bodies):
+            if self.asleep[i] and \
+                    (b.apply_forces(self.t).data - self._sleep_forces[i]).abs().max() > 0:
+                self.wake(i)
+                woken = True
+        return woken
+
+    def _update_rest_time(self, dt):
+        v = self.v.data.view(-1, self.vec_len)
+        resting = (v[:, 0].abs() < self.sleep_ang_vel) & \
+            ((v[:, 1:] ** 2).sum(1) < self.sleep_lin_vel ** 2)
+        self.rest_time = (self.rest_time + dt) * resting.type_as(self.rest_time)
+
+    def _step_start(self):
+        """Stores the state needed to retry a step with a smaller dt."""
+        assert self.collisions.max_penetration() <= 0, \
+            'Interpenetration at beginning of step'
+        return self.p, self.collisions
+
+    def _advance(self, new_v, dt):
+        self.set_v(new_v)
+        self.set_p(self.p + self.v * dt)
+        for joint in self.joints:
+            joint[0].move(dt)
+        self.find_collisions()
+
+    def _restore(self, start, dt):
+        start_p, start_collisions = start
+        # reset positions to beginning of step
+        self.set_p(start_p)
+        for j in self.joints:
+            j[0].update_pos()
+        if dt > self.dt / 4:  # XXX
+            self.collisions = start_collisions
+        # else:
+        #     print('\nSolving stuck collision.')
+
     def set_v(self, new_v):
+        """Replaces the velocities of all bodies at once (see Body.v)."""
         self.v = new_v
-        for i, b in enumerate(self.bodies):
-            b.v = self.v[i * len(b.v):(i+1) * len(b.v)]
 
     def set_p(self, new_p):
-        for i, b in enumerate(self.bodies):
-            b.set_p(new_p[i * self.vec_len:(i + 1) * self.vec_len])
+        """Replaces the positions of all bodies at once (see Body.set_p)."""
+        self.p = new_p
+        # geoms are synced lazily, when collision detection queries ODE
+        self._dirty_geoms.update(i for i, asleep in enumerate(self.asleep)
+                                 if not asleep)
+
+    def sync_geoms(self):
+        """Moves the ODE geoms of the bodies moved since the last sync to
+        their current positions. Positions and quaternions (Eq 2.3) are
+        computed for all of them at once."""
+        if not self._dirty_geoms:
+            return
+        dirty = sorted(self._dirty_geoms)
+        self._dirty_geoms.clear()
+        p = self.p.data.view(len(self.bodies), self.vec_len) \
+            .index_select(0, torch.LongTensor(dirty))
+        zeros = p.new(len(dirty)).zero_()
+        positions = torch.stack([p[:, 1 + X], p[:, 1 + Y], zeros], 1).tolist()
+        # XXX sign correction
+        half_rot = -p[:, 0] / 2
+        quats = torch.stack([half_rot.sin(), zeros, zeros, half_rot.cos()], 1).tolist()
+        for i, position, quat in zip(dirty, positions, quats):
+            b = self.bodies[i]
+            b.geom.setPosition(position)
+            if b.geom_rotates:
+                b.geom.setQuaternion(quat)
+            b.geom_dirty = False
+
+    @property
+    def transforms(self):
+        """The bodies' BodyTransforms at the current positions, computed once
+        per position update."""
+        if self._transforms_src is not self.p:
+            self._transforms_src = self.p
+            self._transforms = BodyTransforms(
+                self.p.view(len(self.bodies), self.vec_len), self._half_dims)
+        return self._transforms
 
     def apply_forces(self, t):
         return torch.cat([b.apply_forces(t) for b in self.bodies])
 
     def find_collisions(self):
-        self.collisions = []
-        # ODE collision detection
-        self.space.collide([self], self.collision_callback)
+        self._lcp_cache.clear()
+        if self.collisions is self._contact_sets[0]:
+            self.collisions = self._contact_sets[1]
+        else:
+            self.collisions = self._contact_sets[0]
+        self._collide()
+        if self.sleep:
+            # Contacts among newly woken bodies were skipped, detect them again
+            while self._wake_touching():
+                self._collide()
+
+    def _collide(self):
+        self.collisions.clear()
+        moving = (self.v.data.view(-1, self.vec_len).abs().max(1)[0] > 0).tolist()
+        self._inactive = [a or (s and not m)
+                          for a, s, m in zip(self.asleep, self.static, moving)]
+        if self.broad_phase.uses_geoms or self.collision_callback.uses_geoms:
+            self.sync_geoms()
+        self.broad_phase(self)
+
+    def skips_contact(self, i1, i2):
+        """Contacts are not needed between two static bodies, nor between
+        sleeping or resting static bodies."""
+        if self.static[i1] and self.static[i2]:
+            return True
+        return self._inactive[i1] and self._inactive[i2]
 
     def Je(self):
-        Je = Variable(Tensor(DIM * len(self.joints), self.vec_len * len(self.bodies)).zero_())
-        for i, joint in enumerate(self.joints):
-            J1, J2 = joint[0].J()
-            i1 = joint[1]
-            i2 = joint[2]
-            Je[i * DIM:(i+1) * DIM, i1 * self.vec_len:(i1 + 1) * self.vec_len] = J1
-            if i2 is not None:
-                Je[i * DIM:(i+1) * DIM,
-                    i2 * self.vec_len:(i2 + 1) * self.vec_len] = J2
-        return Je
+        if not self.joints:
+            return Variable(Tensor(0, self.vec_len * len(self.bodies)).zero_())
+        return self._assemble(*self._Je_entries())
 
     def Jc(self):
-        Jc = Variable(Tensor(len(self.collisions), self.vec_len * len(self.bodies)).zero_())
-        for i, collision in enumerate(self.collisions):
-            c = collision[0]  # c = (normal, collision_pt_1, collision_pt_2)
-            i1 = collision[1]
-            i2 = collision[2]
-            J1 = torch.cat([cross_2d(c[1], c[0]).unsqueeze(1),
-                            c[0].unsqueeze(0)], dim=1)
-            J2 = -torch.cat([cross_2d(c[2], c[0]).unsqueeze(1),
-                             c[0].unsqueeze(0)], dim=1)
-            Jc[i, i1 * self.vec_len:(i1 + 1) * self.vec_len] = J1
-            Jc[i, i2 * self.vec_len:(i2 + 1) * self.vec_len] = J2
-        return Jc
+        return self._assemble(*self._Jc_entries())
 
     def Jf(self):
-        Jf = Variable(Tensor(len(self.collisions) * self.fric_dirs,
-                             self.vec_len * len(self.bodies)).zero_())
-        for i, collision in enumerate(self.collisions):
-            c = collision[0]  # c = (normal, collision_pt_1, collision_pt_2)
-            # find orthogonal vector in 2D
-            dir1 = torch.cross(torch.cat([c[0], Variable(Tensor(1).zero_())]),
-                               Variable(Tensor([0, 0, 1])))[:DIM]
-            dir2 = -dir1
-            i1 = collision[1]  # body 1 index
-            i2 = collision[2]  # body 2 index
-            J1 = torch.cat([
-                torch.cat([cross_2d(c[1], dir1).unsqueeze(1),
-                           dir1.unsqueeze(0)], dim=1),
-                torch.cat([cross_2d(c[1], dir2).unsqueeze(1),
-                           dir2.unsqueeze(0)], dim=1),
-            ], dim=0)
-            J2 = torch.cat([
-                torch.cat([cross_2d(c[2], dir1).unsqueeze(1),
-                           dir1.unsqueeze(0)], dim=1),
-                torch.cat([cross_2d(c[2], dir2).unsqueeze(1),
-                           dir2.unsqueeze(0)], dim=1),
-            ], dim=0)
-            Jf[i * self.fric_dirs:(i+1) * self.fric_dirs,
-                i1 * self.vec_len:(i1 + 1) * self.vec_len] = J1
-            Jf[i * self.fric_dirs:(i+1) * self.fric_dirs,
-                i2 * self.vec_len:(i2 + 1) * self.vec_len] = -J2
-        return Jf
+        return self._assemble(*self._Jf_entries())
+
+    def Je_fixed(self, v):
+        """Product of the fixed bodies' blocks of Je with their velocities v."""
+        return self._fixed_product(*self._Je_entries(), v)
+
+    def Jc_fixed(self, v):
+        """Product of the fixed bodies' blocks of Jc with their velocities v."""
+        return self._fixed_product(*self._Jc_entries(), v)
+
+    def Jf_fixed(self, v):
+        """Product of the fixed bodies' blocks of Jf with their velocities v."""
+        return self._fixed_product(*self._Jf_entries(), v)
+
+    def Jc_blocks(self):
+        """Returns each contact row's blocks for its two bodies (those of
+        collisions.bodies), as a (contacts x 2 x vec_len) Variable, without
+        assembling Jc. Fixed bodies' blocks are included."""
+        return self._pair_blocks(*self._Jc_entries())
+
+    def Jf_blocks(self):
+        """Returns each friction row's blocks for its contact's two bodies, as
+        a (contacts * fric_dirs x 2 x vec_len) Variable."""
+        return self._pair_blocks(*self._Jf_entries())
+
+    def _pair_blocks(self, rows, body_idxs, blocks, num_rows):
+        """Pairs up the entries of a Jacobian whose rows each have a first and
+        a second body's block, all first bodies' blocks coming first."""
+        return blocks.view(2, num_rows, self.vec_len).transpose(0, 1)
+
+    def _Je_entries(self):
+        rows, body_idxs, blocks = [], [], []
+        for i, joint in enumerate(self.joints):
+            J1, J2 = joint[0].J()
+            joint_rows = torch.arange(i * DIM, (i + 1) * DIM).long()
+            rows.append(joint_rows)
+            body_idxs.append(torch.LongTensor(DIM).fill_(joint[1]))
+            blocks.append(J1)
+            if joint[2] is not None:
+                rows.append(joint_rows)
+                body_idxs.append(torch.LongTensor(DIM).fill_(joint[2]))
+                blocks.append(J2)
+        return torch.cat(rows), torch.cat(body_idxs), torch.cat(blocks), \
+            DIM * len(self.joints)
+
+    def _Jc_entries(self):
+        normals = self.collisions.normals
+        p1, p2 = self.collisions.arms[:, 0], self.collisions.arms[:, 1]
+        i1, i2 = self.collisions.bodies[:, 0], self.collisions.bodies[:, 1]
+        J1 = torch.cat([batch_cross_2d(p1, normals).unsqueeze(1), normals], dim=1)
+        J2 = -torch.cat([batch_cross_2d(p2, normals).unsqueeze(1), normals], dim=1)
+        rows = torch.arange(0, len(normals)).long()
+        return torch.cat([rows, rows]), torch.cat([i1, i2]), \
+            torch.cat([J1, J2]), len(normals)
+
+    def _Jf_entries(self):
+        normals = self.collisions.normals
+        p1, p2 = self.collisions.arms[:, 0], self.collisions.arms[:, 1]
+        i1, i2 = self.collisions.bodies[:, 0], self.collisions.bodies[:, 1]
+        num_collisions = len(normals)
+        # find orthogonal vector in 2D, friction directions are (dir1, -dir1)
+        dir1 = torch.stack([normals[:, Y], -normals[:, X]], dim=1)
+        dirs = torch.stack([dir1, -dir1], dim=1).view(-1, DIM)
+        # contact arms repeated once per friction direction
+        p1 = p1.unsqueeze(1).expand(num_collisions, self.fric_dirs, DIM).contiguous().view(-1, DIM)
+        p2 = p2.unsqueeze(1).expand(num_collisions, self.fric_dirs, DIM).contiguous().view(-1, DIM)
+        i1 = i1.unsqueeze(1).expand(num_collisions, self.fric_dirs).contiguous().view(-1)
+        i2 = i2.unsqueeze(1).expand(num_collisions, self.fric_dirs).contiguous().view(-1)
+        J1 = torch.cat([batch_cross_2d(p1, dirs).unsqueeze(1), dirs], dim=1)
+        J2 = torch.cat([batch_cross_2d(p2, dirs).unsqueeze(1), dirs], dim=1)
+        rows = torch.arange(0, len(dirs)).long()
+        return torch.cat([rows, rows]), torch.cat([i1, i2]), \
+            torch.cat([J1, -J2]), len(dirs)
+
+    def _assemble(self, rows, body_idxs, blocks, num_rows):
+        """Builds a dense (num_rows x vec_len * num_bodies) Jacobian by adding each
+        (1 x vec_len) block in blocks to row rows[k], columns of body body_idxs[k].
+        Blocks of fixed bodies (indices past self.bodies) are left out."""
+        num_cols = self.vec_len * len(self.bodies)
+        if self.fixed_bodies:
+            keep = (body_idxs < len(self.bodies)).nonzero().view(-1)
+            rows, body_idxs = rows[keep], body_idxs[keep]
+            blocks = blocks.index_select(0, Variable(keep))
+        offsets = torch.arange(0, self.vec_len).long().unsqueeze(0)
+        cols = body_idxs.unsqueeze(1) * self.vec_len + offsets
+        idxs = (rows.unsqueeze(1) * num_cols + cols).view(-1)
+        J = Variable(Tensor(num_rows * num_cols).zero_())
+        J = J.index_add(0, Variable(idxs), blocks.contiguous().view(-1))
+        return J.view(num_rows, num_cols)
+
+    def _fixed_product(self, rows, body_idxs, blocks, num_rows, v):
+        """Sums, for each row, the fixed bodies' blocks times their velocities."""
+        product = Variable(Tensor(num_rows).zero_())
+        fixed = (body_idxs >= len(self.bodies)).nonzero()
+        if fixed.ndimension() == 0:
+            return product
+        fixed = fixed.view(-1)
+        fixed_v = v.view(-1, self.vec_len).index_select(
+            0, Variable(body_idxs[fixed] - len(self.bodies)))
+        values = (blocks.index_select(0, Variable(fixed)) * fixed_v).sum(1)
+        return product.index_add(0, Variable(rows[fixed]), values)
+
+    def contact_ids(self):
+        """Returns ids of the contacts that persist across steps, as tuples of
+        (body1, body2, feature) with world body indices."""
+        if not self.collisions:
+            return []
+        bodies = self.body_ids.index_select(0, self.collisions.bodies.view(-1)).view(-1, 2)
+        return [(i1, i2, f) for (i1, i2), f in zip(bodies.tolist(),
+                                                   self.collisions.features.tolist())]
 
     def mu(self):
-        return self._memoized_mu(*[(c[1], c[2]) for c in self.collisions])
-
-    @lru_cache()
-    def _memoized_mu(self, *collisions):
-        mu = Variable(torch.zeros(len(self.collisions)))
-        for i, collision in enumerate(self.collisions):
-            i1 = collision[1]
-            i2 = collision[2]
-            mu[i] = self.bodies[i1].fric_coeff * self.bodies[i2].fric_coeff
-        return torch.diag(mu)
+        key = ('mu',) + tuple(self.collisions.bodies.view(-1).tolist())
+        if key not in self._lcp_cache:
+            fric_coeffs = torch.cat([b.fric_coeff for b in self.bodies + self.fixed_bodies])
+            bodies = Variable(self.collisions.bodies)
+            mu = fric_coeffs.index_select(0, bodies[:, 0]) * \
+                fric_coeffs.index_select(0, bodies[:, 1])
+            self._lcp_cache[key] = torch.diag(mu)
+        return self._lcp_cache[key]
 
     def E(self):
-        return self._memoized_E(len(self.collisions))
-
-    @lru_cache()
-    def _memoized_E(self, num_collisions):
-        n = self.fric_dirs * num_collisions
-        E = torch.zeros(n, num_collisions)
-        for i in range(num_collisions):
-            E[i * self.fric_dirs: (i + 1) * self.fric_dirs, i] += 1
-        return Variable(E)
+        num_collisions = len(self.collisions)
+        key = ('E', num_collisions)
+        if key not in self._lcp_cache:
+            n = self.fric_dirs * num_collisions
+            E = torch.zeros(n, num_collisions)
+            for i in range(num_collisions):
+                E[i * self.fric_dirs: (i + 1) * self.fric_dirs, i] += 1
+            self._lcp_cache[key] = Variable(E)
+        return self._lcp_cache[key]
 
     def save_state(self):
-        p = torch.cat([Variable(b.p.data) for b in self.bodies])
-        state_dict = {'p': p, 'v': Variable(self.v.data), 't': self.t}
+        state_dict = {'p': Variable(self.p.data), 'v': Variable(self.v.data), 't': self.t}
         return state_dict
 
     def load_state(self, state_dict):
@@ -215,7 +525,108 @@ class World:
         self.find_collisions()
 
     def reset_engine(self):
-        self.engine = self.engine.__class__()
+        """Clears the engine's state (e.g. warm start solutions), keeping its
+        options."""
+        self.engine.reset()
+
+
+class Island(World):
+    """View of a subset of a world's bodies, with the contacts and joints among
+    them, exposing the World interface used by engines. Body indices in the
+    island's joints and contacts are local to the island. Static bodies
+    constrained with the island's bodies are fixed bodies, indexed after them.
+    """
+    def __init__(self, world, body_idxs, contact_idxs, joint_idxs):
+        self.world = world
+        self.t = world.t
+        self.eps = world.eps
+        self.par_eps = world.par_eps
+        self.fric_dirs = world.fric_dirs
+        self.vec_len = world.vec_len
+
+        contact_idxs = torch.LongTensor(contact_idxs)
+        referenced = world.collisions.bodies.index_select(0, contact_idxs).view(-1).tolist() \
+            if len(contact_idxs) > 0 else []
+        for k in joint_idxs:
+            referenced += [i for i in world.joints[k][1:] if i is not None]
+        fixed_idxs = sorted({i for i in referenced if world.static[i]})
+
+        self.bodies = [world.bodies[i] for i in body_idxs]
+        self.fixed_bodies = [world.bodies[i] for i in fixed_idxs]
+        all_idxs = torch.LongTensor(body_idxs + fixed_idxs)
+        self.body_ids = all_idxs
+        body_map = torch.LongTensor(len(world.bodies)).fill_(-1)
+        body_map.index_copy_(0, all_idxs, torch.arange(0, len(all_idxs)).long())
+        self.joints = []
+        for k in joint_idxs:
+            j, i1, i2 = world.joints[k]
+            self.joints.append((j, int(body_map[i1]),
+                                int(body_map[i2]) if i2 is not None else None))
+
+        # indices of the island's degrees of freedom in the world's state vectors
+        offsets = torch.arange(0, self.vec_len).long().unsqueeze(0)
+        all_dofs = (all_idxs.unsqueeze(1) * self.vec_len + offsets).view(-1)
+        self.dofs = all_dofs[:self.vec_len * len(body_idxs)]
+        dofs = Variable(self.dofs)
+        self.M = BlockDiag(world.M.blocks.index_select(0, Variable(all_idxs[:len(body_idxs)])))
+        self.v = world.v.index_select(0, dofs)
+        self.restitutions = world.restitutions.index_select(0, dofs)
+        self.fixed_v = None
+        if fixed_idxs:
+            fixed_dofs = Variable(all_dofs[self.vec_len * len(body_idxs):])
+            self.fixed_v = world.v.index_select(0, fixed_dofs)
+            self.fixed_restitutions = world.restitutions.index_select(0, fixed_dofs)
+        self.collisions = world.collisions.subset(contact_idxs, body_map) \
+            if len(contact_idxs) > 0 else ContactSet(1)
+        self._lcp_cache = {}
+
+
+class BatchWorld:
+    """Steps B variants of the same scene in lockstep.
+
+    All worlds must have the same bodies and joints (e.g. built by the same
+    scene function), but may differ in masses, friction, forces and states.
+    Each step solves the dynamics of all worlds with one batched LCP. If any
+    world interpenetrates, the step is retried with half the dt for all of
+    them, so that the worlds stay synchronized.
+    """
+    def __init__(self, worlds, dt=Params.DEFAULT_DT, engine=Params.DEFAULT_ENGINE):
+        assert all(len(w.bodies) == len(worlds[0].bodies) and
+                   len(w.joints) == len(worlds[0].joints) for w in worlds), \
+            'Batched worlds must have the same bodies and joints'
+        assert not any(w.sleep for w in worlds), \
+            'Sleeping is not supported in batched worlds'
+        assert not any(w.post_stab for w in worlds), \
+            'Post-stabilization is not supported in batched worlds'
+        assert all(w.static == worlds[0].static for w in worlds), \
+            'Batched worlds must have the same static bodies'
+        self.worlds = worlds
+        self.engine = get_instance(engines_module, engine)
+        self.t = 0
+        self.dt = dt
+        for w in worlds:
+            w.t = self.t
+            w.dt = dt
+
+    def step(self):
+        dt = self.dt
+        starts = [w._step_start() for w in self.worlds]
+        while True:
+            views = [w.dynamic_view() for w in self.worlds]
+            new_vs = self.engine.batch_solve_dynamics(views, dt)
+            for w, view, new_v in zip(self.worlds, views, new_vs):
+                if view is not w:
+                    new_v = w.gather_v([view], [new_v.view(-1)])
+                w._advance(new_v, dt)
+            if all(w.collisions.max_penetration() <= 0 for w in self.worlds):
+                break
+            else:
+                dt /= 2
+                for w, start in zip(self.worlds, starts):
+                    w._restore(start, dt)
+        self.t += dt
+        for w in self.worlds:
+            w.t = self.t
 
 
 def run_world(world, dt=Params.DEFAULT_DT, run_time=10,
@@ -250,8 +661,8 @@ def run_world(world, dt=Params.DEFAULT_DT, run_time=10,
 
                 # XXX visualize collision points and normal for debug
                 # if world.collisions_debug:
-                #     for c in world.collisions_debug:
-                #         (normal, p1, p2, penetration), b1, b2 = c
+                #     c = world.collisions_debug
+                #     for normal, (p1, p2), (b1, b2) in zip(c.normals, c.arms, c.bodies):
                 #         b1_pos = world.bodies[b1].pos
                 #         b2_pos = world.bodies[b2].pos
                 #         p1 = p1 + b1_pos
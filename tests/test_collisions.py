@@ -0,0 +1,244 @@
+import math
+import unittest
+
+try:
+    import torch
+    from torch.autograd import Variable, gradcheck
+
+    from lcp_physics.physics.bodies import Circle, Rect
+    from lcp_physics.physics.collisions import DiffCollisionHandler, SweepAndPrune, \
+        body_poses, circle_circle_contacts, circle_rect_contacts, rect_rect_contacts
+    from lcp_physics.physics.contacts import ContactCache, ContactSet
+    from lcp_physics.physics.utils import Params, rotation_matrix
+    from lcp_physics.physics.world import World
+except ImportError:  # torch 0.3, ode, pygame and scipy are needed
+    torch = None
+
+
+def rotated(body, rot):
+    body.set_p(torch.cat([Variable(Params.TENSOR_TYPE([rot])), body.pos]))
+    return body
+
+
+def assert_close(test, a, b, tol=1e-6):
+    test.assertLess((a - b).abs().max(), tol * (1 + b.abs().max()))
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestCircleCircle(unittest.TestCase):
+    def test_matches_contact_points(self):
+        """The batched kernel gives contact_points' contacts, coincident
+        centers included, which are pushed apart along x."""
+        cases = [('within eps', [530.05, 500]), ('overlapping', [515, 510]),
+                 ('diagonal', [485, 480]), ('coincident', [500, 500])]
+        for name, pos in cases:
+            c1, c2 = Circle(pos, 20), Circle([500, 500], 10)
+            world = World([c1, c2], [])
+            pts = DiffCollisionHandler(cache=False).contact_points(world, c1, c2)
+            self.assertEqual(len(pts), 1, name)
+            normal, p1, p2, penetration = pts[0]
+
+            pos, _ = body_poses(world)
+            normals, p1s, p2s, penetrations = circle_circle_contacts(
+                pos[0:1], pos[1:2], c1.rad, c2.rad)
+            assert_close(self, normals.data[0], normal.data)
+            assert_close(self, p1s.data[0], p1.data)
+            assert_close(self, p2s.data[0], p2.data)
+            assert_close(self, penetrations.data, penetration.data)
+        assert_close(self, normal.data, Params.TENSOR_TYPE([1, 0]))
+        assert_close(self, penetration.data, Params.TENSOR_TYPE([30]))
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestCircleRect(unittest.TestCase):
+    def test_matches_contact_points(self):
+        """The batched kernel gives contact_points' contacts for circles
+        facing a face, a corner, and on the rectangle's axis (y == 0)."""
+        # circle offsets from the center of a 100 x 60 rectangle, in its frame
+        cases = [('face', 0., [10, -45]), ('rotated face', 0.3, [-20, 45]),
+                 ('corner', 0., [55, 35]), ('rotated corner', -0.4, [-55, -35]),
+                 ('y == 0', 0., [65, 0])]
+        for name, rot, (x, y) in cases:
+            c, s = math.cos(rot), math.sin(rot)
+            rect = rotated(Rect([500, 500], [100, 60]), rot)
+            circle = Circle([500 + c * x - s * y, 500 + s * x + c * y], 20)
+            world = World([circle, rect], [])
+            pts = DiffCollisionHandler(cache=False).contact_points(world, circle, rect)
+            self.assertEqual(len(pts), 1, name)
+            normal, p1, p2, penetration = pts[0]
+
+            pos, rotations = body_poses(world)
+            normals, p_circle, p_rect, penetrations = circle_rect_contacts(
+                pos[0:1], circle.rad, pos[1:2], rotations[1:2], rect.dims.unsqueeze(0))
+            assert_close(self, normals.data[0], normal.data)
+            assert_close(self, p_circle.data[0], p1.data)
+            assert_close(self, p_rect.data[0], p2.data)
+            assert_close(self, penetrations.data, penetration.data)
+
+
+def rect_pair(pos1, rot1, dims1, pos2, rot2, dims2):
+    """rect_rect_contacts' inputs for a single pair, as Variables."""
+    T = Params.TENSOR_TYPE
+    return [Variable(T(pos1)), Variable(T([rot1])), Variable(T(dims1)),
+            Variable(T(pos2)), Variable(T([rot2])), Variable(T(dims2))]
+
+
+def rect_contacts(pos1, rot1, dims1, pos2, rot2, dims2):
+    return rect_rect_contacts(
+        pos1.unsqueeze(0), rotation_matrix(rot1).unsqueeze(0), dims1.unsqueeze(0),
+        pos2.unsqueeze(0), rotation_matrix(rot2).unsqueeze(0), dims2.unsqueeze(0))
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestRectRect(unittest.TestCase):
+    def test_aligned_boxes(self):
+        """A 2 x 2 box 0.1 into a wider one below it: both of the narrower
+        face's ends are contacts."""
+        normals, p1, p2, penetrations, valid = rect_contacts(
+            *rect_pair([0, 0], 0, [2, 2], [0, -1.9], 0, [4, 2]))
+        self.assertEqual(valid.tolist(), [1, 1])
+        assert_close(self, penetrations.data, Params.TENSOR_TYPE([0.1, 0.1]))
+        for k in range(2):
+            assert_close(self, normals.data[k], Params.TENSOR_TYPE([0, 1]))
+        order = [0, 1] if p1.data[0, 0] < p1.data[1, 0] else [1, 0]
+        assert_close(self, p1.data[order[0]], Params.TENSOR_TYPE([-1, -1]))
+        assert_close(self, p1.data[order[1]], Params.TENSOR_TYPE([1, -1]))
+        assert_close(self, p2.data[order[0]], Params.TENSOR_TYPE([-1, 1]))
+        assert_close(self, p2.data[order[1]], Params.TENSOR_TYPE([1, 1]))
+
+    def test_equal_overlaps(self):
+        """Diagonally overlapping squares overlap equally along all four
+        axes, rectangle 1's x axis is chosen."""
+        for offset in [0, 0.5 * 1e-6]:
+            normals, p1, p2, penetrations, valid = rect_contacts(
+                *rect_pair([0, 0], 0, [2, 2], [1.9, 1.9 + offset], 0, [2, 2]))
+            for k in range(2):
+                if valid[k]:
+                    assert_close(self, normals.data[k], Params.TENSOR_TYPE([-1, 0]))
+                    assert_close(self, penetrations.data[k:k + 1], Params.TENSOR_TYPE([0.1]))
+
+    def test_gradients(self):
+        """Gradients with respect to positions, rotations and dims."""
+        inputs = rect_pair([0.2, 0], 0.05, [2, 2], [0.3, -1.9], 0.1, [3, 2])
+        for x in inputs:
+            x.requires_grad = True
+
+        def contacts(*inputs):
+            normals, p1, p2, penetrations, _ = rect_contacts(*inputs)
+            return torch.cat([normals.view(-1), p1.view(-1), p2.view(-1), penetrations])
+        self.assertTrue(gradcheck(contacts, inputs, eps=1e-6, atol=1e-5))
+
+    def test_resting_box(self):
+        """A box resting on the ground touches it at its two bottom corners,
+        found by the default broad phase."""
+        ground = Rect([500, 500], [900, 10], static=True)
+        box = Rect([500, 465], [60, 60])
+        world = World([ground, box], [])
+        contacts = world.collisions
+        self.assertEqual(len(contacts), 2)
+        self.assertLess(contacts.penetrations.data.abs().max(), 1e-9)
+        xs = []
+        for (i1, _), (p1, _), normal in zip(contacts.bodies.tolist(), contacts.arms.data,
+                                            contacts.normals.data):
+            point = world.bodies[i1].pos.data + p1
+            self.assertAlmostEqual(point[1], 495)
+            self.assertAlmostEqual(abs(normal[1]), 1)
+            xs.append(point[0])
+        self.assertEqual(sorted(round(x) for x in xs), [470, 530])
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestContactSet(unittest.TestCase):
+    def test_rows_keep_their_graphs(self):
+        T = Params.TENSOR_TYPE
+        x = Variable(T([2]), requires_grad=True)
+        contacts = ContactSet(capacity=1)
+        contacts.append(x.repeat(2), x.repeat(2), -x.repeat(2), x, 0, 1)
+        contacts.extend(x.repeat(2, 2), x.repeat(2, 2), x.repeat(2, 2), x.repeat(2),
+                        torch.LongTensor([1, 2]), torch.LongTensor([3, 3]),
+                        torch.LongTensor([0, 1]))
+        self.assertEqual(len(contacts), 3)
+        self.assertEqual(contacts.arms.size(), torch.Size([3, 2, 2]))
+        self.assertEqual(contacts.bodies.tolist(), [[0, 1], [1, 3], [2, 3]])
+        self.assertEqual(contacts.features.tolist(), [0, 0, 1])
+        penetrations = contacts.penetrations
+        contacts.clear()
+        penetrations.sum().backward()
+        self.assertEqual(x.grad.data[0], 3)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestContactCache(unittest.TestCase):
+    def test_evicts_separated_pairs(self):
+        for broad_phase in ['OdeBroadPhase', 'SweepAndPrune']:
+            handler = DiffCollisionHandler(cache=True)
+            box = Rect([500, 465], [60, 60])
+            world = World([Rect([500, 500], [900, 10], static=True), box], [],
+                          collision_callback=handler, broad_phase=broad_phase)
+            self.assertEqual(len(handler.cache.poses), 1, broad_phase)
+            self.assertEqual(len(handler.cache.contacts), 2, broad_phase)
+            box.set_p(box.p - Variable(Params.TENSOR_TYPE([0, 0, 100])))
+            world.find_collisions()
+            self.assertEqual(len(world.collisions), 0, broad_phase)
+            self.assertEqual(len(handler.cache.poses), 0, broad_phase)
+            self.assertEqual(len(handler.cache.contacts), 0, broad_phase)
+
+    def test_lookup_evicts_separated_pairs(self):
+        """A pair moved apart by more than eps, but within the cache's
+        tolerances, gets no contacts and is evicted."""
+        handler = DiffCollisionHandler(cache=True)
+        handler.cache = ContactCache(lin_tol=1.)
+        ground, box = Rect([500, 500], [900, 10], static=True), Rect([500, 465], [60, 60])
+        world = World([ground, box], [], collision_callback=handler,
+                      broad_phase='SweepAndPrune')
+        box.set_p(box.p - Variable(Params.TENSOR_TYPE([0, 0, 0.5])))
+        self.assertEqual(handler.cache.lookup(ground, box, 0, 1, world.eps), [])
+        self.assertEqual(len(handler.cache.poses), 0)
+        self.assertEqual(len(handler.cache.contacts), 0)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestSweepAndPrune(unittest.TestCase):
+    def test_bounding_boxes(self):
+        """Rotated rectangles' boxes enclose their corners, circles' are
+        their radii, grown by eps."""
+        bodies = [rotated(Rect([500, 500], [100, 60]), 0.3),
+                  rotated(Rect([300, 500], [100, 60]), -2.), Circle([700, 500], 20)]
+        world = World(bodies, [])
+        lo, hi = SweepAndPrune().bounding_boxes(world)
+        corners = world.transforms.corners.data
+        for i in range(2):
+            assert_close(self, lo[i], corners[i].min(0)[0] - world.eps)
+            assert_close(self, hi[i], corners[i].max(0)[0] + world.eps)
+        assert_close(self, lo[2], Params.TENSOR_TYPE([680, 480]) - world.eps)
+        assert_close(self, hi[2], Params.TENSOR_TYPE([720, 520]) + world.eps)
+
+    def test_find_pairs_matches_brute_force(self):
+        """The sorted sweep finds exactly the pairs whose boxes overlap, on
+        random scenes with static bodies and boxes touching at their edges."""
+        for seed in range(5):
+            torch.manual_seed(seed)
+            bodies = []
+            for i in range(30):
+                pos = (torch.rand(2) * 400).tolist()
+                static = i % 4 == 0
+                if i % 3 == 0:
+                    bodies.append(Circle(pos, 5 + 20 * torch.rand(1)[0], static=static))
+                else:
+                    rect = Rect(pos, (10 + 50 * torch.rand(2)).tolist(), static=static)
+                    bodies.append(rotated(rect, 2 * math.pi * torch.rand(1)[0]))
+            # boxes grown by eps = 0.5 touching exactly along x and along y
+            bodies += [Rect([100, 600], [60, 60]), Rect([161, 600], [60, 60], static=True),
+                       Circle([600, 100], 20), Circle([600, 141], 20)]
+            world = World(bodies, [], eps=0.5, broad_phase='SweepAndPrune')
+            lo, hi = SweepAndPrune().bounding_boxes(world)
+            expected = [[i1, i2] for i1 in range(len(bodies)) for i2 in range(i1 + 1, len(bodies))
+                        if (lo[i1] <= hi[i2]).all() and (lo[i2] <= hi[i1]).all()]
+            self.assertIn([len(bodies) - 4, len(bodies) - 3], expected)
+            self.assertIn([len(bodies) - 2, len(bodies) - 1], expected)
+            pairs = SweepAndPrune().find_pairs(world)
+            self.assertEqual(sorted(pairs.tolist()), expected, seed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+
+try:
+    import torch
+    from torch.autograd import Variable
+
+    from lcp_physics.physics.bodies import Circle, Rect
+    from lcp_physics.physics.constraints import Joint
+    from lcp_physics.physics.engines import DelassusEngine, PdipmEngine, PgsEngine
+    from lcp_physics.physics.forces import ExternalForce, gravity
+    from lcp_physics.physics.utils import Params
+    from lcp_physics.physics.world import World
+except ImportError:  # torch 0.3, ode, pygame and scipy are needed
+    torch = None
+
+
+def box_scene(engine):
+    """A box resting on a static ground."""
+    box = Rect([500, 465], [60, 60])
+    box.add_force(ExternalForce(gravity, multiplier=100))
+    return World([Rect([500, 500], [900, 10], static=True), box], [], engine=engine)
+
+
+def stack_scene(engine):
+    """Two boxes resting on each other on a static ground."""
+    bodies = [Rect([500, 500], [900, 10], static=True)]
+    for j in range(2):
+        r = Rect([500, 465 - 60 * j], [60, 60])
+        r.add_force(ExternalForce(gravity, multiplier=100))
+        bodies.append(r)
+    return World(bodies, [], engine=engine)
+
+
+def chain_scene(engine):
+    """Two jointed circles resting on a static ground."""
+    bodies = [Rect([500, 500], [900, 10], static=True)]
+    for i in range(2):
+        c = Circle([300 + 40 * i, 475], 20)
+        c.add_force(ExternalForce(gravity, multiplier=100))
+        bodies.append(c)
+    bodies[1].add_no_collision(bodies[2])
+    joints = [Joint(bodies[1], bodies[2], [320, 475])]
+    return World(bodies, joints, engine=engine)
+
+
+def solve(scene, engine):
+    """Returns the velocities after one solve and the gradient of a weighted
+    sum of them with respect to the initial velocities."""
+    world = scene(engine)
+    world.v = Variable(world.v.data.clone(), requires_grad=True)
+    new_v = world.solve_dynamics(world.dt)
+    weights = Variable(torch.linspace(-1, 1, new_v.size(0)).type_as(new_v.data))
+    (new_v * weights).sum().backward()
+    return new_v.data, world.v.grad.data
+
+
+def assert_close(test, a, b, tol=1e-3):
+    test.assertLess((a - b).abs().max(), tol * (1 + b.abs().max()))
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestDelassusEngine(unittest.TestCase):
+    def test_matches_pdipm(self):
+        for scene in [stack_scene, chain_scene]:
+            v, grad = solve(scene, PdipmEngine())
+            delassus_v, delassus_grad = solve(scene, DelassusEngine())
+            assert_close(self, delassus_v, v)
+            assert_close(self, delassus_grad, grad)
+
+    def test_batch_matches_single(self):
+        engine = DelassusEngine()
+        worlds = [stack_scene(engine), chain_scene(engine)]
+        # different contact counts, the smaller LCP is padded
+        views = [w.dynamic_view() for w in worlds]
+        batch_vs = engine.batch_solve_dynamics(views, worlds[0].dt)
+        for view, batch_v in zip(views, batch_vs):
+            v = engine.solve_dynamics(view, worlds[0].dt)
+            assert_close(self, batch_v.data, v.data)
+
+    def test_gradients_match_finite_differences(self):
+        """Gradients of the new velocities with respect to the initial ones,
+        with the bodies sliding so that the contacts are strictly
+        complementary."""
+        for scene, vxs in [(stack_scene, [100, 200]), (chain_scene, [200, 200])]:
+            world = scene(DelassusEngine(warm_start=False))
+            v = world.v.data.clone()
+            dynamic = [i for i, s in enumerate(world.static) if not s]
+            for i, vx in zip(dynamic, vxs):
+                v[i * world.vec_len + 1] = vx
+            weights = torch.linspace(-1, 1, v.size(0)).type_as(v)
+
+            def loss(v):
+                world.v = Variable(v)
+                return (world.solve_dynamics(world.dt).data * weights).sum()
+
+            world.v = Variable(v.clone(), requires_grad=True)
+            (world.solve_dynamics(world.dt) * Variable(weights)).sum().backward()
+            grad = world.v.grad.data
+            fd = torch.zeros(v.size()).type_as(v)
+            eps = 1e-4
+            for i in range(v.size(0)):
+                v_plus, v_minus = v.clone(), v.clone()
+                v_plus[i] += eps
+                v_minus[i] -= eps
+                fd[i] = (loss(v_plus) - loss(v_minus)) / (2 * eps)
+            assert_close(self, grad, fd)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestPgsEngine(unittest.TestCase):
+    def test_converges_to_pdipm(self):
+        """The resting box's velocities approach PdipmEngine's as sweeps are
+        added."""
+        v = box_scene(PdipmEngine()).solve_dynamics(Params.DEFAULT_DT).data
+        errors = []
+        for iterations in [1, 10, 100]:
+            world = box_scene(PgsEngine(iterations=iterations, tol=0))
+            pgs_v = world.solve_dynamics(world.dt).data
+            errors.append((pgs_v - v).abs().max())
+        self.assertLessEqual(errors[2], errors[0])
+        self.assertLess(errors[2], 1e-2 * (1 + v.abs().max()))
+
+    def test_no_stabilization(self):
+        world = box_scene(PgsEngine())
+        with self.assertRaises(NotImplementedError):
+            world.engine.solve_dynamics(world, world.dt, stabilization=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
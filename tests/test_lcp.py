@@ -0,0 +1,239 @@
+import itertools
+import unittest
+
+try:
+    import torch
+    from torch.autograd import Variable
+
+    from lcp_physics.lcp.lcp import LCPFunction, LCPSolvers
+    from lcp_physics.lcp.solvers import batch_fb_newton as fbn_b
+    from lcp_physics.lcp.solvers import batch_pdipm as pdipm_b
+    from lcp_physics.physics.bodies import Rect
+    from lcp_physics.physics.engines import PdipmEngine
+    from lcp_physics.physics.forces import ExternalForce, gravity
+    from lcp_physics.physics.utils import Params
+    from lcp_physics.physics.world import World
+except ImportError:  # torch 0.3, ode, pygame and scipy are needed
+    torch = None
+
+
+def random_lcp(nz=4, nineq=3, neq=1, seed=0):
+    """Returns a batch of one (Q, p, G, h, A, b, F) mixed LCP, with Q positive
+    definite and F monotone but not symmetric, as the engine's."""
+    torch.manual_seed(seed)
+    L = torch.randn(nz, nz).double()
+    Q = L.mm(L.t()) + torch.eye(nz).double()
+    p = torch.randn(nz).double()
+    G = torch.randn(nineq, nz).double()
+    h = torch.rand(nineq).double() + 1
+    A = torch.randn(neq, nz).double()
+    b = torch.randn(neq).double()
+    L = 0.1 * torch.randn(nineq, nineq).double()
+    B = 0.1 * torch.randn(nineq, nineq).double()
+    F = L.mm(L.t()) + B - B.t()
+    return [t.unsqueeze(0) for t in (Q, p, G, h, A, b, F)]
+
+
+def contact_lcp():
+    """Returns the batch of one mixed LCP PdipmEngine builds for a box sliding
+    on a static ground. F's friction blocks (E, mu and -E^T) are not
+    symmetric, and the sliding keeps the solution strictly complementary."""
+    box = Rect([500, 465], [60, 60], fric_coeff=0.1)
+    box.add_force(ExternalForce(gravity, multiplier=100))
+    world = World([Rect([500, 500], [900, 10], static=True), box], [])
+    box.v = Variable(Params.TENSOR_TYPE([0, 100, 0]))
+    view = world.dynamic_view()
+    M, G, h, F = PdipmEngine().lcp_terms(view, view.Jc())
+    u = view.M.mv(view.v) + world.dt * view.apply_forces(world.t)
+    empty = torch.DoubleTensor()
+    return [M.data.unsqueeze(0), u.data.unsqueeze(0), G.data.unsqueeze(0),
+            h.data.unsqueeze(0), empty, empty, F.data.unsqueeze(0)]
+
+
+def solve(terms, **kwargs):
+    """Solves the LCP, returns the solver, the solution and the inputs'
+    Variables."""
+    inputs = [Variable(t.clone(), requires_grad=t.dim() > 0) for t in terms]
+    solver = LCPFunction(**kwargs)
+    x = solver(*inputs)
+    return solver, x, inputs
+
+
+def dense_adjoint(Q, G, A, F, lams, slacks, dl_dx):
+    """Solves the transposed KKT system of a single problem densely,
+
+    [Q^T, 0, G^T,   A^T] [dx ]     [dl_dx]
+    [0,   D, I,     0  ] [ds ] = - [0    ]
+    [G,   I, -F^T,  0  ] [dz ]     [0    ]
+    [A,   0, 0,     0  ] [dy ]     [0    ]
+
+    with D = lams / slacks, and returns (dx, dz, dy)."""
+    Q, G, A, F = Q[0], G[0], A[0], F[0]
+    nineq, nz, neq = G.size(0), G.size(1), A.size(0)
+    I = torch.eye(nineq).double()
+    zeros = torch.zeros
+    K = torch.cat([
+        torch.cat([Q.t(), zeros(nz, nineq).double(), G.t(), A.t()], 1),
+        torch.cat([zeros(nineq, nz).double(), torch.diag(lams[0] / slacks[0]), I,
+                   zeros(nineq, neq).double()], 1),
+        torch.cat([G, I, -F.t(), zeros(nineq, neq).double()], 1),
+        torch.cat([A, zeros(neq, 2 * nineq + neq).double()], 1)])
+    r = torch.cat([-dl_dx[0], zeros(2 * nineq + neq).double()])
+    v, _ = torch.gesv(r.unsqueeze(1), K)
+    v = v.squeeze(1)
+    return v[:nz], v[nz + nineq:nz + 2 * nineq], v[nz + 2 * nineq:]
+
+
+def finite_differences(loss, terms, k, eps=1e-6):
+    """Central differences of loss with respect to each entry of terms[k]."""
+    fd = torch.zeros(terms[k].size()).double()
+    for i in range(fd.numel()):
+        shifted = []
+        for sign in [1, -1]:
+            term = terms[k].clone()
+            step = eps * (1 + abs(term.view(-1)[i]))
+            term.view(-1)[i] += sign * step
+            shifted.append(loss(terms[:k] + [term] + terms[k + 1:]))
+        fd.view(-1)[i] = (shifted[0] - shifted[1]) / (2 * step)
+    return fd
+
+
+def assert_close(test, a, b, tol=1e-5):
+    test.assertLess((a - b).abs().max(), tol * (1 + b.abs().max()))
+
+
+KKT_SOLVERS = [pdipm_b.KKTSolvers.LU_FULL, pdipm_b.KKTSolvers.LU_PARTIAL,
+               pdipm_b.KKTSolvers.SP_LU_BATCHED] if torch is not None else []
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestLCPBackward(unittest.TestCase):
+    def test_matches_dense_adjoint(self):
+        """backward solves the transposed KKT system, for every KKT solver,
+        and for symmetric systems (whose LU_PARTIAL factors are reused)."""
+        for kkt_solver, symmetric in itertools.product(KKT_SOLVERS, [False, True]):
+            Q, p, G, h, A, b, F = terms = random_lcp()
+            terms[3] = h - 3  # make constraints active
+            if symmetric:
+                terms[6] = F = 0.5 * (F + F.transpose(1, 2))
+            solver, x, inputs = solve(terms, kkt_solver=kkt_solver)
+            self.assertGreater(solver.lams.max(), 1e-3)
+            dl_dx = torch.linspace(-1, 1, x.size(1)).double().unsqueeze(0)
+            x.backward(dl_dx)
+
+            dx, dlam, dnu = dense_adjoint(Q, G, A, F, solver.lams, solver.slacks, dl_dx)
+            assert_close(self, inputs[1].grad.data[0], dx)
+            assert_close(self, inputs[3].grad.data[0], -dlam)
+            assert_close(self, inputs[5].grad.data[0], -dnu)
+
+    def test_matches_finite_differences(self):
+        """dQ, dG, dh and dF of a contact LCP, whose F is not symmetric."""
+        terms = contact_lcp()
+        weights = torch.linspace(-1, 1, terms[0].size(1)).double().unsqueeze(0)
+        for kkt_solver in KKT_SOLVERS:
+            def loss(terms):
+                _, x, _ = solve(terms, kkt_solver=kkt_solver)
+                return (x.data * weights).sum()
+
+            _, x, inputs = solve(terms, kkt_solver=kkt_solver)
+            x.backward(weights)
+            for k in [0, 2, 3, 6]:
+                assert_close(self, inputs[k].grad.data,
+                             finite_differences(loss, terms, k), tol=1e-3)
+
+    def test_equilibrated_matches_unscaled(self):
+        """Ruiz scaling changes neither the solution nor the gradients, for
+        every KKT solver."""
+        active = random_lcp()
+        active[3] = active[3] - 3  # make constraints active
+        for terms, kkt_solver in itertools.product([active, contact_lcp()], KKT_SOLVERS):
+            results = []
+            for equilibrate in [False, True]:
+                _, x, inputs = solve(terms, kkt_solver=kkt_solver, equilibrate=equilibrate)
+                x.backward(torch.linspace(-1, 1, x.size(1)).double().unsqueeze(0))
+                results.append([x.data] + [t.grad.data for t in inputs if t.requires_grad])
+            for scaled, unscaled in zip(results[1], results[0]):
+                assert_close(self, scaled, unscaled, tol=1e-5)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestPDIPM(unittest.TestCase):
+    def test_masked_batch_matches_single_solves(self):
+        """Problems leaving the batch once converged or stalled end where
+        they do when solved alone, for every KKT solver."""
+        problems = []
+        for seed, shift in [(0, 0), (1, -3), (2, -10)]:
+            terms = random_lcp(seed=seed)
+            terms[3] = terms[3] + shift  # from inactive to strongly active
+            problems.append(terms)
+        batch = [torch.cat(terms) for terms in zip(*problems)]
+        for kkt_solver in KKT_SOLVERS:
+            _, x, _ = solve(batch, kkt_solver=kkt_solver)
+            for k, terms in enumerate(problems):
+                _, x_k, _ = solve(terms, kkt_solver=kkt_solver)
+                assert_close(self, x.data[k], x_k.data[0], tol=1e-8)
+
+    def test_warm_start_needs_fewer_iterations(self):
+        """Warm started from the solution of a nearby problem, e.g. the
+        previous step's, PDIPM reaches the same solution in fewer iterations."""
+        previous = random_lcp()
+        previous[3] = previous[3] - 3  # make constraints active
+        terms = [t.clone() for t in previous]
+        terms[1] = terms[1] * 1.01
+        solver, x, _ = solve(previous, maxIter=50)
+        warm_start = x.data, solver.slacks, solver.lams, solver.nus
+        _, x_ref, _ = solve(terms, maxIter=50)
+
+        def iterations(warm_start):
+            for n in range(1, 50):
+                _, x, _ = solve(terms, maxIter=n, warm_start=warm_start)
+                if (x.data - x_ref.data).abs().max() < 1e-8 * (1 + x_ref.data.abs().max()):
+                    return n
+            return None
+
+        cold, warm = iterations(None), iterations(warm_start)
+        self.assertIsNotNone(warm)
+        self.assertLess(warm, cold)
+
+    def test_sparse_batch_matches_dense(self):
+        """SP_LU_BATCHED's solutions and gradients of a batch match LU_FULL's."""
+        problems = [random_lcp(seed=seed) for seed in range(3)]
+        batch = [torch.cat(terms) for terms in zip(*problems)]
+        batch[3] = batch[3] - 3  # make constraints active
+        results = []
+        for kkt_solver in [pdipm_b.KKTSolvers.LU_FULL, pdipm_b.KKTSolvers.SP_LU_BATCHED]:
+            _, x, inputs = solve(batch, kkt_solver=kkt_solver)
+            x.backward(torch.linspace(-1, 1, x.numel()).double().view_as(x.data))
+            results.append([x.data] + [t.grad.data for t in inputs])
+        for sparse, dense in zip(results[1], results[0]):
+            assert_close(self, sparse, dense, tol=1e-6)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestFBNewton(unittest.TestCase):
+    def test_adjoint_matches_pdipm(self):
+        """The adjoint of the semismooth system gives PDIPM's gradients."""
+        terms = random_lcp()
+        terms[3] = terms[3] - 3  # make constraints active
+        grads = []
+        for solver in [LCPSolvers.PDIPM_BATCHED, LCPSolvers.FB_NEWTON_BATCHED]:
+            _, x, inputs = solve(terms, solver=solver)
+            x.backward(torch.linspace(-1, 1, x.size(1)).double().unsqueeze(0))
+            grads.append([t.grad.data for t in inputs])
+        for pdipm_grad, fbn_grad in zip(*grads):
+            assert_close(self, fbn_grad, pdipm_grad, tol=1e-4)
+
+    def test_converged_problems_frozen(self):
+        """A problem starting at its solution is left as is while the rest
+        of the batch is solved."""
+        terms = [torch.cat([t1, t2]) for t1, t2 in zip(random_lcp(), random_lcp(seed=1))]
+        x, y, z, s = fbn_b.forward(*terms)
+        warm_start = [x.clone(), s.clone(), z.clone(), y.clone()]
+        warm_start[0][1] = 0
+        x_w, _, _, _ = fbn_b.forward(*terms, warm_start=warm_start)
+        self.assertLess((x_w[0] - x[0]).abs().max(), 1e-10)
+        assert_close(self, x_w[1], x[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+
+try:
+    import torch
+    from torch.autograd import Variable
+
+    from lcp_physics.physics.bodies import Circle, Rect
+    from lcp_physics.physics.constraints import Joint
+    from lcp_physics.physics.forces import ExternalForce, gravity
+    from lcp_physics.physics.utils import Params
+    from lcp_physics.physics.world import BatchWorld, World
+except ImportError:  # torch 0.3, ode, pygame and scipy are needed
+    torch = None
+
+
+def stacks_scene(lift=0, **kwargs):
+    """Two separate stacks, a box on a box and a circle on a box, on a static
+    ground. The top bodies start lift above their supports."""
+    bodies = [Rect([500, 500], [900, 10], static=True)]
+    for x in [300, 700]:
+        r = Rect([x, 465], [60, 60])
+        r.add_force(ExternalForce(gravity, multiplier=100))
+        bodies.append(r)
+    r = Rect([300, 405 - lift], [60, 60])
+    r.add_force(ExternalForce(gravity, multiplier=100))
+    bodies.append(r)
+    c = Circle([700, 415 - lift], 20)
+    c.add_force(ExternalForce(gravity, multiplier=100))
+    bodies.append(c)
+    return World(bodies, [], **kwargs)
+
+
+def assert_close(test, a, b, tol=1e-4):
+    test.assertLess((a - b).abs().max(), tol * (1 + b.abs().max()))
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestIslands(unittest.TestCase):
+    def test_islands_match_single_solve(self):
+        world = stacks_scene(islands=False)
+        island_world = stacks_scene(islands=True)
+        self.assertEqual(len(island_world.find_islands()), 2)
+        for _ in range(5):
+            world.step()
+            island_world.step()
+            assert_close(self, island_world.v.data, world.v.data)
+
+    def test_lcp_cache_cleared(self):
+        world = stacks_scene()
+        mu = world.mu()
+        self.assertIs(world.mu(), mu)
+        world.find_collisions()
+        self.assertEqual(len(world._lcp_cache), 0)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestStatic(unittest.TestCase):
+    def test_matches_jointed_ground(self):
+        """A box landing and sliding on a static ground moves as it does on
+        a ground pinned by two joints."""
+        trajectories = []
+        for static in [True, False]:
+            ground = Rect([500, 500], [900, 10], static=static)
+            box = Rect([400, 460], [60, 60], fric_coeff=0.1)
+            box.add_force(ExternalForce(gravity, multiplier=100))
+            joints = [] if static else [Joint(ground, None, [100, 500]),
+                                        Joint(ground, None, [900, 500])]
+            world = World([ground, box], joints)
+            box.v = Variable(Params.TENSOR_TYPE([0, 150, 0]))
+            trajectory = []
+            for _ in range(20):
+                world.step()
+                trajectory.append(torch.cat([world.p.data[3:], world.v.data[3:]]))
+            trajectories.append(torch.stack(trajectory))
+        assert_close(self, trajectories[0], trajectories[1], tol=1e-3)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestSleep(unittest.TestCase):
+    def test_sleeps_and_wakes_when_hit(self):
+        """A box resting on the ground falls asleep while a circle falls
+        towards it from far above, and is woken when the circle lands."""
+        box = Rect([500, 465], [60, 60])
+        box.add_force(ExternalForce(gravity, multiplier=100))
+        circle = Circle([500, -700], 20)
+        circle.add_force(ExternalForce(gravity, multiplier=100))
+        world = World([Rect([500, 500], [900, 10], static=True), box, circle], [],
+                      islands=True, sleep=True)
+        for _ in range(30):
+            world.step()
+            if world.asleep[1]:
+                break
+        self.assertTrue(world.asleep[1])
+        self.assertFalse(world.asleep[2])
+        self.assertEqual(box.v.data.abs().max(), 0)
+        for _ in range(60):
+            world.step()
+            if not world.asleep[1]:
+                break
+        self.assertFalse(world.asleep[1])
+        self.assertGreater(circle.pos.data[1], 400)
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestGeomSync(unittest.TestCase):
+    def test_synced_for_ode(self):
+        world = stacks_scene(broad_phase='OdeBroadPhase')
+        world.step()
+        self.assertEqual(len(world._dirty_geoms), 0)
+        for b in world.bodies:
+            self.assertAlmostEqual(b.geom.getPosition()[0], b.pos.data[0])
+            self.assertAlmostEqual(b.geom.getPosition()[1], b.pos.data[1])
+
+    def test_not_synced_for_sweep_and_prune(self):
+        world = stacks_scene(broad_phase='SweepAndPrune')
+        world.step()
+        self.assertEqual(world._dirty_geoms, set(range(len(world.bodies))))
+
+
+@unittest.skipIf(torch is None, 'requires torch, ode and pygame')
+class TestBatchWorld(unittest.TestCase):
+    def test_no_post_stabilization(self):
+        with self.assertRaises(AssertionError):
+            BatchWorld([stacks_scene(post_stab=True), stacks_scene(post_stab=True)])
+
+    def test_matches_single_worlds(self):
+        # the top bodies rest or are still falling, so the worlds have
+        # different contact counts and the batch gets padded
+        lifts = [0, 30, 60]
+        batch = BatchWorld([stacks_scene(lift=l) for l in lifts])
+        worlds = [stacks_scene(lift=l) for l in lifts]
+        self.assertGreater(len(set(len(w.collisions) for w in batch.worlds)), 1)
+        for _ in range(5):
+            batch.step()
+            for w in worlds:
+                w.step()
+        for bw, w in zip(batch.worlds, worlds):
+            self.assertAlmostEqual(bw.t, w.t)
+            assert_close(self, bw.p.data, w.p.data)
+            assert_close(self, bw.v.data, w.v.data)
+
+
+if __name__ == '__main__':
+    unittest.main()